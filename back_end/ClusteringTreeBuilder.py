@@ -8,9 +8,13 @@ class ClusteringTreeBuilder:
         self.current_index = 0  # Index hiện tại cho node mới
         self.round_mapping = {}  # Mapping giữa các vòng
 
-    def add_initial_paragraphs(self,client, paragraphs):
+    def add_initial_paragraphs(self,client, paragraphs, keywords=None):
         """
         Thêm các đoạn văn ban đầu vào cây (các node lá)
+
+        Args:
+            paragraphs: Danh sách các đoạn văn đã tóm tắt
+            keywords: Từ khóa đã tính sẵn cho từng đoạn (nếu None sẽ gọi LLM để trích xuất)
         """
         initial_indices = []
 
@@ -19,7 +23,7 @@ class ClusteringTreeBuilder:
                 'index': self.current_index,
                 'parent_index': -1,  # Node gốc không có parent
                 'summarized_paragraph': summarized_paragraph,
-                'keyword': extract_key_word(client, summarized_paragraph),
+                'keyword': keywords[i] if keywords is not None else extract_key_word(client, summarized_paragraph),
                 'type': 'leaf_node',  # Loại: đoạn văn gốc
                 'round': 0,  # Vòng 0 = dữ liệu ban đầu
                 'cluster_id': None,  # Chưa thuộc cụm nào
@@ -112,6 +116,9 @@ class ClusteringTreeBuilder:
 
     def get_node_by_index(self, index):
         """Lấy node theo index"""
+        # Node được thêm với index tăng dần từ 0 nên thường nằm đúng vị trí index trong danh sách
+        if 0 <= index < len(self.tree) and self.tree[index]['index'] == index:
+            return self.tree[index]
         for node in self.tree:
             if node['index'] == index:
                 return node
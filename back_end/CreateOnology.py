@@ -1,7 +1,20 @@
 from owlready2 import *
 import types
 import re
-from LLMquery import get_embedding
+import json
+from EmbeddingStore import EMBEDDING_MODEL_NAME
+from OnnxEmbedding import active_embedding_model_key
+
+
+def entity_embedding_text(name, summary):
+    """Văn bản được nhúng cho một thực thể (tên + summary), dùng chung khi tạo ontology và khi chat."""
+    return f"{name.replace('_', ' ')}: {summary}"
+
+
+def embedding_model_name(model_embedding):
+    """Tên kho embedding của model (khớp với annotation 'summary_embedding_model' của ontology)."""
+    return getattr(model_embedding, 'store_name', None) or active_embedding_model_key(EMBEDDING_MODEL_NAME)
+
 
 def safe_add_annotation_property(onto, annotation_name):
     """Tạo annotation property nếu chưa tồn tại."""
@@ -166,7 +179,7 @@ def add_class_to_ontology(onto, parent_class_name, class_name_list, node, merged
 
 def add_annotation_to_class(onto, owl_class, node, merged_nodes):
     """
-    Thêm annotation 'summary' và 'summary_embeddings' cho một class.
+    Thêm annotation 'summary' cho một class (embedding được ghi sau bằng `add_summary_embeddings`).
     """
     # Đảm bảo các annotation property tồn tại
     summary_prop = getattr(onto, "summary", None)
@@ -179,18 +192,35 @@ def add_annotation_to_class(onto, owl_class, node, merged_nodes):
         summary_embeddings_prop = types.new_class("summary_embeddings", (AnnotationProperty,))
         onto.summary_embeddings = summary_embeddings_prop
 
+    summary_embedding_model_prop = getattr(onto, "summary_embedding_model", None)
+    if summary_embedding_model_prop is None:
+        summary_embedding_model_prop = types.new_class("summary_embedding_model", (AnnotationProperty,))
+        onto.summary_embedding_model = summary_embedding_model_prop
+
     # Tìm thông tin node tương ứng trong merged_nodes để lấy summary
     # Thay vì lặp lại merged_nodes, bạn có thể truyền thẳng `node` đã được lấy từ merged_nodes
     # hoặc cải thiện cách lấy summary_value
     summary_value = node.get("summarized_paragraph") # Đảm bảo key này đúng
     if summary_value:
-        try:
-            summary_embedding = get_embedding(model_embedding, summary_value)
-            owl_class.summary = summary_value
-            owl_class.summary_embeddings = str(summary_embedding)
-        except NameError:
-            print("Hàm get_embedding chưa được định nghĩa")
-            owl_class.summary = summary_value
+        owl_class.summary = summary_value
+
+
+def add_summary_embeddings(onto, model_embedding):
+    """
+    Nhúng (một lần cho cả ontology) văn bản `entity_embedding_text` của mọi class có summary và ghi vào
+    annotation 'summary_embeddings', kèm 'summary_embedding_model' để khi chat chỉ dùng lại vector
+    của đúng model đó. Văn bản giống hệt văn bản mà chỉ mục thực thể khi chat nhúng.
+    """
+    classes = [cls for cls in onto.classes() if getattr(cls, 'summary', None)]
+    if not classes:
+        return
+    texts = [entity_embedding_text(cls.name, ''.join(cls.summary)) for cls in classes]
+    embeddings = model_embedding.encode(texts, show_progress_bar=False)
+    model_key = embedding_model_name(model_embedding)
+    for cls, embedding in zip(classes, embeddings):
+        cls.summary_embeddings = json.dumps([round(float(x), 5) for x in embedding], separators=(',', ':'))
+        cls.summary_embedding_model = model_key
+    print(f"Đã lưu embedding cho {len(classes)} class vào ontology")
 
 
 def clean_class_name(name):
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ khóa giữa các thread trong process
+    fcntl = None
+
+# --- Cấu hình cache tài liệu ---
+DOCUMENT_CACHE_FOLDER = os.getenv('DOCUMENT_CACHE_FOLDER', 'document_cache')
+DOCUMENT_CACHE_MAX_ENTRIES = int(os.getenv('DOCUMENT_CACHE_MAX_ENTRIES', '100'))
+DOCUMENT_CACHE_MAX_BYTES = int(os.getenv('DOCUMENT_CACHE_MAX_MB', '1024')) * 1024 * 1024
+
+
+def save_upload_with_hash(file_storage, save_path, chunk_size=1024 * 1024):
+    """
+    Lưu file upload xuống đĩa theo từng chunk, đồng thời tính SHA-256 của nội dung.
+    File không bị đọc toàn bộ vào bộ nhớ.
+
+    Args:
+        file_storage: werkzeug FileStorage từ `request.files`.
+        save_path (str): Đường dẫn lưu file.
+        chunk_size (int): Kích thước mỗi lần đọc (bytes).
+
+    Returns:
+        str: Mã SHA-256 (hex) của file.
+    """
+    hasher = hashlib.sha256()
+    with open(save_path, 'wb') as f:
+        while True:
+            chunk = file_storage.stream.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            f.write(chunk)
+    return hasher.hexdigest()
+
+
+def document_cache_key(pdf_hash, settings):
+    """
+    Key cache của một tài liệu: SHA-256 của file PDF kèm hash các cấu hình ảnh hưởng tới kết quả
+    (cách trích xuất, tìm k, dựng cây, engine phân cụm, model embedding/LLM), để đổi cấu hình
+    thì không dùng lại cây và ontology tạo theo cấu hình cũ.
+
+    Args:
+        pdf_hash (str): SHA-256 của file PDF.
+        settings (dict): Các cấu hình ảnh hưởng tới kết quả.
+
+    Returns:
+        str: '<pdf_hash>-<16 ký tự hex đầu của hash cấu hình>'
+    """
+    settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+    return f"{pdf_hash}-{settings_hash[:16]}"
+
+
+class DocumentCache:
+    """
+    Cache kết quả xử lý PDF theo nội dung (content-addressed): key là SHA-256 của file PDF kèm hash
+    cấu hình (`document_cache_key`), giá trị là cây phân cụm và file ontology (.owl) đã tạo.
+    Giới hạn theo số lượng và tổng dung lượng, loại bỏ mục ít được dùng gần đây nhất (LRU).
+    Flask và các Celery worker dùng chung thư mục cache: mọi thao tác đọc-sửa-ghi index đều giữ khóa file
+    và đọc lại index từ đĩa, nên không làm mất mục hoặc xóa nhầm mục do process khác vừa thêm.
+
+    Cấu trúc thư mục:
+        <cache_dir>/index.json
+        <cache_dir>/.lock
+        <cache_dir>/<cache_key>/tree.json
+        <cache_dir>/<cache_key>/ontology.owl
+    """
+
+    def __init__(self, cache_dir=DOCUMENT_CACHE_FOLDER, max_entries=DOCUMENT_CACHE_MAX_ENTRIES,
+                 max_bytes=DOCUMENT_CACHE_MAX_BYTES):
+        """
+        Args:
+            cache_dir (str): Thư mục lưu cache.
+            max_entries (int): Số tài liệu tối đa được lưu.
+            max_bytes (int): Tổng dung lượng tối đa (bytes).
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock_path = os.path.join(cache_dir, '.lock')
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._file_lock():
+            self._index = self._load_index()
+
+    @contextmanager
+    def _file_lock(self):
+        """Khóa độc quyền giữa các process (không có fcntl thì chỉ khóa trong process)."""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        """Đọc index từ đĩa, bỏ qua các mục không còn thư mục tương ứng."""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {cache_key: entry for cache_key, entry in index.items()
+                if os.path.isdir(self._entry_dir(cache_key))}
+
+    def _save_index(self):
+        """Ghi index xuống đĩa (ghi file tạm rồi thay thế nguyên tử để tránh hỏng file), gọi khi đang giữ khóa file."""
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _entry_dir(self, cache_key):
+        return os.path.join(self.cache_dir, cache_key)
+
+    def get(self, cache_key):
+        """
+        Lấy kết quả đã cache của một tài liệu.
+
+        Args:
+            cache_key (str): Key của tài liệu (`document_cache_key`).
+
+        Returns:
+            dict hoặc None: {'tree': cây phân cụm, 'ontology_path': đường dẫn file .owl trong cache},
+                            None nếu chưa có trong cache.
+        """
+        with self._file_lock():
+            self._index = self._load_index()
+            entry = self._index.get(cache_key)
+            if entry is None:
+                return None
+
+            entry_dir = self._entry_dir(cache_key)
+            ontology_path = os.path.join(entry_dir, 'ontology.owl')
+            try:
+                with open(os.path.join(entry_dir, 'tree.json'), 'r', encoding='utf-8') as f:
+                    tree = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Cache tài liệu bị hỏng cho {cache_key}: {e}")
+                self._remove_entry(cache_key)
+                self._save_index()
+                return None
+            if not os.path.exists(ontology_path):
+                self._remove_entry(cache_key)
+                self._save_index()
+                return None
+
+            entry['last_access'] = time.time()
+            entry['hits'] = entry.get('hits', 0) + 1
+            self._save_index()
+
+        print(f"Cache tài liệu HIT: {cache_key}")
+        return {'tree': tree, 'ontology_path': ontology_path}
+
+    def put(self, cache_key, clustering_tree, ontology_path):
+        """
+        Lưu cây phân cụm và file ontology của một tài liệu vào cache, sau đó loại bỏ mục cũ nếu vượt giới hạn.
+
+        Args:
+            cache_key (str): Key của tài liệu (`document_cache_key`).
+            clustering_tree (list): Cây phân cụm (danh sách node).
+            ontology_path (str): Đường dẫn file .owl đã tạo.
+        """
+        with self._file_lock():
+            self._index = self._load_index()
+            entry_dir = self._entry_dir(cache_key)
+            os.makedirs(entry_dir, exist_ok=True)
+            tree_path = os.path.join(entry_dir, 'tree.json')
+            with open(tree_path, 'w', encoding='utf-8') as f:
+                json.dump(clustering_tree, f, ensure_ascii=False)
+            cached_ontology_path = os.path.join(entry_dir, 'ontology.owl')
+            shutil.copyfile(ontology_path, cached_ontology_path)
+
+            now = time.time()
+            self._index[cache_key] = {
+                'size': os.path.getsize(tree_path) + os.path.getsize(cached_ontology_path),
+                'created': now,
+                'last_access': now,
+                'hits': 0
+            }
+            self._evict()
+            self._save_index()
+        print(f"Đã lưu tài liệu vào cache: {cache_key}")
+
+    def _remove_entry(self, cache_key):
+        self._index.pop(cache_key, None)
+        shutil.rmtree(self._entry_dir(cache_key), ignore_errors=True)
+
+    def _evict(self):
+        """Loại bỏ các mục ít được truy cập gần đây nhất cho đến khi nằm trong giới hạn."""
+        total_bytes = sum(entry['size'] for entry in self._index.values())
+        lru_order = sorted(self._index, key=lambda cache_key: self._index[cache_key]['last_access'])
+        for cache_key in lru_order:
+            if len(self._index) <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            total_bytes -= self._index[cache_key]['size']
+            self._remove_entry(cache_key)
+            print(f"Đã loại bỏ tài liệu khỏi cache (LRU): {cache_key}")
+
+    def stats(self):
+        """Thống kê cache: số mục, tổng dung lượng và số lần hit."""
+        with self._file_lock():
+            self._index = self._load_index()
+            return {
+                'entries': len(self._index),
+                'total_bytes': sum(entry['size'] for entry in self._index.values()),
+                'hits': sum(entry.get('hits', 0) for entry in self._index.values())
+            }
@@ -0,0 +1,365 @@
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ khóa giữa các thread trong process
+    fcntl = None
+
+# --- Cấu hình kho embedding ---
+EMBEDDING_STORE_ENABLED = os.getenv('EMBEDDING_STORE_ENABLED', '1') == '1'
+EMBEDDING_STORE_FOLDER = os.getenv('EMBEDDING_STORE_FOLDER', 'embedding_store')
+# float16 giảm một nửa dung lượng/bộ nhớ, sai số cosine ~1e-3 không ảnh hưởng phân cụm và truy xuất
+EMBEDDING_STORE_DTYPE = os.getenv('EMBEDDING_STORE_DTYPE', 'float16')
+EMBEDDING_STORE_INITIAL_CAPACITY = 1024
+EMBEDDING_MODEL_NAME = os.getenv('EMBEDDING_MODEL_NAME', 'paraphrase-multilingual-MiniLM-L12-v2')
+
+
+def text_hash(text):
+    """SHA-256 (hex) của nội dung văn bản, dùng làm key của kho embedding."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Kho embedding trên đĩa theo nội dung (content-addressed): key là SHA-256 của văn bản,
+    giá trị là một dòng trong ma trận memory-mapped (float16/float32).
+    Nhiều process (Flask, Celery worker) có thể mở cùng một kho: dữ liệu được OS chia sẻ qua page cache,
+    không process nào phải copy cả ma trận vào bộ nhớ. Ghi thêm (append) và nén (compact) được khóa bằng fcntl.
+
+    Cấu trúc thư mục:
+        <store_dir>/meta.json     {dim, dtype, capacity, generation}
+        <store_dir>/vectors.bin   ma trận (capacity, dim), chỉ `count` dòng đầu có dữ liệu
+        <store_dir>/ids.txt       mỗi dòng là hash của một dòng trong ma trận (thứ tự dòng)
+        <store_dir>/.lock
+    """
+
+    def __init__(self, store_dir=EMBEDDING_STORE_FOLDER, dtype=EMBEDDING_STORE_DTYPE, read_only=False):
+        """
+        Args:
+            store_dir (str): Thư mục của kho (mỗi model embedding nên dùng một thư mục riêng).
+            dtype (str): 'float16' hoặc 'float32', chỉ dùng khi tạo kho mới.
+            read_only (bool): Chỉ đọc (không ghi thêm), dùng cho các worker chỉ tra cứu.
+        """
+        self.store_dir = store_dir
+        self.dtype = np.dtype(dtype)
+        self.read_only = read_only
+        self.meta_path = os.path.join(store_dir, 'meta.json')
+        self.vectors_path = os.path.join(store_dir, 'vectors.bin')
+        self.ids_path = os.path.join(store_dir, 'ids.txt')
+        self.lock_path = os.path.join(store_dir, '.lock')
+        self._lock = threading.RLock()
+
+        self.dim = None
+        self.capacity = 0
+        self.generation = None
+        self._index = {}
+        self._rows = 0
+        self._ids_offset = 0
+        self._vectors = None
+
+        if not read_only:
+            os.makedirs(store_dir, exist_ok=True)
+        with self._lock:
+            self._refresh()
+
+    # --- Khóa và metadata ---
+    @contextmanager
+    def _file_lock(self):
+        """Khóa độc quyền giữa các process khi ghi (không có fcntl thì chỉ khóa trong process)."""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self):
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'dim': self.dim, 'dtype': self.dtype.name, 'capacity': self.capacity,
+                       'generation': self.generation}, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def _open_vectors(self):
+        mode = 'r' if self.read_only else 'r+'
+        self._vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode=mode, shape=(self.capacity, self.dim))
+
+    def _refresh(self):
+        """
+        Đồng bộ với dữ liệu trên đĩa: mở lại ma trận khi kho được nén/mở rộng,
+        đọc thêm các id mới do process khác ghi vào.
+        """
+        meta = self._read_meta()
+        if meta is None:
+            return
+        if meta['generation'] != self.generation or meta['capacity'] != self.capacity:
+            if meta['generation'] != self.generation:
+                self._index = {}
+                self._rows = 0
+                self._ids_offset = 0
+            self.dim = meta['dim']
+            self.dtype = np.dtype(meta['dtype'])
+            self.capacity = meta['capacity']
+            self.generation = meta['generation']
+            self._open_vectors()
+
+        try:
+            with open(self.ids_path, 'r', encoding='ascii') as f:
+                f.seek(self._ids_offset)
+                new_ids = f.read()
+        except OSError:
+            return
+        # Chỉ nhận các dòng đã ghi trọn vẹn (kết thúc bằng xuống dòng)
+        complete = new_ids[:new_ids.rfind('\n') + 1]
+        for key in complete.splitlines():
+            self._index.setdefault(key, self._rows)
+            self._rows += 1
+        self._ids_offset += len(complete)
+
+    # --- Đọc ---
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, text):
+        return text_hash(text) in self._index
+
+    def get(self, text):
+        """Lấy vector (float32) của một văn bản, None nếu chưa có."""
+        vectors, found = self.get_many([text])
+        return vectors[0] if found[0] else None
+
+    def get_many(self, texts, refresh=True):
+        """
+        Lấy vector của nhiều văn bản.
+
+        Returns:
+            tuple: (np.ndarray (n, dim) float32 — dòng chưa có là 0, np.ndarray bool đánh dấu văn bản đã có)
+        """
+        with self._lock:
+            if refresh:
+                self._refresh()
+            rows = [self._index.get(text_hash(text), -1) for text in texts]
+            found = np.array([row >= 0 for row in rows], dtype=bool)
+            if self.dim is None:
+                return np.zeros((len(texts), 0), dtype=np.float32), found
+            vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+            if found.any():
+                vectors[found] = self._vectors[np.array(rows)[found]]
+            return vectors, found
+
+    # --- Ghi ---
+    def _ensure_capacity(self, dim, needed_rows):
+        """Tạo kho mới hoặc mở rộng file ma trận (gấp đôi) khi không đủ chỗ."""
+        if self.dim is None:
+            self.dim = dim
+            self.generation = 0
+            self.capacity = 0
+        elif dim != self.dim:
+            raise ValueError(f"Vector có {dim} chiều, kho embedding có {self.dim} chiều.")
+
+        if needed_rows <= self.capacity:
+            return
+        capacity = max(EMBEDDING_STORE_INITIAL_CAPACITY, self.capacity)
+        while capacity < needed_rows:
+            capacity *= 2
+        self._vectors = None
+        with open(self.vectors_path, 'ab') as f:
+            f.truncate(capacity * self.dim * self.dtype.itemsize)
+        self.capacity = capacity
+        self._write_meta()
+        self._open_vectors()
+
+    def add_many(self, texts, vectors):
+        """
+        Ghi thêm vector cho các văn bản chưa có trong kho.
+        Vector được ghi trước, id ghi sau cùng: process khác chỉ thấy id khi vector đã nằm trên đĩa.
+        """
+        if self.read_only:
+            raise PermissionError("Kho embedding đang mở ở chế độ chỉ đọc.")
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._file_lock():
+            self._refresh()
+            new_keys, new_rows = [], []
+            for i, text in enumerate(texts):
+                key = text_hash(text)
+                if key not in self._index and key not in new_keys:
+                    new_keys.append(key)
+                    new_rows.append(i)
+            if not new_keys:
+                return 0
+
+            start = self._rows
+            self._ensure_capacity(vectors.shape[1], start + len(new_keys))
+            self._vectors[start:start + len(new_keys)] = vectors[new_rows].astype(self.dtype)
+            self._vectors.flush()
+            with open(self.ids_path, 'a', encoding='ascii') as f:
+                f.write(''.join(key + '\n' for key in new_keys))
+            self._refresh()
+            return len(new_keys)
+
+    def encode(self, model, texts, show_progress_bar=False, write=True):
+        """
+        Lấy vector của các văn bản từ kho, chỉ nhúng (model.encode) những văn bản chưa có rồi ghi thêm vào kho.
+        Vector mới nhúng được làm tròn theo dtype của kho nên kết quả không phụ thuộc việc đã có trong kho hay chưa.
+        `write=False` chỉ tra cứu: văn bản chưa có được nhúng nhưng không ghi vào kho.
+
+        Returns:
+            np.ndarray (n, dim) float32, đúng thứ tự đầu vào.
+        """
+        vectors, found = self.get_many(texts)
+        if found.all():
+            return vectors
+
+        missing_positions = np.where(~found)[0]
+        # Văn bản trùng nhau chỉ nhúng một lần
+        unique_missing = list(dict.fromkeys(texts[i] for i in missing_positions))
+        new_vectors = np.asarray(model.encode(unique_missing, show_progress_bar=show_progress_bar), dtype=np.float32)
+        # Làm tròn theo kiểu dữ liệu của kho để lần nhúng đầu và các lần đọc lại sau cho cùng một vector
+        new_vectors = new_vectors.astype(self.dtype).astype(np.float32)
+        if write and not self.read_only:
+            self.add_many(unique_missing, new_vectors)
+
+        if vectors.shape[1] == 0:
+            vectors = np.zeros((len(texts), new_vectors.shape[1]), dtype=np.float32)
+        position = {text: i for i, text in enumerate(unique_missing)}
+        for i in missing_positions:
+            vectors[i] = new_vectors[position[texts[i]]]
+        return vectors
+
+    # --- Nén ---
+    def compact(self, keep_texts=None):
+        """
+        Viết lại kho chỉ gồm các dòng cần giữ (mặc định: bỏ dòng trùng và phần dung lượng dư).
+        File mới được tạo rồi thay thế nguyên tử; process khác đang đọc vẫn dùng file cũ
+        cho tới khi thấy `generation` thay đổi.
+
+        Args:
+            keep_texts (list, optional): Chỉ giữ vector của các văn bản này.
+
+        Returns:
+            int: Số vector còn lại.
+        """
+        if self.read_only:
+            raise PermissionError("Kho embedding đang mở ở chế độ chỉ đọc.")
+        with self._file_lock():
+            self._refresh()
+            if self.dim is None:
+                return 0
+            if keep_texts is None:
+                keys = list(self._index)
+            else:
+                keys = [key for key in dict.fromkeys(text_hash(text) for text in keep_texts) if key in self._index]
+            rows = np.array([self._index[key] for key in keys], dtype=np.intp)
+
+            capacity = max(EMBEDDING_STORE_INITIAL_CAPACITY, len(keys))
+            tmp_vectors_path = self.vectors_path + '.tmp'
+            new_vectors = np.memmap(tmp_vectors_path, dtype=self.dtype, mode='w+', shape=(capacity, self.dim))
+            if len(rows):
+                new_vectors[:len(rows)] = self._vectors[rows]
+            new_vectors.flush()
+            del new_vectors
+            tmp_ids_path = self.ids_path + '.tmp'
+            with open(tmp_ids_path, 'w', encoding='ascii') as f:
+                f.write(''.join(key + '\n' for key in keys))
+
+            self._vectors = None
+            os.replace(tmp_vectors_path, self.vectors_path)
+            os.replace(tmp_ids_path, self.ids_path)
+            self.capacity = capacity
+            self.generation += 1
+            self._write_meta()
+            self._index = {}
+            self._rows = 0
+            self._ids_offset = 0
+            self.generation = None
+            self._refresh()
+            print(f"Đã nén kho embedding: còn {len(keys)} vector")
+            return len(keys)
+
+    def stats(self):
+        """Thống kê kho: số vector, số chiều, kiểu dữ liệu và dung lượng file ma trận."""
+        with self._lock:
+            return {
+                'entries': len(self._index),
+                'dim': self.dim,
+                'dtype': self.dtype.name,
+                'capacity': self.capacity,
+                'file_bytes': os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+            }
+
+
+class StoredEmbeddingModel:
+    """
+    Bọc model embedding (SentenceTransformer) để `encode` đi qua EmbeddingStore:
+    văn bản đã nhúng khi xử lý tài liệu (phân cụm, tạo ontology) không phải nhúng lại.
+    Dùng thay trực tiếp cho model ở mọi nơi gọi `model.encode(...)`.
+    """
+
+    def __init__(self, model, store, write=True):
+        """
+        Args:
+            model: Model embedding thật.
+            store (EmbeddingStore): Kho embedding.
+            write (bool): Ghi vector mới nhúng vào kho. Dùng False cho chat để câu hỏi của người dùng
+                          chỉ tra cứu kho, không bị lưu lại và không làm kho lớn dần theo lượng truy cập.
+        """
+        self.model = model
+        self.store = store
+        self.write = write
+
+    def encode(self, sentences, show_progress_bar=False, **kwargs):
+        """Giống SentenceTransformer.encode: chuỗi đơn trả về vector 1 chiều, list trả về ma trận."""
+        if kwargs:
+            # Tùy chọn đặc biệt (normalize_embeddings, convert_to_tensor, ...) không qua kho
+            return self.model.encode(sentences, show_progress_bar=show_progress_bar, **kwargs)
+        if isinstance(sentences, str):
+            return self.store.encode(self.model, [sentences], show_progress_bar, self.write)[0]
+        sentences = list(sentences)
+        if not sentences:
+            return np.zeros((0, self.store.dim or 0), dtype=np.float32)
+        return self.store.encode(self.model, sentences, show_progress_bar, self.write)
+
+    def __getattr__(self, name):
+        if name == 'model':
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+
+def model_store_dir(model_name, root=EMBEDDING_STORE_FOLDER):
+    """Thư mục kho cho một model embedding (vector của các model khác nhau không dùng chung được)."""
+    return os.path.join(root, model_name.replace('/', '__'))
+
+
+_embedding_stores = {}
+_embedding_stores_lock = threading.Lock()
+
+
+def get_embedding_store(model_name=EMBEDDING_MODEL_NAME, read_only=False):
+    """Lấy kho embedding dùng chung trong process cho một model. Trả về None nếu kho bị tắt."""
+    if not EMBEDDING_STORE_ENABLED:
+        return None
+    with _embedding_stores_lock:
+        key = (model_name, read_only)
+        if key not in _embedding_stores:
+            store_dir = model_store_dir(model_name)
+            if read_only and not os.path.exists(os.path.join(store_dir, 'meta.json')):
+                return None
+            _embedding_stores[key] = EmbeddingStore(store_dir, read_only=read_only)
+        return _embedding_stores[key]
@@ -0,0 +1,155 @@
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# --- Cấu hình bộ nhúng văn bản ---
+# Số process nhúng song song (0 = chỉ nhúng trong process hiện tại)
+ENCODER_POOL_WORKERS = int(os.getenv('ENCODER_POOL_WORKERS', '0'))
+# Số thread torch cho mỗi process (0 = để torch tự chọn)
+ENCODER_THREADS_PER_WORKER = int(os.getenv('ENCODER_THREADS_PER_WORKER', '0'))
+# Mặc định bằng batch_size của SentenceTransformer.encode
+ENCODER_BATCH_SIZE = int(os.getenv('ENCODER_BATCH_SIZE', '32'))
+# Dưới số câu này thì nhúng ngay trong process (chi phí gửi dữ liệu sang worker lớn hơn lợi ích)
+ENCODER_MIN_PARALLEL_ITEMS = int(os.getenv('ENCODER_MIN_PARALLEL_ITEMS', '256'))
+
+_encoder_worker_state = {}
+
+
+def _configure_threads(num_threads):
+    if not num_threads:
+        return
+    try:
+        import torch
+        torch.set_num_threads(int(num_threads))
+    except ImportError:
+        pass
+
+
+def _init_encoder_worker(model_name, num_threads, backend='torch'):
+    """Khởi tạo worker: đặt số thread và load model embedding riêng cho process này (CPU)."""
+    if backend == 'onnx':
+        from OnnxEmbedding import OnnxEmbeddingModel, onnx_model_dir
+        _encoder_worker_state['model'] = OnnxEmbeddingModel(onnx_model_dir(model_name), num_threads=num_threads)
+        return
+    _configure_threads(num_threads)
+    from sentence_transformers import SentenceTransformer
+    _encoder_worker_state['model'] = SentenceTransformer(model_name, device='cpu')
+
+
+def _encode_chunk(sentences, batch_size):
+    """Nhúng một nhóm câu (đã sắp theo độ dài) trong worker process."""
+    return np.asarray(_encoder_worker_state['model'].encode(sentences, batch_size=batch_size,
+                                                            show_progress_bar=False), dtype=np.float32)
+
+
+class EncoderPool:
+    """
+    Bộ nhúng câu cho CPU: sắp các câu theo số token rồi chia thành các nhóm liền nhau
+    (câu dài gần bằng nhau nằm cùng batch nên ít padding), nhúng song song trên nhiều process
+    và trả kết quả theo đúng thứ tự đầu vào.
+    Dùng thay trực tiếp cho SentenceTransformer ở mọi nơi gọi `model.encode(...)`.
+    """
+
+    def __init__(self, model, model_name, workers=ENCODER_POOL_WORKERS, threads_per_worker=ENCODER_THREADS_PER_WORKER,
+                 batch_size=ENCODER_BATCH_SIZE, min_parallel_items=ENCODER_MIN_PARALLEL_ITEMS):
+        """
+        Args:
+            model: SentenceTransformer hoặc OnnxEmbeddingModel đã load (dùng cho lượng câu nhỏ và để đếm token).
+            model_name (str): Tên model để các worker tự load.
+            workers (int): Số worker process (0 = không dùng pool).
+            threads_per_worker (int): Số thread torch mỗi process (cả process chính).
+            batch_size (int): Kích thước batch khi nhúng.
+            min_parallel_items (int): Số câu tối thiểu để gửi sang pool.
+        """
+        self.model = model
+        self.model_name = model_name
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.batch_size = batch_size
+        self.min_parallel_items = min_parallel_items
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # Worker load cùng loại backend với model của process chính
+        self.backend = 'onnx' if hasattr(model, 'session') else 'torch'
+        _configure_threads(threads_per_worker)
+
+    def _get_executor(self):
+        """Tạo pool lần đầu khi cần (các worker load model một lần và dùng lại cho mọi lần nhúng)."""
+        with self._executor_lock:
+            if self._executor is None:
+                print(f"Khởi tạo {self.workers} worker nhúng văn bản ({self.threads_per_worker or 'auto'} thread/worker)")
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=_init_encoder_worker,
+                                                     initargs=(self.model_name, self.threads_per_worker, self.backend))
+                atexit.register(self.close)
+            return self._executor
+
+    def close(self):
+        """Dừng các worker process."""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def token_lengths(self, sentences):
+        """Số token của từng câu (theo tokenizer của model, không có thì theo số ký tự)."""
+        tokenizer = getattr(self.model, 'tokenizer', None)
+        if tokenizer is None:
+            return [len(sentence) for sentence in sentences]
+        encoded = tokenizer(sentences, add_special_tokens=False, truncation=False)['input_ids']
+        return [len(ids) for ids in encoded]
+
+    def length_sorted_chunks(self, sentences, n_chunks):
+        """
+        Sắp chỉ số câu theo số token giảm dần và chia thành tối đa `n_chunks` nhóm liền nhau,
+        mỗi nhóm gồm nguyên các batch.
+
+        Returns:
+            list: Danh sách nhóm, mỗi nhóm là np.ndarray chỉ số câu gốc.
+        """
+        order = np.argsort(-np.asarray(self.token_lengths(sentences)), kind='stable')
+        n_batches = -(-len(sentences) // self.batch_size)
+        batches_per_chunk = max(1, -(-n_batches // max(1, n_chunks)))
+        chunk_size = batches_per_chunk * self.batch_size
+        return [order[start:start + chunk_size] for start in range(0, len(order), chunk_size)]
+
+    def encode(self, sentences, show_progress_bar=False, batch_size=None, **kwargs):
+        """
+        Giống SentenceTransformer.encode (trả về numpy float32): chuỗi đơn trả về vector 1 chiều.
+        Tùy chọn khác (normalize_embeddings, convert_to_tensor, ...) được chuyển thẳng cho model.
+        """
+        if kwargs:
+            return self.model.encode(sentences, show_progress_bar=show_progress_bar,
+                                     batch_size=batch_size or self.batch_size, **kwargs)
+        if isinstance(sentences, str):
+            return self.encode([sentences], show_progress_bar, batch_size)[0]
+
+        sentences = list(sentences)
+        batch_size = batch_size or self.batch_size
+        if self.workers <= 0 or len(sentences) < self.min_parallel_items:
+            # Model tự sắp theo độ dài bên trong, không cần chia nhóm
+            return np.asarray(self.model.encode(sentences, batch_size=batch_size,
+                                                show_progress_bar=show_progress_bar), dtype=np.float32)
+
+        # Mỗi worker nhận vài nhóm để cân bằng tải khi độ dài câu chênh lệch nhiều
+        chunks = self.length_sorted_chunks(sentences, self.workers * 4)
+        executor = self._get_executor()
+        futures = [executor.submit(_encode_chunk, [sentences[i] for i in chunk], batch_size) for chunk in chunks]
+
+        embeddings = None
+        for chunk, future in zip(chunks, futures):
+            chunk_embeddings = future.result()
+            if embeddings is None:
+                embeddings = np.empty((len(sentences), chunk_embeddings.shape[1]), dtype=np.float32)
+            embeddings[chunk] = chunk_embeddings
+        return embeddings
+
+    def __getattr__(self, name):
+        if name == 'model':
+            raise AttributeError(name)
+        return getattr(self.model, name)
@@ -0,0 +1,193 @@
+import os
+
+import faiss
+import numpy as np
+
+from ParagraphClusterer import ParagraphClusterer
+
+# --- Cấu hình engine phân cụm ---
+# 'sklearn': ParagraphClusterer (MiniBatchKMeans), 'faiss': FaissParagraphClusterer (spherical faiss.Kmeans)
+CLUSTERING_ENGINE = os.getenv('CLUSTERING_ENGINE', 'sklearn')
+FAISS_KMEANS_NITER = int(os.getenv('FAISS_KMEANS_NITER', '25'))
+FAISS_KMEANS_NREDO = int(os.getenv('FAISS_KMEANS_NREDO', '1'))
+# Từ số đoạn này trở lên thì chọn đoạn đại diện bằng chỉ mục HNSW (gần đúng) thay vì tìm chính xác
+FAISS_ANN_MIN_ITEMS = int(os.getenv('FAISS_ANN_MIN_ITEMS', '20000'))
+# Số láng giềng gần tâm cụm được xét khi chọn đoạn đại diện
+FAISS_REPRESENTATIVE_CANDIDATES = int(os.getenv('FAISS_REPRESENTATIVE_CANDIDATES', '32'))
+
+
+class FaissKMeansResult:
+    """Kết quả phân cụm faiss với các thuộc tính giống MiniBatchKMeans (cluster_centers_, labels_, inertia_)."""
+
+    def __init__(self, cluster_centers, labels, inertia):
+        self.cluster_centers_ = cluster_centers
+        self.labels_ = labels
+        self.inertia_ = inertia
+
+
+class FaissParagraphClusterer(ParagraphClusterer):
+    """
+    ParagraphClusterer cho tài liệu rất lớn (hàng chục nghìn đoạn văn): K-Means cầu (spherical) của faiss,
+    chọn đoạn đại diện bằng tìm kiếm láng giềng gần tâm cụm và thống kê độ tương đồng trên mẫu,
+    nên mọi bước chỉ tốn O(n·k·d) thay vì ma trận n x n.
+    """
+
+    def __init__(self, model_embedding, embedding_cache=None, niter=FAISS_KMEANS_NITER, nredo=FAISS_KMEANS_NREDO,
+                 ann_min_items=FAISS_ANN_MIN_ITEMS, representative_candidates=FAISS_REPRESENTATIVE_CANDIDATES):
+        """
+        Args:
+            niter (int): Số vòng lặp K-Means của faiss.
+            nredo (int): Số lần chạy lại với khởi tạo khác (giữ kết quả tốt nhất).
+            ann_min_items (int): Số đoạn tối thiểu để dùng chỉ mục HNSW khi chọn đoạn đại diện.
+            representative_candidates (int): Số láng giềng gần tâm cụm được xét cho mỗi cụm.
+        """
+        super().__init__(model_embedding, embedding_cache)
+        self.niter = niter
+        self.nredo = nredo
+        self.ann_min_items = ann_min_items
+        self.representative_candidates = representative_candidates
+
+    def _faiss_embeddings(self):
+        return np.ascontiguousarray(self.normalized_embeddings, dtype=np.float32)
+
+    def _run_faiss_kmeans(self, num_clusters, init_centers=None, random_state=42, max_iter=None):
+        """Chạy spherical faiss.Kmeans, trả về FaissKMeansResult (inertia tính như sklearn: tổng bình phương tới tâm trung bình)."""
+        embeddings = self._faiss_embeddings()
+        kmeans = faiss.Kmeans(embeddings.shape[1], num_clusters, niter=max_iter or self.niter,
+                              nredo=1 if init_centers is not None else self.nredo,
+                              spherical=True, seed=random_state, verbose=False,
+                              min_points_per_centroid=1)
+        if init_centers is not None:
+            init_centers = np.ascontiguousarray(self._extend_centers(init_centers, num_clusters, random_state),
+                                                dtype=np.float32)
+            kmeans.train(embeddings, init_centroids=init_centers)
+        else:
+            kmeans.train(embeddings)
+        _, assignments = kmeans.index.search(embeddings, 1)
+        labels = assignments.ravel().astype(np.int64)
+
+        # WCSS = Σ||x||² - Σ_c ||Σx_c||² / n_c (cùng đại lượng với inertia_ của K-Means thường)
+        cluster_sums = np.zeros((num_clusters, embeddings.shape[1]), dtype=np.float64)
+        np.add.at(cluster_sums, labels, embeddings)
+        counts = np.bincount(labels, minlength=num_clusters)
+        non_empty = counts > 0
+        inertia = float(np.einsum('ij,ij->', embeddings, embeddings, dtype=np.float64)
+                        - np.sum(np.einsum('ij,ij->i', cluster_sums[non_empty], cluster_sums[non_empty]) / counts[non_empty]))
+        return FaissKMeansResult(kmeans.centroids.copy(), labels, max(0.0, inertia))
+
+    def perform_kmeans_clustering(self, num_clusters: int, random_state: int = 42, n_init='auto', max_iter: int = 300):
+        """Giống ParagraphClusterer.perform_kmeans_clustering nhưng dùng spherical faiss.Kmeans."""
+        if (self.normalized_embeddings is None or not self.paragraphs or num_clusters <= 0
+                or len(self.normalized_embeddings) < num_clusters):
+            return super().perform_kmeans_clustering(num_clusters, random_state, n_init, max_iter)
+
+        self.num_clusters = num_clusters
+        print(f"Đang chạy faiss K-Means (spherical) với {self.num_clusters} cụm...")
+        self.kmeans_model = self._run_faiss_kmeans(num_clusters, random_state=random_state)
+        self.cluster_labels = self.kmeans_model.labels_
+        print("Hoàn tất phân cụm K-Means.")
+        return True
+
+    def fit_kmeans_inertia(self, num_clusters: int, init_centers: np.ndarray = None, random_state: int = 42,
+                           n_init='auto', max_iter: int = 300):
+        """Giống ParagraphClusterer.fit_kmeans_inertia (dùng cho tìm k theo lưới log) với faiss."""
+        result = self._run_faiss_kmeans(num_clusters, init_centers=init_centers, random_state=random_state)
+        return result.inertia_, result.cluster_centers_
+
+    def find_optimal_clusters_elbow(self, k_range: range, random_state: int = 42, n_init='auto', max_iter: int = 300,
+                                    n_jobs: int = 1):
+        """Đường cong WCSS theo k bằng faiss (faiss tự chạy đa luồng nên bỏ qua n_jobs)."""
+        if self.normalized_embeddings is None:
+            print("Chưa có vector đoạn văn nào được nhúng. Vui lòng gọi `embed_paragraphs` trước.")
+            return []
+        k_values = [k for k in k_range if 0 < k <= len(self.normalized_embeddings)]
+        print(f"Đang chạy faiss K-Means để tìm k tối ưu qua phương pháp Elbow (kiểm tra {len(k_values)} giá trị k)...")
+        inertias = []
+        for k in k_values:
+            inertia, _ = self.fit_kmeans_inertia(k, random_state=random_state)
+            inertias.append(inertia)
+            print(f"  Đã tính WCSS cho k={k}: {inertia:.2f}")
+        return inertias
+
+    def _build_search_index(self, embeddings):
+        """Chỉ mục tích vô hướng: chính xác (IndexFlatIP) khi ít đoạn, HNSW khi rất nhiều đoạn."""
+        if len(embeddings) >= self.ann_min_items:
+            index = faiss.IndexHNSWFlat(embeddings.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efSearch = max(64, self.representative_candidates * 2)
+        else:
+            index = faiss.IndexFlatIP(embeddings.shape[1])
+        index.add(embeddings)
+        return index
+
+    def find_representatives(self):
+        """
+        Chọn đoạn đại diện cho mọi cụm cùng lúc: tìm các láng giềng gần tâm cụm nhất trong chỉ mục,
+        lấy láng giềng đầu tiên thuộc đúng cụm đó. Cụm nào không có ứng viên trong top láng giềng
+        thì tìm chính xác trong các đoạn của cụm.
+
+        Returns:
+            np.ndarray: Chỉ số đoạn đại diện của từng cụm.
+        """
+        embeddings = self._faiss_embeddings()
+        centers = np.ascontiguousarray(self.kmeans_model.cluster_centers_, dtype=np.float32)
+        centers = centers / np.maximum(np.linalg.norm(centers, axis=1, keepdims=True), 1e-12)
+        index = self._build_search_index(embeddings)
+        _, neighbors = index.search(centers, min(self.representative_candidates, len(embeddings)))
+
+        representatives = np.full(self.num_clusters, -1, dtype=np.int64)
+        for cluster_id in range(self.num_clusters):
+            for candidate in neighbors[cluster_id]:
+                if candidate >= 0 and self.cluster_labels[candidate] == cluster_id:
+                    representatives[cluster_id] = candidate
+                    break
+            if representatives[cluster_id] < 0:
+                members = np.where(self.cluster_labels == cluster_id)[0]
+                if members.size:
+                    representatives[cluster_id] = members[np.argmax(embeddings[members] @ centers[cluster_id])]
+        return representatives
+
+    def get_cluster_info(self):
+        """Giống ParagraphClusterer.get_cluster_info, đoạn đại diện chọn bằng `find_representatives`."""
+        if self.cluster_labels is None or not self.paragraphs or self.kmeans_model is None:
+            print("Chưa có thông tin cụm. Vui lòng chạy `embed_paragraphs` và `perform_kmeans_clustering` trước.")
+            return []
+
+        order = np.argsort(self.cluster_labels, kind='stable')
+        boundaries = np.searchsorted(self.cluster_labels[order], np.arange(self.num_clusters + 1))
+        representatives = self.find_representatives()
+
+        results = []
+        for cluster_id in range(self.num_clusters):
+            paragraph_indices_in_cluster = order[boundaries[cluster_id]:boundaries[cluster_id + 1]].tolist()
+            if not paragraph_indices_in_cluster:
+                # faiss có thể để trống cụm; bỏ qua để không tạo nút rỗng trong cây
+                continue
+            representative_paragraph_index = int(representatives[cluster_id])
+            results.append({
+                "ID_of_cluster": len(results),
+                "index_from_list_paragraph": paragraph_indices_in_cluster,
+                "represent": self.paragraphs[representative_paragraph_index],
+                "represent_index": representative_paragraph_index,
+                "keyword": self.keywords[representative_paragraph_index]
+            })
+        return results
+
+    def _farthest_similarities(self, queries: np.ndarray, chunk_size: int = 1024) -> np.ndarray:
+        """
+        Giống ParagraphClusterer._farthest_similarities nhưng tìm bằng faiss: đoạn ít tương đồng nhất
+        với x là láng giềng gần nhất của -x theo tích vô hướng.
+        """
+        embeddings = self._faiss_embeddings()
+        index = faiss.IndexFlatIP(embeddings.shape[1])
+        index.add(embeddings)
+        scores, neighbors = index.search(np.ascontiguousarray(-embeddings[queries]), 2)
+        # Láng giềng đầu chỉ là chính đoạn đó khi mọi đoạn trùng nhau, khi đó lấy láng giềng thứ hai
+        use_second = neighbors[:, 0] == queries
+        return -np.where(use_second, scores[:, 1], scores[:, 0]).astype(np.float64)
+
+
+def create_paragraph_clusterer(model_embedding, engine=CLUSTERING_ENGINE, embedding_cache=None):
+    """Tạo clusterer theo engine: 'faiss' (FaissParagraphClusterer) hoặc 'sklearn' (ParagraphClusterer)."""
+    if engine == 'faiss':
+        return FaissParagraphClusterer(model_embedding, embedding_cache)
+    return ParagraphClusterer(model_embedding, embedding_cache)
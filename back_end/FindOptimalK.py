@@ -1,7 +1,17 @@
+import os
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.spatial.distance import cdist
 
+# --- Cấu hình tìm k ---
+# 'hierarchy': đọc WCSS mọi k từ một cây phân cấp; 'kmeans': chạy MiniBatchKMeans cho từng k;
+# 'log': K-Means trên lưới thưa theo thang log rồi tinh chỉnh quanh điểm knee
+K_SEARCH_METHOD = os.getenv('K_SEARCH_METHOD', 'hierarchy')
+# Kiểu liên kết của cây phân cấp: 'ward' hoặc 'average' (cosine)
+K_SEARCH_LINKAGE = os.getenv('K_SEARCH_LINKAGE', 'ward')
+# Số điểm của lưới thô khi k_search='log'
+K_SEARCH_COARSE_POINTS = int(os.getenv('K_SEARCH_COARSE_POINTS', '8'))
+
 def find_optimal_k_elbow(k_range, inertias, method='knee', plot=True):
     """
     Tìm k tối ưu từ kết quả elbow method
@@ -207,6 +217,105 @@ def auto_select_optimal_k(k_range, inertias, show_comparison=True):
 
     return most_common_k
 
+def find_optimal_k_log_search(clusterer, k_range, coarse_points=K_SEARCH_COARSE_POINTS, max_fits=None,
+                              stop_ratio=1e-3, warm_start_ratio=0.75):
+    """
+    Tìm WCSS theo k với ít lần fit K-Means: chạy trên lưới thô theo thang log, sau đó chia đôi
+    khoảng quanh điểm knee (`_find_knee_point`) cho đến khi hai điểm kề knee cách nó 1 đơn vị.
+    Các lần fit tinh chỉnh khởi tạo ấm từ tâm cụm của lần fit có k gần nhất (ưu tiên k lớn hơn).
+
+    Parameters:
+    -----------
+    clusterer : ParagraphClusterer
+        Đã gọi `embed_paragraphs`
+    k_range : range
+        Phạm vi k cần tìm (như `get_safe_k_range`)
+    coarse_points : int
+        Số điểm của lưới thô
+    max_fits : int
+        Giới hạn tổng số lần fit (mặc định không giới hạn ngoài kích thước k_range)
+    stop_ratio : float
+        Dừng lưới thô sớm khi WCSS <= stop_ratio * WCSS(k nhỏ nhất) (các k lớn hơn gần như bằng 0)
+    warm_start_ratio : float
+        Chỉ khởi tạo ấm từ lần fit có k trong [warm_start_ratio * k, k / warm_start_ratio]
+
+    Returns:
+    --------
+    k_values, inertias : list, list
+        Các k đã fit (tăng dần) và WCSS tương ứng. Khoảng cách giữa các k không đều: 'knee' và
+        'elbow_distance' dùng trực tiếp được, còn 'derivative' (giả định bước k = 1) thì không, nên cần
+        `interpolate_wcss_curve` trước khi đưa vào `auto_select_optimal_k`
+    """
+    n_samples = len(clusterer.normalized_embeddings)
+    all_k = [k for k in k_range if 0 < k <= n_samples]
+    if not all_k:
+        return [], []
+    max_fits = max_fits or len(all_k)
+
+    results = {}
+
+    def fit(k):
+        # Khởi tạo ấm từ lần fit gần nhất có k lớn hơn (gộp tâm), không có thì từ k nhỏ hơn đủ gần.
+        # Tâm của một k nhỏ hơn nhiều thường nằm giữa các cụm thật và kéo K-Means vào cực tiểu
+        # địa phương kém hơn khởi tạo k-means++, nên khi đó fit lạnh.
+        larger = [known_k for known_k in results if k < known_k <= k / warm_start_ratio]
+        smaller = [known_k for known_k in results if warm_start_ratio * k <= known_k < k]
+        source_k = min(larger) if larger else (max(smaller) if smaller else None)
+        init_centers = results[source_k][1] if source_k is not None else None
+        inertia, centers = clusterer.fit_kmeans_inertia(k, init_centers=init_centers)
+        results[k] = (inertia, centers)
+        print(f"  Đã tính WCSS cho k={k}: {inertia:.2f}")
+
+    # 1) Lưới thô theo thang log (luôn có hai đầu mút)
+    coarse_grid = sorted(set(int(round(k)) for k in np.geomspace(all_k[0], all_k[-1], num=max(2, coarse_points))))
+    coarse_grid = [k for k in coarse_grid if k in set(all_k)] or [all_k[0], all_k[-1]]
+    print(f"Tìm k trên lưới log {coarse_grid} rồi tinh chỉnh quanh điểm knee...")
+    for k in coarse_grid:
+        fit(k)
+        if results[k][0] <= stop_ratio * results[coarse_grid[0]][0] and k != coarse_grid[0]:
+            print(f"  WCSS gần bằng 0 từ k={k}, bỏ qua các k lớn hơn trên lưới thô")
+            break
+
+    # 2) Chia đôi khoảng rộng hơn quanh điểm knee hiện tại đến khi hai điểm kề cách knee 1 đơn vị
+    while len(results) < max_fits:
+        k_values = sorted(results)
+        if len(k_values) < 3:
+            break
+        knee = _find_knee_point(k_values, [results[k][0] for k in k_values])
+        position = k_values.index(knee)
+        gaps = []
+        if position > 0:
+            gaps.append((knee - k_values[position - 1], k_values[position - 1], knee))
+        if position < len(k_values) - 1:
+            gaps.append((k_values[position + 1] - knee, knee, k_values[position + 1]))
+        width, low, high = max(gaps)
+        if width <= 1:
+            break
+        fit((low + high) // 2)
+
+    k_values = sorted(results)
+    saved = len(all_k) - len(k_values)
+    print(f"  → Đã fit {len(k_values)}/{len(all_k)} giá trị k, tiết kiệm {saved} lần fit "
+          f"({saved / len(all_k):.0%}) so với duyệt toàn bộ")
+    return k_values, [results[k][0] for k in k_values]
+
+def interpolate_wcss_curve(k_values, inertias):
+    """
+    Nội suy tuyến tính đường WCSS của các k đã fit (lưới thưa, khoảng cách không đều) lên mọi k nguyên
+    trong [k nhỏ nhất, k lớn nhất], để dùng được cho cả ba phương pháp của `auto_select_optimal_k`.
+
+    Trên lưới thưa, 'knee' và 'elbow_distance' (khoảng cách tới dây cung) vẫn đúng, nhưng 'derivative'
+    dùng np.diff với giả định các k cách nhau 1 đơn vị. Trên đường nội suy, sai phân bậc hai tại mỗi
+    điểm đã fit bằng độ thay đổi độ dốc trên một đơn vị k. Knee/elbow_distance không đổi vì khoảng cách
+    tới dây cung của đường gấp khúc lớn nhất tại một điểm đã fit.
+
+    Returns:
+    --------
+    uniform_k, uniform_inertias : list, list
+    """
+    uniform_k = list(range(k_values[0], k_values[-1] + 1))
+    return uniform_k, np.interp(uniform_k, k_values, inertias).tolist()
+
 def get_safe_k_range(n_samples, min_k=2, max_k=None):
     """
     Tạo k_range an toàn dựa trên số lượng samples, từ 2 -> n_samples-2
@@ -239,6 +348,19 @@ def get_safe_k_range(n_samples, min_k=2, max_k=None):
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
 
+def _similarity_statistics(embeddings, clusterer=None, with_min=True):
+    """
+    Độ tương đồng cosine trung bình và nhỏ nhất (None nếu with_min=False) giữa các cặp đoạn văn.
+    Clusterer nào có `cohesion_statistics` (ParagraphClusterer) thì dùng của nó (không dựng ma trận n x n),
+    không thì tính trên toàn bộ ma trận tương đồng.
+    """
+    if clusterer is not None and hasattr(clusterer, 'cohesion_statistics'):
+        return clusterer.cohesion_statistics(with_min=with_min)
+    similarity_matrix = cosine_similarity(embeddings)
+    # Lấy tam giác trên (không tính đường chéo)
+    upper_triangle = similarity_matrix[np.triu_indices_from(similarity_matrix, k=1)]
+    return np.mean(upper_triangle), (np.min(upper_triangle) if with_min else None)
+
 def should_merge_to_single_cluster(list_paragraphs, embeddings=None, clusterer=None, strategy='adaptive'):
     """
     Quyết định có nên gom tất cả về 1 cụm cuối cùng hay không
@@ -272,10 +394,7 @@ def should_merge_to_single_cluster(list_paragraphs, embeddings=None, clusterer=N
         # Chiến lược độ tương đồng: Nếu các đoạn văn đủ tương đồng thì gom
         if embeddings is not None and n_paragraphs > 1:
             # Tính độ tương đồng trung bình giữa tất cả các cặp
-            similarity_matrix = cosine_similarity(embeddings)
-            # Lấy tam giác trên (không tính đường chéo)
-            upper_triangle = similarity_matrix[np.triu_indices_from(similarity_matrix, k=1)]
-            avg_similarity = np.mean(upper_triangle)
+            avg_similarity, _ = _similarity_statistics(embeddings, clusterer, with_min=False)
 
             print(f"  → Độ tương đồng trung bình: {avg_similarity:.4f}")
 
@@ -297,10 +416,7 @@ def should_merge_to_single_cluster(list_paragraphs, embeddings=None, clusterer=N
 
         # Yếu tố 2: Độ tương đồng cao
         if embeddings is not None and n_paragraphs > 2:
-            similarity_matrix = cosine_similarity(embeddings)
-            upper_triangle = similarity_matrix[np.triu_indices_from(similarity_matrix, k=1)]
-            avg_similarity = np.mean(upper_triangle)
-            min_similarity = np.min(upper_triangle)
+            avg_similarity, min_similarity = _similarity_statistics(embeddings, clusterer)
 
             print(f"  → Độ tương đồng TB: {avg_similarity:.4f}, Min: {min_similarity:.4f}")
 
@@ -325,9 +441,15 @@ def should_merge_to_single_cluster(list_paragraphs, embeddings=None, clusterer=N
         # Mặc định: chỉ gom khi còn 2 đoạn
         return n_paragraphs <= 2
 
-def get_optimal_k_with_final_merge_logic(list_paragraphs, clusterer, strategy='adaptive'):
+def get_optimal_k_with_final_merge_logic(list_paragraphs, clusterer, strategy='adaptive',
+                                         k_search=K_SEARCH_METHOD, linkage_method=K_SEARCH_LINKAGE):
     """
     Lấy số cụm tối ưu với logic gom cụm cuối thông minh
+
+    Args:
+        k_search: 'hierarchy' (WCSS của mọi k từ một cây phân cấp), 'log' (K-Means trên lưới log và tinh
+                  chỉnh quanh knee) hoặc 'kmeans' (chạy K-Means cho từng k)
+        linkage_method: kiểu liên kết khi k_search='hierarchy' ('ward' hoặc 'average')
     """
     n_paragraphs = len(list_paragraphs)
 
@@ -336,7 +458,7 @@ def get_optimal_k_with_final_merge_logic(list_paragraphs, clusterer, strategy='a
     # Kiểm tra xem có nên gom về 1 cụm không
     should_merge = should_merge_to_single_cluster(
         list_paragraphs,
-        clusterer.embeddings if hasattr(clusterer, 'embeddings') else None,
+        clusterer.normalized_embeddings,
         clusterer,
         strategy
     )
@@ -350,7 +472,15 @@ def get_optimal_k_with_final_merge_logic(list_paragraphs, clusterer, strategy='a
 
     # Đảm bảo k không quá lớn so với số đoạn văn
     k_test_range = get_safe_k_range(len(list_paragraphs), min_k=1, max_k=None)
-    inertias = clusterer.find_optimal_clusters_elbow(k_test_range)
+    if k_search == 'hierarchy':
+        inertias = clusterer.find_optimal_clusters_hierarchy(k_test_range, method=linkage_method)
+    elif k_search == 'log':
+        k_values, inertias = find_optimal_k_log_search(clusterer, k_test_range)
+        # Lưới thưa không đều: nội suy lên lưới k đều trước khi bỏ phiếu (phương pháp 'derivative' cần bước 1)
+        if k_values:
+            k_test_range, inertias = interpolate_wcss_curve(k_values, inertias)
+    else:
+        inertias = clusterer.find_optimal_clusters_elbow(k_test_range)
 
     if inertias:
         optimal_k = auto_select_optimal_k(k_test_range, inertias, show_comparison=True)
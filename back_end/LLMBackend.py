@@ -0,0 +1,335 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+# --- Cấu hình backend LLM ---
+# 'openai': gọi OpenAI API, 'fake': backend giả lập tất định, không cần mạng (dùng để đo hiệu năng)
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'openai')
+LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-4o-mini')
+FAKE_LLM_LATENCY_MS = float(os.getenv('FAKE_LLM_LATENCY_MS', '0'))
+FAKE_LLM_LATENCY_JITTER_MS = float(os.getenv('FAKE_LLM_LATENCY_JITTER_MS', '0'))
+FAKE_LLM_ERROR_RATE = float(os.getenv('FAKE_LLM_ERROR_RATE', '0'))
+FAKE_LLM_SEED = int(os.getenv('FAKE_LLM_SEED', '0'))
+
+# Từ dừng tiếng Việt thường gặp, bỏ qua khi chọn từ khóa giả lập
+_STOPWORDS = {
+    'và', 'của', 'là', 'các', 'những', 'được', 'trong', 'với', 'cho', 'đã', 'có', 'không', 'này', 'đó',
+    'một', 'để', 'khi', 'thì', 'từ', 'ra', 'vào', 'trên', 'dưới', 'về', 'như', 'nhưng', 'còn', 'cũng',
+    'sau', 'trước', 'đến', 'lại', 'nên', 'vì', 'do', 'bị', 'theo', 'tại', 'gì', 'nào', 'ta', 'the', 'of', 'and'
+}
+
+
+class LLMCompletion:
+    """Kết quả của một lời gọi LLM: nội dung và số token đã dùng (nếu backend biết)."""
+
+    def __init__(self, content, total_tokens=None):
+        self.content = content
+        self.total_tokens = total_tokens
+
+
+class LLMBackend:
+    """
+    Giao diện chung cho các backend LLM: gọi đồng bộ, streaming, bất đồng bộ và theo lô.
+    `purpose` là tên hàm gọi LLM (summary_paragraph, generate_response, ...),
+    backend thật bỏ qua, backend giả lập dùng để chọn kiểu phản hồi.
+    `name` định danh backend, là một phần của key cache LLM.
+    """
+
+    name = 'base'
+
+    def complete(self, messages, model=LLM_MODEL, temperature=0, purpose=None, **request_options):
+        """Gọi LLM và trả về LLMCompletion."""
+        raise NotImplementedError
+
+    def stream(self, messages, model=LLM_MODEL, temperature=0, purpose=None, **request_options):
+        """Gọi LLM và trả về iterator các đoạn nội dung (str) theo thứ tự sinh."""
+        raise NotImplementedError
+
+    async def acomplete(self, messages, model=LLM_MODEL, temperature=0, purpose=None, **request_options):
+        """Phiên bản bất đồng bộ của `complete`. Mặc định chạy `complete` trong thread pool."""
+        return await asyncio.to_thread(self.complete, messages, model, temperature, purpose, **request_options)
+
+    def batch(self, requests, max_concurrency=8):
+        """
+        Gọi nhiều request song song, tối đa `max_concurrency` request cùng lúc.
+
+        Args:
+            requests (list): Mỗi phần tử là dict tham số của `complete` (messages, model, temperature, purpose, ...).
+            max_concurrency (int): Số request đồng thời tối đa.
+
+        Returns:
+            list: LLMCompletion theo đúng thứ tự đầu vào.
+        """
+        async def run_all():
+            semaphore = asyncio.Semaphore(max(1, max_concurrency))
+            async with self.async_session() as backend:
+                async def run_one(request):
+                    async with semaphore:
+                        return await backend.acomplete(**request)
+                return await asyncio.gather(*(run_one(request) for request in requests))
+
+        return asyncio.run(run_all())
+
+    def async_session(self):
+        """
+        Backend dùng trong một event loop (`async with backend.async_session() as b`).
+        Mặc định là chính backend này.
+        """
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+class OpenAIBackend(LLMBackend):
+    """Backend gọi OpenAI API (hoặc API tương thích) qua client của thư viện openai."""
+
+    name = 'openai'
+
+    def __init__(self, client, async_client=None):
+        """
+        Args:
+            client: OpenAI client (đồng bộ), hoặc AsyncOpenAI nếu chỉ dùng bất đồng bộ.
+            async_client: AsyncOpenAI client dùng cho `acomplete` (nếu không có sẽ dùng `client`).
+        """
+        self.client = client
+        self.async_client = async_client
+
+    @staticmethod
+    def _to_completion(response):
+        usage = getattr(response, 'usage', None)
+        return LLMCompletion(response.choices[0].message.content, getattr(usage, 'total_tokens', None))
+
+    def complete(self, messages, model=LLM_MODEL, temperature=0, purpose=None, **request_options):
+        response = self.client.chat.completions.create(
+            model=model,
+            temperature=temperature,
+            messages=messages,
+            **request_options
+        )
+        return self._to_completion(response)
+
+    def stream(self, messages, model=LLM_MODEL, temperature=0, purpose=None, **request_options):
+        response = self.client.chat.completions.create(
+            model=model,
+            temperature=temperature,
+            messages=messages,
+            stream=True,
+            **request_options
+        )
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def acomplete(self, messages, model=LLM_MODEL, temperature=0, purpose=None, **request_options):
+        client = self.async_client if self.async_client is not None else self.client
+        response = await client.chat.completions.create(
+            model=model,
+            temperature=temperature,
+            messages=messages,
+            **request_options
+        )
+        return self._to_completion(response)
+
+    def async_session(self):
+        """
+        Tạo backend với AsyncOpenAI client cùng cấu hình (api_key, base_url, organization).
+        Mỗi event loop dùng một client riêng để không dùng lại kết nối của loop đã đóng.
+        """
+        if self.async_client is not None:
+            return self
+        from openai import AsyncOpenAI
+        return OpenAIBackend(self.client, AsyncOpenAI(api_key=self.client.api_key,
+                                                      base_url=self.client.base_url,
+                                                      organization=self.client.organization))
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.async_client is not None and hasattr(self.async_client, 'close'):
+            await self.async_client.close()
+        return False
+
+
+class FakeLLMError(Exception):
+    """Lỗi giả lập của FakeLLMBackend (mang status_code để bộ điều phối xử lý như lỗi thật)."""
+
+    def __init__(self, status_code):
+        super().__init__(f"Lỗi LLM giả lập (HTTP {status_code})")
+        self.status_code = status_code
+
+
+def _words(text):
+    return re.findall(r'\w+', text.lower())
+
+
+def _fake_summary(text, max_words=40):
+    """Tóm tắt giả lập: câu đầu tiên của đoạn văn, cắt tối đa `max_words` từ."""
+    first_sentence = re.split(r'(?<=[.!?])\s+', text.strip(), maxsplit=1)[0]
+    words = first_sentence.split()
+    return ' '.join(words[:max_words])
+
+
+def _fake_keyword(text, n_words=2):
+    """Từ khóa giả lập: các từ (không phải từ dừng) xuất hiện nhiều nhất, hòa thì theo thứ tự xuất hiện."""
+    words = [w for w in _words(text) if w not in _STOPWORDS and not w.isdigit() and len(w) > 1]
+    if not words:
+        return 'Không rõ'
+    counts = Counter(words)
+    first_seen = {}
+    for i, w in enumerate(words):
+        first_seen.setdefault(w, i)
+    top = sorted(counts, key=lambda w: (-counts[w], first_seen[w]))[:n_words]
+    return ' '.join(top).capitalize()
+
+
+def _user_content(messages, prefix=None):
+    """Lấy nội dung message user (đầu tiên, hoặc message bắt đầu bằng `prefix`)."""
+    for m in messages:
+        if m['role'] != 'user':
+            continue
+        if prefix is None:
+            return m['content']
+        if m['content'].startswith(prefix):
+            return m['content'][len(prefix):]
+    return ''
+
+
+class FakeLLMBackend(LLMBackend):
+    """
+    Backend giả lập tất định, không gọi mạng: cùng đầu vào luôn cho cùng đầu ra.
+    Sinh tóm tắt, từ khóa, JSON thực thể và câu trả lời theo `purpose`,
+    có thể giả lập độ trễ và tỉ lệ lỗi (429/500) để đo thông lượng và kiểm tra cơ chế thử lại.
+    """
+
+    name = 'fake'
+
+    def __init__(self, latency_ms=FAKE_LLM_LATENCY_MS, latency_jitter_ms=FAKE_LLM_LATENCY_JITTER_MS,
+                 error_rate=FAKE_LLM_ERROR_RATE, seed=FAKE_LLM_SEED):
+        """
+        Args:
+            latency_ms (float): Độ trễ cố định mỗi request (mili giây).
+            latency_jitter_ms (float): Độ trễ ngẫu nhiên thêm vào, trong khoảng [0, latency_jitter_ms].
+            error_rate (float): Xác suất một request bị lỗi (0..1).
+            seed (int): Seed cho bộ sinh ngẫu nhiên của độ trễ và lỗi.
+        """
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = Counter()
+
+    def _draw(self, purpose):
+        """Ghi nhận lời gọi, chọn độ trễ và quyết định có giả lập lỗi hay không."""
+        with self._lock:
+            self.calls[purpose or 'unknown'] += 1
+            delay = (self.latency_ms + self._random.uniform(0, self.latency_jitter_ms)) / 1000.0
+            error = self._random.random() < self.error_rate
+            status_code = self._random.choice([429, 500, 503]) if error else None
+        return delay, status_code
+
+    def _respond(self, messages, purpose):
+        """Sinh nội dung phản hồi tất định theo `purpose`."""
+        paragraph = _user_content(messages)
+
+        if purpose == 'summary_paragraph':
+            return _fake_summary(paragraph)
+        if purpose == 'extract_key_word':
+            return _fake_keyword(paragraph)
+        if purpose == 'summarize_and_extract_keyword':
+            return json.dumps({'summary': _fake_summary(paragraph), 'keyword': _fake_keyword(paragraph)},
+                              ensure_ascii=False)
+        if purpose == 'summarize_and_extract_keyword_packed':
+            items = re.split(r'(?:^|\n\n)\[(\d+)\] ', paragraph)[1:]
+            return json.dumps({'items': [
+                {'id': int(item_id), 'summary': _fake_summary(text), 'keyword': _fake_keyword(text)}
+                for item_id, text in zip(items[0::2], items[1::2])
+            ]}, ensure_ascii=False)
+        if purpose == 'find_entities_from_question_PP1':
+            return self._fake_entities(messages)
+        if purpose == 'generate_response':
+            system_prompt = ''.join(m['content'] for m in messages if m['role'] == 'system')
+            information = system_prompt.split('THÔNG TIN:', 1)[-1].split('LỊCH SỬ CUỘC TRÒ CHUYỆN:', 1)[0].strip()
+            if not information or information == '[]':
+                return 'Tôi không biết, tôi chưa có kiến thức để trả lời câu hỏi này.'
+            return f"Dựa trên thông tin được cung cấp: {_fake_summary(information, max_words=60)}"
+
+        digest = hashlib.sha256(json.dumps(messages, ensure_ascii=False).encode('utf-8')).hexdigest()[:12]
+        return f"[fake:{purpose}:{digest}]"
+
+    @staticmethod
+    def _fake_entities(messages, top_k=3):
+        """Chọn các thực thể có nhiều từ trùng với câu hỏi nhất (tên thực thể + chú thích)."""
+        question_words = set(_words(_user_content(messages, 'CÂU HỎI:\n'))) - _STOPWORDS
+        try:
+            explication = json.loads(_user_content(messages, 'TÊN THỰC THỂ VÀ THÔNG TIN CHÚ THÍCH:\n') or '{}')
+        except ValueError:
+            explication = {}
+
+        scores = []
+        for entity, text in explication.items():
+            entity_words = set(_words(entity.replace('_', ' ')))
+            score = 2 * len(question_words & entity_words) + len(question_words & set(_words(str(text))))
+            if score > 0:
+                scores.append((-score, entity))
+        entities = [entity for _, entity in sorted(scores)[:top_k]]
+        return json.dumps({'Thực_thể': entities} if entities else {'Trong': []}, ensure_ascii=False)
+
+    def _completion(self, messages, purpose):
+        content = self._respond(messages, purpose)
+        prompt_chars = sum(len(m.get('content') or '') for m in messages)
+        return LLMCompletion(content, total_tokens=(prompt_chars + len(content)) // 3 + 1)
+
+    def complete(self, messages, model=LLM_MODEL, temperature=0, purpose=None, **request_options):
+        delay, status_code = self._draw(purpose)
+        if delay > 0:
+            time.sleep(delay)
+        if status_code is not None:
+            raise FakeLLMError(status_code)
+        return self._completion(messages, purpose)
+
+    def stream(self, messages, model=LLM_MODEL, temperature=0, purpose=None, **request_options):
+        content = self.complete(messages, model, temperature, purpose, **request_options).content
+        for token in re.findall(r'\S+\s*', content):
+            yield token
+
+    async def acomplete(self, messages, model=LLM_MODEL, temperature=0, purpose=None, **request_options):
+        delay, status_code = self._draw(purpose)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if status_code is not None:
+            raise FakeLLMError(status_code)
+        return self._completion(messages, purpose)
+
+
+def as_backend(client):
+    """Trả về LLMBackend cho `client` (giữ nguyên nếu đã là backend, bọc OpenAI/AsyncOpenAI client)."""
+    if isinstance(client, LLMBackend):
+        return client
+    return OpenAIBackend(client)
+
+
+def create_llm_backend(api_key=None, backend=LLM_BACKEND):
+    """
+    Tạo backend LLM theo cấu hình.
+
+    Args:
+        api_key (str, optional): OpenAI API key (cho backend 'openai').
+        backend (str): 'openai' hoặc 'fake'.
+
+    Returns:
+        LLMBackend
+    """
+    if backend == 'fake':
+        print(f"Dùng backend LLM giả lập (độ trễ {FAKE_LLM_LATENCY_MS}ms, tỉ lệ lỗi {FAKE_LLM_ERROR_RATE})")
+        return FakeLLMBackend()
+    from openai import OpenAI
+    return OpenAIBackend(OpenAI(api_key=api_key))
@@ -0,0 +1,285 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from LLMBackend import LLM_MODEL, as_backend
+from LLMScheduler import get_llm_scheduler
+
+# --- Cấu hình cache phản hồi LLM ---
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', '1') == '1'
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', 'llm_cache.sqlite3')
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '200000'))
+
+# Thời gian sống (giây) của kết quả theo từng hàm, None = không hết hạn.
+# Tóm tắt/từ khóa chỉ phụ thuộc vào nội dung đoạn văn nên giữ vô thời hạn;
+# kết quả chat phụ thuộc lịch sử hội thoại nên chỉ giữ ngắn hạn.
+DEFAULT_LLM_CACHE_TTLS = {
+    'summary_paragraph': None,
+    'extract_key_word': None,
+    'summarize_and_extract_keyword': None,
+    'summarize_and_extract_keyword_packed': None,
+    'find_entities_from_question_PP1': 7 * 24 * 3600,
+    'generate_response': 24 * 3600,
+}
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Cache trên đĩa (SQLite) cho các lời gọi LLM tất định (temperature=0).
+    Key gồm model, hash của system prompt và hash của phần input còn lại,
+    nên nội dung giống nhau sẽ không phải trả phí gọi lại LLM.
+    Hỗ trợ TTL theo từng hàm, giới hạn số lượng mục (loại bỏ mục ít dùng gần đây nhất)
+    và bộ đếm hit/miss.
+    """
+
+    def __init__(self, path=LLM_CACHE_PATH, max_entries=LLM_CACHE_MAX_ENTRIES, ttls=None):
+        """
+        Args:
+            path (str): Đường dẫn file SQLite.
+            max_entries (int): Số mục tối đa trong cache.
+            ttls (dict, optional): TTL (giây) theo tên hàm, ghi đè DEFAULT_LLM_CACHE_TTLS.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttls = dict(DEFAULT_LLM_CACHE_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+
+        # Một kết nối dùng chung cho các thread của process, WAL cho phép nhiều process cùng đọc/ghi
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    function TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            ''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache(last_access)')
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(model, messages, **request_options):
+        """
+        Tạo key cho một request: hash(model, hash(system prompt), hash(các message còn lại + tùy chọn request)).
+        """
+        system_prompt = ''.join(m['content'] for m in messages if m['role'] == 'system')
+        inputs = [m for m in messages if m['role'] != 'system']
+        input_hash = _sha256(json.dumps([inputs, request_options], ensure_ascii=False, sort_keys=True))
+        return _sha256('\0'.join([model, _sha256(system_prompt), input_hash]))
+
+    def get(self, function_name, model, messages, **request_options):
+        """
+        Lấy phản hồi đã cache.
+        Returns:
+            str hoặc None: Nội dung phản hồi, None nếu không có hoặc đã hết hạn.
+        """
+        key = self.make_key(model, messages, **request_options)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT response, created FROM llm_cache WHERE key = ?', (key,)).fetchone()
+            ttl = self.ttls.get(function_name)
+            if row is not None and ttl is not None and now - row[1] > ttl:
+                self._conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses[function_name] = self.misses.get(function_name, 0) + 1
+                return None
+            self._conn.execute('UPDATE llm_cache SET last_access = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+            self.hits[function_name] = self.hits.get(function_name, 0) + 1
+        return row[0]
+
+    def set(self, function_name, model, messages, response, **request_options):
+        """Lưu phản hồi vào cache và loại bỏ bớt mục cũ nếu vượt giới hạn."""
+        key = self.make_key(model, messages, **request_options)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO llm_cache (key, function, model, response, created, last_access) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, function_name, model, response, now, now)
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Xóa các mục ít được truy cập gần đây nhất khi số mục vượt `max_entries` (xóa thêm 10% để tránh xóa liên tục)."""
+        count = self._conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+        if count <= self.max_entries:
+            return
+        n_delete = count - self.max_entries + max(1, self.max_entries // 10)
+        self._conn.execute(
+            'DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)',
+            (n_delete,)
+        )
+
+    def stats(self):
+        """Thống kê hit/miss theo từng hàm và số mục hiện có."""
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+        return {
+            'entries': entries,
+            'hits': dict(self.hits),
+            'misses': dict(self.misses)
+        }
+
+
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """Lấy cache LLM dùng chung của process (tạo lần đầu khi cần). Trả về None nếu cache bị tắt."""
+    global _llm_cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = LLMResponseCache()
+        return _llm_cache
+
+
+def set_llm_cache(cache):
+    """Đặt cache LLM dùng chung (truyền None để tắt cache)."""
+    global _llm_cache, LLM_CACHE_ENABLED
+    _llm_cache = cache
+    LLM_CACHE_ENABLED = cache is not None
+
+
+def cache_model_key(backend, model):
+    """
+    Phần "model" của key cache: phản hồi của backend khác OpenAI (ví dụ backend giả lập) được lưu
+    dưới tên riêng '<backend>:<model>' để không bao giờ trả cho request tới model thật.
+    """
+    return model if backend.name == 'openai' else f"{backend.name}:{model}"
+
+
+def _is_valid(validator, content):
+    """Kiểm tra phản hồi bằng `validator` (nếu có). Validator có thể trả về False hoặc raise ValueError."""
+    if validator is None:
+        return True
+    try:
+        return validator(content) is not False
+    except ValueError:
+        return False
+
+
+def cached_chat_completion(client, function_name, messages, model=LLM_MODEL, temperature=0, validator=None,
+                           **request_options):
+    """
+    Gọi LLM qua cache. Chỉ cache khi temperature=0 (kết quả tất định).
+    Request thật sự gửi đi được điều phối bởi LLMScheduler (giới hạn tốc độ, ưu tiên, thử lại).
+
+    Args:
+        client: LLMBackend hoặc OpenAI client.
+        function_name (str): Tên hàm gọi LLM, dùng cho TTL và thống kê.
+        messages (list): Danh sách message.
+        model (str): Tên model.
+        temperature (float): Nhiệt độ sinh.
+        validator (callable, optional): Hàm kiểm tra phản hồi, chỉ phản hồi hợp lệ mới được lưu/đọc từ cache.
+        **request_options: Tham số khác truyền cho API (ví dụ response_format), cũng là một phần của key.
+
+    Returns:
+        str: Nội dung phản hồi của LLM.
+    """
+    backend = as_backend(client)
+    cache = get_llm_cache() if temperature == 0 else None
+    cache_model = cache_model_key(backend, model)
+    if cache is not None:
+        cached = cache.get(function_name, cache_model, messages, **request_options)
+        if cached is not None and _is_valid(validator, cached):
+            return cached
+
+    def request():
+        return backend.complete(messages, model=model, temperature=temperature, purpose=function_name,
+                                **request_options)
+
+    # Đi qua bộ điều phối (giới hạn RPM/TPM, ưu tiên chat, thử lại khi 429/5xx) nếu được bật
+    scheduler = get_llm_scheduler()
+    if scheduler is not None:
+        response = scheduler.call(request, messages, function_name, request_options.get('max_tokens'))
+    else:
+        response = request()
+    content = response.content
+
+    if cache is not None and content is not None and _is_valid(validator, content):
+        cache.set(function_name, cache_model, messages, content, **request_options)
+    return content
+
+
+def cached_chat_completion_stream(client, function_name, messages, model=LLM_MODEL, temperature=0,
+                                  **request_options):
+    """
+    Phiên bản streaming của `cached_chat_completion`: trả về từng đoạn nội dung ngay khi LLM sinh ra.
+    Nếu đã có trong cache thì trả toàn bộ phản hồi trong một đoạn; phản hồi đầy đủ được lưu cache
+    sau khi stream kết thúc.
+
+    Yields:
+        str: Các đoạn nội dung phản hồi.
+    """
+    backend = as_backend(client)
+    cache = get_llm_cache() if temperature == 0 else None
+    cache_model = cache_model_key(backend, model)
+    if cache is not None:
+        cached = cache.get(function_name, cache_model, messages, **request_options)
+        if cached is not None:
+            yield cached
+            return
+
+    def request():
+        return backend.stream(messages, model=model, temperature=temperature, purpose=function_name,
+                              **request_options)
+
+    scheduler = get_llm_scheduler()
+    chunks = scheduler.stream(request, messages, function_name, request_options.get('max_tokens')) \
+        if scheduler is not None else request()
+
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+
+    if cache is not None and parts:
+        cache.set(function_name, cache_model, messages, ''.join(parts), **request_options)
+
+
+async def cached_chat_completion_async(async_client, function_name, messages, model=LLM_MODEL, temperature=0,
+                                       validator=None, **request_options):
+    """Phiên bản bất đồng bộ của `cached_chat_completion` (LLMBackend trong event loop hoặc AsyncOpenAI client)."""
+    backend = as_backend(async_client)
+    cache = get_llm_cache() if temperature == 0 else None
+    cache_model = cache_model_key(backend, model)
+    if cache is not None:
+        cached = cache.get(function_name, cache_model, messages, **request_options)
+        if cached is not None and _is_valid(validator, cached):
+            return cached
+
+    def request():
+        return backend.acomplete(messages, model=model, temperature=temperature, purpose=function_name,
+                                 **request_options)
+
+    scheduler = get_llm_scheduler()
+    if scheduler is not None:
+        response = await scheduler.call_async(request, messages, function_name, request_options.get('max_tokens'))
+    else:
+        response = await request()
+    content = response.content
+
+    if cache is not None and content is not None and _is_valid(validator, content):
+        cache.set(function_name, cache_model, messages, content, **request_options)
+    return content
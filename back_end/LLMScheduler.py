@@ -0,0 +1,440 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+# --- Cấu hình bộ điều phối request LLM ---
+LLM_SCHEDULER_ENABLED = os.getenv('LLM_SCHEDULER_ENABLED', '1') == '1'
+LLM_SCHEDULER_REDIS_URL = os.getenv('LLM_SCHEDULER_REDIS_URL',
+                                    os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0'))
+LLM_SCHEDULER_PREFIX = os.getenv('LLM_SCHEDULER_PREFIX', 'llm_scheduler')
+# Ngân sách của tài khoản OpenAI (dùng chung cho Flask và tất cả Celery worker)
+LLM_RATE_LIMIT_RPM = int(os.getenv('LLM_RATE_LIMIT_RPM', '500'))
+LLM_RATE_LIMIT_TPM = int(os.getenv('LLM_RATE_LIMIT_TPM', '200000'))
+# Tỉ lệ ngân sách dành riêng cho luồng 'interactive' (chat), luồng 'bulk' (xử lý PDF) không được dùng tới
+LLM_BULK_RESERVE_FRACTION = float(os.getenv('LLM_BULK_RESERVE_FRACTION', '0.2'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '6'))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv('LLM_BACKOFF_BASE_SECONDS', '1.0'))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv('LLM_BACKOFF_MAX_SECONDS', '60'))
+# Số token đầu ra ước lượng cho mỗi request khi không có max_tokens
+LLM_DEFAULT_COMPLETION_TOKENS = int(os.getenv('LLM_DEFAULT_COMPLETION_TOKENS', '256'))
+
+INTERACTIVE_LANE = 'interactive'
+BULK_LANE = 'bulk'
+# Các hàm phục vụ trực tiếp người dùng đang chat, được ưu tiên hơn xử lý tài liệu
+INTERACTIVE_FUNCTIONS = {'find_entities_from_question_PP1', 'generate_response'}
+
+# Lấy token đồng thời từ hai bucket (request và token) một cách nguyên tử.
+# KEYS: bucket request, bucket token, bộ đếm request interactive đang chờ
+# ARGV: rpm, tpm, số token cần, tỉ lệ dự trữ, là luồng bulk (0/1)
+# Thời điểm hiện tại lấy từ đồng hồ của Redis (TIME) để lệch giờ giữa các máy Flask/Celery không làm sai lượng nạp lại.
+# Trả về: 0 nếu lấy được, ngược lại số mili giây nên chờ trước khi thử lại.
+TOKEN_BUCKET_LUA = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local reserve = tonumber(ARGV[4])
+local bulk = tonumber(ARGV[5])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000.0
+
+local function refill(key, capacity)
+    local data = redis.call('HMGET', key, 'level', 'ts')
+    local level = tonumber(data[1])
+    local ts = tonumber(data[2])
+    if level == nil then
+        level = capacity
+        ts = now
+    end
+    level = math.min(capacity, level + (now - ts) * capacity / 60.0)
+    return level
+end
+
+local req_level = refill(KEYS[1], rpm)
+local tok_level = refill(KEYS[2], tpm)
+local floor_req = 0
+local floor_tok = 0
+if bulk == 1 then
+    local waiting = tonumber(redis.call('GET', KEYS[3]) or '0')
+    if waiting > 0 then
+        redis.call('HSET', KEYS[1], 'level', req_level, 'ts', now)
+        redis.call('HSET', KEYS[2], 'level', tok_level, 'ts', now)
+        return 50
+    end
+    floor_req = rpm * reserve
+    floor_tok = tpm * reserve
+end
+cost = math.min(cost, tpm * (1 - reserve))
+
+local wait = 0
+if req_level - 1 < floor_req then
+    wait = math.max(wait, (floor_req + 1 - req_level) * 60.0 / rpm)
+end
+if tok_level - cost < floor_tok then
+    wait = math.max(wait, (floor_tok + cost - tok_level) * 60.0 / tpm)
+end
+if wait == 0 then
+    req_level = req_level - 1
+    tok_level = tok_level - cost
+end
+redis.call('HSET', KEYS[1], 'level', req_level, 'ts', now)
+redis.call('HSET', KEYS[2], 'level', tok_level, 'ts', now)
+redis.call('EXPIRE', KEYS[1], 120)
+redis.call('EXPIRE', KEYS[2], 120)
+return math.ceil(wait * 1000)
+"""
+
+
+def estimate_request_tokens(messages, max_tokens=None):
+    """
+    Ước lượng số token của một request (đầu vào theo số ký tự + đầu ra dự kiến),
+    dùng để trừ vào bucket token trước khi gửi.
+    """
+    prompt_chars = sum(len(m.get('content') or '') for m in messages)
+    return prompt_chars // 3 + 1 + (max_tokens or LLM_DEFAULT_COMPLETION_TOKENS)
+
+
+def lane_for_function(function_name):
+    """Chọn luồng ưu tiên theo tên hàm gọi LLM."""
+    return INTERACTIVE_LANE if function_name in INTERACTIVE_FUNCTIONS else BULK_LANE
+
+
+def is_retryable_error(error):
+    """Lỗi 429, 5xx, timeout hoặc lỗi kết nối thì nên thử lại."""
+    status_code = getattr(error, 'status_code', None)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return type(error).__name__ in ('RateLimitError', 'APIConnectionError', 'APITimeoutError',
+                                    'InternalServerError', 'ConnectionError', 'TimeoutError')
+
+
+def _retry_after_seconds(error):
+    """Đọc header Retry-After (nếu có) của lỗi từ OpenAI."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class LocalTokenBucket:
+    """
+    Token bucket trong bộ nhớ của process, dùng khi không kết nối được Redis.
+    Cùng thuật toán với TOKEN_BUCKET_LUA nhưng chỉ điều phối các thread trong một process.
+    """
+
+    def __init__(self, rpm, tpm, reserve_fraction):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.reserve_fraction = reserve_fraction
+        self._levels = {'requests': float(rpm), 'tokens': float(tpm)}
+        self._ts = time.time()
+        self._interactive_waiting = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, cost, lane):
+        """Trả về 0 nếu lấy được, ngược lại số giây nên chờ."""
+        with self._lock:
+            now = time.time()
+            elapsed = now - self._ts
+            self._ts = now
+            self._levels['requests'] = min(self.rpm, self._levels['requests'] + elapsed * self.rpm / 60.0)
+            self._levels['tokens'] = min(self.tpm, self._levels['tokens'] + elapsed * self.tpm / 60.0)
+
+            floor_req, floor_tok = 0, 0
+            if lane == BULK_LANE:
+                if self._interactive_waiting > 0:
+                    return 0.05
+                floor_req = self.rpm * self.reserve_fraction
+                floor_tok = self.tpm * self.reserve_fraction
+            cost = min(cost, self.tpm * (1 - self.reserve_fraction))
+
+            wait = 0
+            if self._levels['requests'] - 1 < floor_req:
+                wait = max(wait, (floor_req + 1 - self._levels['requests']) * 60.0 / self.rpm)
+            if self._levels['tokens'] - cost < floor_tok:
+                wait = max(wait, (floor_tok + cost - self._levels['tokens']) * 60.0 / self.tpm)
+            if wait == 0:
+                self._levels['requests'] -= 1
+                self._levels['tokens'] -= cost
+            return wait
+
+    def adjust_tokens(self, delta):
+        """Điều chỉnh bucket token theo số token thực tế đã dùng (delta > 0: dùng nhiều hơn ước lượng)."""
+        with self._lock:
+            self._levels['tokens'] -= delta
+
+    def waiting(self, lane, delta):
+        if lane == INTERACTIVE_LANE:
+            with self._lock:
+                self._interactive_waiting += delta
+
+
+class RedisTokenBucket:
+    """Token bucket dùng chung giữa Flask và các Celery worker qua Redis (script Lua nguyên tử)."""
+
+    def __init__(self, redis_client, rpm, tpm, reserve_fraction, prefix=LLM_SCHEDULER_PREFIX):
+        self.redis = redis_client
+        self.rpm = rpm
+        self.tpm = tpm
+        self.reserve_fraction = reserve_fraction
+        self.keys = [f"{prefix}:bucket:requests", f"{prefix}:bucket:tokens", f"{prefix}:waiting:interactive"]
+        self._script = redis_client.register_script(TOKEN_BUCKET_LUA)
+
+    def try_acquire(self, cost, lane):
+        wait_ms = self._script(keys=self.keys, args=[
+            self.rpm, self.tpm, cost, self.reserve_fraction, 1 if lane == BULK_LANE else 0
+        ])
+        return int(wait_ms) / 1000.0
+
+    def adjust_tokens(self, delta):
+        self.redis.hincrbyfloat(self.keys[1], 'level', -delta)
+
+    def waiting(self, lane, delta):
+        if lane == INTERACTIVE_LANE:
+            pipe = self.redis.pipeline()
+            pipe.incrby(self.keys[2], delta)
+            # Tránh bộ đếm bị kẹt nếu process chết khi đang chờ
+            pipe.expire(self.keys[2], 60)
+            pipe.execute()
+
+
+class LLMScheduler:
+    """
+    Điều phối mọi request tới LLM: giới hạn theo requests/phút và tokens/phút (token bucket),
+    ưu tiên luồng 'interactive' (chat) trước luồng 'bulk' (xử lý PDF),
+    thử lại với exponential backoff có jitter khi gặp 429/5xx/lỗi kết nối,
+    và ghi nhận thời gian chờ trong hàng đợi theo từng luồng.
+    """
+
+    def __init__(self, bucket, max_retries=LLM_MAX_RETRIES, backoff_base=LLM_BACKOFF_BASE_SECONDS,
+                 backoff_max=LLM_BACKOFF_MAX_SECONDS):
+        """
+        Args:
+            bucket: LocalTokenBucket hoặc RedisTokenBucket.
+            max_retries (int): Số lần thử lại tối đa cho lỗi tạm thời.
+            backoff_base (float): Thời gian chờ cơ sở (giây) của backoff.
+            backoff_max (float): Thời gian chờ tối đa (giây) giữa hai lần thử.
+        """
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._metrics_lock = threading.Lock()
+        self._metrics = {lane: {'requests': 0, 'retries': 0, 'failures': 0,
+                                'queue_wait_total': 0.0, 'queue_wait_max': 0.0}
+                         for lane in (INTERACTIVE_LANE, BULK_LANE)}
+
+    # --- Lấy quyền gửi request ---
+    def _record_wait(self, lane, waited):
+        with self._metrics_lock:
+            metrics = self._metrics[lane]
+            metrics['requests'] += 1
+            metrics['queue_wait_total'] += waited
+            metrics['queue_wait_max'] = max(metrics['queue_wait_max'], waited)
+
+    def _next_wait(self, cost, lane):
+        try:
+            return self.bucket.try_acquire(cost, lane)
+        except Exception as e:
+            # Redis lỗi giữa chừng: không chặn request, chỉ mất điều phối giữa các process
+            print(f"⚠ Lỗi token bucket, bỏ qua giới hạn: {e}")
+            return 0
+
+    def acquire(self, cost, lane=BULK_LANE):
+        """Chờ (blocking) đến khi đủ ngân sách cho request. Trả về thời gian đã chờ (giây)."""
+        start = time.time()
+        self.bucket.waiting(lane, 1)
+        try:
+            while True:
+                wait = self._next_wait(cost, lane)
+                if wait <= 0:
+                    break
+                time.sleep(min(wait, 1.0) * random.uniform(1.0, 1.2))
+        finally:
+            self.bucket.waiting(lane, -1)
+        waited = time.time() - start
+        self._record_wait(lane, waited)
+        return waited
+
+    async def acquire_async(self, cost, lane=BULK_LANE):
+        """
+        Phiên bản bất đồng bộ của `acquire`. Các lệnh tới bucket (Redis client blocking) chạy trong thread
+        để không chặn event loop của các coroutine khác.
+        """
+        start = time.time()
+        await asyncio.to_thread(self.bucket.waiting, lane, 1)
+        try:
+            while True:
+                wait = await asyncio.to_thread(self._next_wait, cost, lane)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(min(wait, 1.0) * random.uniform(1.0, 1.2))
+        finally:
+            await asyncio.to_thread(self.bucket.waiting, lane, -1)
+        waited = time.time() - start
+        self._record_wait(lane, waited)
+        return waited
+
+    # --- Backoff ---
+    def backoff_seconds(self, attempt, error=None):
+        """Exponential backoff với full jitter; ưu tiên Retry-After từ server nếu có."""
+        retry_after = _retry_after_seconds(error) if error is not None else None
+        if retry_after is not None:
+            return min(self.backoff_max, retry_after) + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _on_retry(self, lane, attempt, error):
+        with self._metrics_lock:
+            self._metrics[lane]['retries'] += 1
+        delay = self.backoff_seconds(attempt, error)
+        print(f"  ↻ Lỗi LLM tạm thời ({type(error).__name__}), thử lại lần {attempt + 1} sau {delay:.1f}s")
+        return delay
+
+    def _on_failure(self, lane):
+        with self._metrics_lock:
+            self._metrics[lane]['failures'] += 1
+
+    def _record_usage(self, response, estimated_tokens):
+        total_tokens = getattr(response, 'total_tokens', None)
+        if total_tokens is None:
+            return
+        try:
+            self.bucket.adjust_tokens(total_tokens - estimated_tokens)
+        except Exception:
+            pass
+
+    # --- Gửi request ---
+    def call(self, request_fn, messages, function_name='', max_tokens=None):
+        """
+        Gửi một request qua bộ điều phối (blocking).
+
+        Args:
+            request_fn (callable): Hàm không tham số thực hiện request (ví dụ lambda gọi backend.complete).
+            messages (list): Messages của request, dùng để ước lượng token.
+            function_name (str): Tên hàm gọi LLM, quyết định luồng ưu tiên.
+            max_tokens (int, optional): Số token đầu ra tối đa của request.
+
+        Returns:
+            Kết quả của `request_fn`.
+        """
+        lane = lane_for_function(function_name)
+        cost = estimate_request_tokens(messages, max_tokens)
+        for attempt in range(self.max_retries + 1):
+            self.acquire(cost, lane)
+            try:
+                response = request_fn()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable_error(e):
+                    self._on_failure(lane)
+                    raise
+                time.sleep(self._on_retry(lane, attempt, e))
+                continue
+            self._record_usage(response, cost)
+            return response
+
+    async def call_async(self, request_fn, messages, function_name='', max_tokens=None):
+        """Phiên bản bất đồng bộ của `call`; `request_fn` trả về coroutine."""
+        lane = lane_for_function(function_name)
+        cost = estimate_request_tokens(messages, max_tokens)
+        for attempt in range(self.max_retries + 1):
+            await self.acquire_async(cost, lane)
+            try:
+                response = await request_fn()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable_error(e):
+                    self._on_failure(lane)
+                    raise
+                await asyncio.sleep(self._on_retry(lane, attempt, e))
+                continue
+            self._record_usage(response, cost)
+            return response
+
+    def stream(self, request_fn, messages, function_name='', max_tokens=None):
+        """
+        Gửi một request streaming qua bộ điều phối. Chỉ thử lại khi lỗi xảy ra trước đoạn nội dung đầu tiên
+        (sau khi đã gửi nội dung cho người dùng thì không thể gửi lại từ đầu).
+
+        Args:
+            request_fn (callable): Hàm không tham số trả về iterator các đoạn nội dung (ví dụ backend.stream).
+
+        Yields:
+            str: Các đoạn nội dung theo thứ tự sinh.
+        """
+        lane = lane_for_function(function_name)
+        cost = estimate_request_tokens(messages, max_tokens)
+        for attempt in range(self.max_retries + 1):
+            self.acquire(cost, lane)
+            try:
+                chunks = iter(request_fn())
+                first_chunk = next(chunks, None)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable_error(e):
+                    self._on_failure(lane)
+                    raise
+                time.sleep(self._on_retry(lane, attempt, e))
+                continue
+            if first_chunk is not None:
+                yield first_chunk
+            yield from chunks
+            return
+
+    def stats(self):
+        """Thống kê theo luồng: số request, số lần thử lại, thất bại và thời gian chờ hàng đợi (trung bình/tối đa)."""
+        with self._metrics_lock:
+            stats = {}
+            for lane, metrics in self._metrics.items():
+                stats[lane] = dict(metrics)
+                stats[lane]['queue_wait_avg'] = (metrics['queue_wait_total'] / metrics['requests']
+                                                 if metrics['requests'] else 0.0)
+        stats['backend'] = type(self.bucket).__name__
+        return stats
+
+
+def create_llm_scheduler(redis_url=LLM_SCHEDULER_REDIS_URL, rpm=LLM_RATE_LIMIT_RPM, tpm=LLM_RATE_LIMIT_TPM,
+                         reserve_fraction=LLM_BULK_RESERVE_FRACTION):
+    """
+    Tạo bộ điều phối dùng Redis token bucket; nếu không kết nối được Redis thì dùng bucket trong process.
+    """
+    bucket = None
+    if redis_url:
+        try:
+            import redis
+            redis_client = redis.StrictRedis.from_url(redis_url)
+            redis_client.ping()
+            bucket = RedisTokenBucket(redis_client, rpm, tpm, reserve_fraction)
+            print(f"LLM scheduler dùng Redis token bucket ({rpm} RPM, {tpm} TPM)")
+        except Exception as e:
+            print(f"LLM scheduler không kết nối được Redis ({e}), dùng token bucket trong process")
+    if bucket is None:
+        bucket = LocalTokenBucket(rpm, tpm, reserve_fraction)
+    return LLMScheduler(bucket)
+
+
+_llm_scheduler = None
+_llm_scheduler_lock = threading.Lock()
+
+
+def get_llm_scheduler():
+    """Lấy bộ điều phối LLM dùng chung của process (tạo lần đầu khi cần). Trả về None nếu bị tắt."""
+    global _llm_scheduler
+    if not LLM_SCHEDULER_ENABLED:
+        return None
+    with _llm_scheduler_lock:
+        if _llm_scheduler is None:
+            _llm_scheduler = create_llm_scheduler()
+        return _llm_scheduler
+
+
+def set_llm_scheduler(scheduler):
+    """Đặt bộ điều phối LLM dùng chung (truyền None để gọi LLM trực tiếp)."""
+    global _llm_scheduler, LLM_SCHEDULER_ENABLED
+    _llm_scheduler = scheduler
+    LLM_SCHEDULER_ENABLED = scheduler is not None
@@ -3,7 +3,13 @@
 
 from owlready2 import *
 import faiss
+import hashlib
 import numpy as np
+import os
+from collections import OrderedDict
+from CreateOnology import embedding_model_name, entity_embedding_text
+from LLMBackend import LLM_MODEL
+from LLMCache import cached_chat_completion, cached_chat_completion_stream
 
 
 """**pp1**: lấy toàn bộ anotation làm chú thích
@@ -134,7 +140,12 @@ def create_explication(entities_with_annotation_sumarry : dict):
 
 import json
 
-def find_entities_from_question_PP1(client, relation, explication, question, chat_history):
+def find_entities_from_question_PP1(client, relation, explication, question, chat_history, compact=False):
+    """
+    Dùng LLM tìm các thực thể trong ontology liên quan đến câu hỏi.
+    compact=True: serialize cấu trúc/chú thích không thụt lề để giảm số token của prompt.
+    """
+    json_options = {'separators': (',', ':')} if compact else {'indent': 4}
     messages = [
         {
             "role": "system",
@@ -179,11 +190,11 @@ def find_entities_from_question_PP1(client, relation, explication, question, cha
         },
         {
             "role": "user",
-            "content": f"CÁC THỰC THỂ VÀ CÁC QUAN HỆ TƯƠNG ỨNG:\n{json.dumps(relation, indent=4, ensure_ascii=False)}"
+            "content": f"CÁC THỰC THỂ VÀ CÁC QUAN HỆ TƯƠNG ỨNG:\n{json.dumps(relation, ensure_ascii=False, **json_options)}"
         },
         {
             "role": "user",
-            "content": f"TÊN THỰC THỂ VÀ THÔNG TIN CHÚ THÍCH:\n{json.dumps(explication, indent=4, ensure_ascii=False)}"
+            "content": f"TÊN THỰC THỂ VÀ THÔNG TIN CHÚ THÍCH:\n{json.dumps(explication, ensure_ascii=False, **json_options)}"
         },
         {
             "role": "user",
@@ -195,13 +206,241 @@ def find_entities_from_question_PP1(client, relation, explication, question, cha
         }
     ]
 
-    response = client.chat.completions.create(
-        model='gpt-4o-mini',
+    return cached_chat_completion(
+        client,
+        'find_entities_from_question_PP1',
+        model=LLM_MODEL,
         temperature=0,
         messages=messages
     )
+"""**PP1 + lọc ứng viên: chỉ gửi cho LLM top-K thực thể gần câu hỏi nhất (theo embedding) và các lớp tổ tiên**"""
+
+# Số thực thể ứng viên gửi cho LLM (0 = gửi toàn bộ ontology như PP1)
+PP1_CANDIDATE_TOP_K = int(os.getenv('PP1_CANDIDATE_TOP_K', '30'))
+# Số ontology giữ chỉ mục embedding trong bộ nhớ
+CLASS_INDEX_CACHE_SIZE = int(os.getenv('CLASS_INDEX_CACHE_SIZE', '16'))
+
+_class_index_cache = OrderedDict()
+
+
+def get_stored_summary_embeddings(onto, model_key):
+    """
+    Đọc vector thực thể đã lưu sẵn trong annotation 'summary_embeddings' (ghi khi tạo ontology),
+    chỉ lấy các lớp được nhúng bằng đúng model `model_key`.
+
+    Returns:
+        dict: {tên lớp: np.ndarray float32}
+    """
+    stored = {}
+    if onto is None:
+        return stored
+    for cls in onto.classes():
+        values = getattr(cls, 'summary_embeddings', None)
+        models = getattr(cls, 'summary_embedding_model', None)
+        if not values or not models or models[0] != model_key:
+            continue
+        try:
+            stored[cls.name] = np.asarray(json.loads(values[0]), dtype=np.float32)
+        except (TypeError, ValueError):
+            continue
+    return stored
+
+
+def build_class_embedding_index(model_embedding, explication, stored_embeddings=None):
+    """
+    Tạo chỉ mục embedding (đã chuẩn hóa) cho các thực thể từ tên và chú thích summary (`entity_embedding_text`).
+    Thực thể có vector lưu sẵn trong ontology (`stored_embeddings`, nhúng từ cùng văn bản đó bằng cùng model
+    và cùng số chiều) dùng lại vector đó, chỉ các thực thể còn lại được nhúng.
+
+    Returns:
+        dict: {'names': list tên thực thể, 'embeddings': np.ndarray (n, d) float32}
+    """
+    names = list(explication.keys())
+    stored_embeddings = stored_embeddings or {}
+
+    def encode_entities(indices):
+        texts = [entity_embedding_text(names[i], explication[names[i]]) for i in indices]
+        return np.asarray(model_embedding.encode(texts, show_progress_bar=False), dtype=np.float32)
+
+    missing = [i for i, name in enumerate(names) if name not in stored_embeddings]
+    encoded = encode_entities(missing) if missing else None
+    if encoded is not None:
+        # Vector lưu sẵn khác số chiều của model hiện tại thì nhúng lại
+        mismatched = [i for i, name in enumerate(names)
+                      if name in stored_embeddings and len(stored_embeddings[name]) != encoded.shape[1]]
+        if mismatched:
+            missing, encoded = missing + mismatched, np.vstack([encoded, encode_entities(mismatched)])
+    dim = encoded.shape[1] if encoded is not None else len(next(iter(stored_embeddings.values())))
+
+    embeddings = np.empty((len(names), dim), dtype=np.float32)
+    missing_set = set(missing)
+    for i, name in enumerate(names):
+        if i not in missing_set:
+            embeddings[i] = stored_embeddings[name]
+    if encoded is not None:
+        embeddings[missing] = encoded
+    embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    print(f"Chỉ mục thực thể: dùng lại {len(names) - len(missing)} vector lưu sẵn, nhúng mới {len(missing)}")
+    return {'names': names, 'embeddings': embeddings}
+
+
+def explication_fingerprint(explication):
+    """Hash nội dung chú thích của ontology (O(kích thước ontology), chỉ nên tính một lần khi load ontology)."""
+    return hashlib.sha256(json.dumps(explication, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def ontology_file_key(ontology_path):
+    """Định danh một file ontology theo đường dẫn, thời điểm sửa và kích thước: O(1), đổi khi file được ghi lại."""
+    stat = os.stat(ontology_path)
+    return f"{os.path.abspath(ontology_path)}:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def get_class_embedding_index(model_embedding, explication, onto=None, ontology_key=None):
+    """
+    Lấy chỉ mục embedding của ontology từ cache, tạo mới nếu chưa có. Key là model và `ontology_key`
+    (định danh ontology tính một lần khi load, ví dụ `ontology_file_key`), nên mỗi câu hỏi không phải
+    duyệt lại toàn bộ chú thích; không có `ontology_key` thì dùng `explication_fingerprint`.
+    Nếu có `onto`, vector thực thể đã lưu trong ontology được dùng lại thay vì nhúng lại.
+    """
+    model_key = embedding_model_name(model_embedding)
+    key = (model_key, ontology_key or explication_fingerprint(explication))
+    if key in _class_index_cache:
+        _class_index_cache.move_to_end(key)
+        return _class_index_cache[key]
+
+    stored_embeddings = {name: vector for name, vector in get_stored_summary_embeddings(onto, model_key).items()
+                         if name in explication}
+    class_index = build_class_embedding_index(model_embedding, explication, stored_embeddings)
+    _class_index_cache[key] = class_index
+    while len(_class_index_cache) > CLASS_INDEX_CACHE_SIZE:
+        _class_index_cache.popitem(last=False)
+    return class_index
+
+
+_ontology_context_cache = OrderedDict()
+
+
+def get_ontology_context(onto, ontology_key=None):
+    """
+    Cấu trúc (`find_relation`) và chú thích (`create_explication`) của ontology, cache theo `ontology_key`
+    để các câu hỏi sau trên cùng ontology không phải duyệt lại toàn bộ ontology.
+
+    Returns:
+        tuple: (relation, explication)
+    """
+    if ontology_key is not None and ontology_key in _ontology_context_cache:
+        _ontology_context_cache.move_to_end(ontology_key)
+        return _ontology_context_cache[ontology_key]
+
+    context = (find_relation(onto), create_explication(get_entities_with_annotation(onto, 'summary')))
+    if ontology_key is not None:
+        _ontology_context_cache[ontology_key] = context
+        while len(_ontology_context_cache) > CLASS_INDEX_CACHE_SIZE:
+            _ontology_context_cache.popitem(last=False)
+    return context
+
+
+def question_similarities(model_embedding, class_index, question):
+    """Cosine similarity giữa câu hỏi và từng thực thể trong chỉ mục."""
+    question_embedding = np.asarray(model_embedding.encode([question], show_progress_bar=False),
+                                    dtype=np.float32)[0]
+    question_embedding /= max(np.linalg.norm(question_embedding), 1e-12)
+    return class_index['embeddings'] @ question_embedding
+
+
+def top_k_candidate_entities(model_embedding, class_index, question, top_k=PP1_CANDIDATE_TOP_K):
+    """Chọn `top_k` thực thể có cosine similarity với câu hỏi cao nhất."""
+    scores = question_similarities(model_embedding, class_index, question)
+    top_k = min(top_k, len(scores))
+    top_indices = np.argpartition(-scores, top_k - 1)[:top_k]
+    top_indices = top_indices[np.argsort(-scores[top_indices])]
+    return [class_index['names'][i] for i in top_indices]
+
+
+def prune_relation(relation, candidates):
+    """
+    Giữ lại trong cây `find_relation` các nhánh dẫn tới thực thể ứng viên: các lớp ứng viên,
+    lớp tổ tiên của chúng và các instance ứng viên (lớp ứng viên giữ toàn bộ instance).
+
+    Returns:
+        tuple: (cây đã lọc, tập tên các lớp tổ tiên được giữ lại)
+    """
+    candidates = set(candidates)
+    ancestors = set()
+
+    def prune_node(node, node_key):
+        is_candidate = node_key in candidates or node.get("name") in candidates
+        pruned = {"name": node["name"]}
+        subclasses = [child for child in (prune_node(sub, sub.get("name")) for sub in node.get("subclasses", []))
+                      if child is not None]
+        if subclasses:
+            pruned["subclasses"] = subclasses
+        instances = node.get("Instances", [])
+        if not is_candidate:
+            instances = [inst for inst in instances if inst in candidates]
+        if instances:
+            pruned["Instances"] = instances
+        if not (is_candidate or subclasses or instances):
+            return None
+        if subclasses or instances:
+            ancestors.add(node_key)
+            ancestors.add(node["name"])
+        return pruned
+
+    pruned_relation = {}
+    for key, node in relation.items():
+        pruned = prune_node(node, key)
+        if pruned is not None:
+            pruned_relation[key] = pruned
+    return pruned_relation, ancestors
+
+
+def find_entities_from_question_pruned(client, model_embedding, relation, explication, question, chat_history,
+                                       top_k=PP1_CANDIDATE_TOP_K, onto=None, ontology_key=None):
+    """
+    Giống find_entities_from_question_PP1 nhưng chỉ gửi cho LLM cây con gồm top-K thực thể gần câu hỏi nhất
+    (theo embedding của tên + summary) cùng các lớp tổ tiên, serialize gọn (không thụt lề).
+    Nhờ đó kích thước prompt không tăng theo kích thước ontology.
+    """
+    if top_k <= 0 or len(explication) <= top_k:
+        return find_entities_from_question_PP1(client, relation, explication, question, chat_history, compact=True)
+
+    class_index = get_class_embedding_index(model_embedding, explication, onto, ontology_key)
+    candidates = top_k_candidate_entities(model_embedding, class_index, question, top_k)
+    pruned_relation, ancestors = prune_relation(relation, candidates)
+    pruned_explication = {name: explication[name] for name in explication
+                          if name in ancestors or name in candidates}
+    print(f"Lọc ứng viên: {len(pruned_explication)}/{len(explication)} thực thể gửi cho LLM")
+    return find_entities_from_question_PP1(client, pruned_relation, pruned_explication, question, chat_history,
+                                           compact=True)
+
+
+"""**PP2: embedding chú thích để tìm thực thể gần với câu hỏi nhất, không cần gọi LLM**"""
+
+# Số thực thể lấy theo độ tương đồng và ngưỡng cosine tối thiểu ở PP2
+PP2_TOP_K = int(os.getenv('PP2_TOP_K', '3'))
+PP2_MIN_SIMILARITY = float(os.getenv('PP2_MIN_SIMILARITY', '0.2'))
+
+
+def find_entities_from_question_PP2(model_embedding, explication, question, top_k=PP2_TOP_K,
+                                    min_similarity=PP2_MIN_SIMILARITY, onto=None, ontology_key=None):
+    """
+    Tìm thực thể liên quan đến câu hỏi bằng cosine similarity giữa embedding câu hỏi và embedding
+    (tên + summary) của các thực thể, thay cho lời gọi LLM của PP1. Có `onto` thì dùng lại
+    vector thực thể đã lưu trong ontology.
+
+    Returns:
+        dict: Cùng định dạng JSON của PP1, dùng trực tiếp cho create_query
+              (lớp được mở rộng sang các lớp con qua get_children_of).
+    """
+    if not explication:
+        return {"Trong": []}
+    class_index = get_class_embedding_index(model_embedding, explication, onto, ontology_key)
+    scores = question_similarities(model_embedding, class_index, question)
+    entities = [class_index['names'][i] for i in np.argsort(-scores)[:top_k] if scores[i] >= min_similarity]
+    return {"PP2": entities} if entities else {"Trong": []}
+
 
-    return response.choices[0].message.content
 def get_direct_class_of_individual(onto, individual_name):
     """
     Trả về class cha trực tiếp đầu tiên (rdf:type) của một individual.
@@ -337,7 +576,7 @@ def find_question_info(name_ontology, list_query):
 
     return results
 
-def generate_response(client ,question_info, question, history ):
+def build_response_messages(question_info, question, history):
   system_prompt  = f'''
             Bạn là một agent hữu ích giúp trả lời câu hỏi của người dùng dựa trên thông tin được cung cấp.
             Dựa vào lịch sử cuộc trò chuyện để hiểu rõ hơn ngữ cảnh cuộc trò chuyện.
@@ -351,21 +590,35 @@ def generate_response(client ,question_info, question, history ):
 
             Nếu không có câu trả lời, hãy nói: Tôi không biết, tôi chưa có kiến thức để trả lời câu hỏi này.
   '''
-  response = client.chat.completions.create(
-      model='gpt-4o-mini',
+  return [
+      {
+          "role": "system",
+          "content": system_prompt
+      },
+      {
+          "role": "user",
+          "content": question
+      }
+      ]
+
+def generate_response(client ,question_info, question, history ):
+  return cached_chat_completion(
+      client,
+      'generate_response',
+      model=LLM_MODEL,
+      temperature=0,
+      messages=build_response_messages(question_info, question, history)
+      )
+
+def generate_response_stream(client, question_info, question, history):
+  """Giống generate_response nhưng trả về từng đoạn câu trả lời ngay khi LLM sinh ra (dùng cho SSE)."""
+  return cached_chat_completion_stream(
+      client,
+      'generate_response',
+      model=LLM_MODEL,
       temperature=0,
-      messages=[
-          {
-              "role": "system",
-              "content": system_prompt
-          },
-          {
-              "role": "user",
-              "content": question
-          }
-          ]
+      messages=build_response_messages(question_info, question, history)
       )
-  return response.choices[0].message.content
 
 def get_embedding( model_embedding, text):
     # return model.encode(text)
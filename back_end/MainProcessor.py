@@ -2,23 +2,25 @@ from PDF_Processor import *
 from RunBuildTree import *
 from CreateOnology import *
 
-def process_PDF_file(client, model_embedding, model_detect_layout, reader, PDF_file_path):
+def process_PDF_file(client, model_embedding, model_detect_layout, reader, PDF_file_path,
+                     extraction_mode=PDF_EXTRACTION_MODE):
     '''
     Tạo ra cây phân cấp từ file PDF.
     Args:
         PDF_file_path: đường dẫn đến file PDF trong thư mục upload
+        extraction_mode: 'layout' (YOLO cho mọi trang) hoặc 'native' (ưu tiên text layer)
 
     Returns:
         list các dict có index và parent_index để tạo cây
     '''
-    pdf_result = process_full_pdf(model_detect_layout,reader, PDF_file_path)
+    pdf_result = process_full_pdf(model_detect_layout,reader, PDF_file_path, extraction_mode=extraction_mode)
     merged_result = merge_short_paragraphs(pdf_result['all_paragraphs'])
     result = run_clustering_with_tree_building(client, model_embedding, merged_result, clustering_strategy='adaptive')
     clustering_tree = result['tree']
     return clustering_tree
 
 
-def create_ontology(merged_nodes, save_path, ontology_iri="http://www.semanticweb.org/MINDMAP"):
+def create_ontology(merged_nodes, save_path, ontology_iri="http://www.semanticweb.org/MINDMAP", model_embedding=None):
     """
     Tạo ontology dựa vào cấu trúc index và index_parent từ merged_nodes.
     Thêm annotation 'summary' cho mỗi class.
@@ -26,6 +28,7 @@ def create_ontology(merged_nodes, save_path, ontology_iri="http://www.semanticwe
     Args:
         merged_nodes: List các node đã được xử lý từ hàm merge_short_nodes
         ontology_iri: IRI của ontology
+        model_embedding: Nếu có, lưu embedding (tên + summary) của mỗi class vào ontology để khi chat không phải nhúng lại
 
     Returns:
         Đối tượng ontology đã được tạo
@@ -109,6 +112,9 @@ def create_ontology(merged_nodes, save_path, ontology_iri="http://www.semanticwe
         # Đệ quy xử lý các node con của node hiện tại
         process_nodes_level_by_level(onto, nodes_by_parent, class_names, merged_nodes, index)
 
+    if model_embedding is not None:
+        add_summary_embeddings(onto, model_embedding)
+
     onto.save(save_path)
 
     return onto
\ No newline at end of file
@@ -0,0 +1,244 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+# --- Cấu hình backend embedding ---
+# 'torch': SentenceTransformer (PyTorch), 'onnx': ONNX Runtime với model đã lượng tử hóa int8
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch')
+ONNX_MODEL_FOLDER = os.getenv('ONNX_MODEL_FOLDER', 'model/onnx_embedding')
+ONNX_NUM_THREADS = int(os.getenv('ONNX_NUM_THREADS', '0'))
+ONNX_BATCH_SIZE = int(os.getenv('ONNX_BATCH_SIZE', '64'))
+ONNX_MAX_SEQ_LENGTH = int(os.getenv('ONNX_MAX_SEQ_LENGTH', '128'))
+
+
+def onnx_model_dir(model_name, root=ONNX_MODEL_FOLDER):
+    """Thư mục chứa model ONNX của một model embedding."""
+    return os.path.join(root, model_name.replace('/', '__'))
+
+
+def embedding_model_key(model_name, backend=EMBEDDING_BACKEND):
+    """Tên dùng cho kho embedding: vector int8 lệch nhẹ so với PyTorch nên không dùng chung kho."""
+    return f"{model_name}-onnx-int8" if backend == 'onnx' else model_name
+
+
+def export_onnx_model(model_name, output_dir=None, quantize=True, opset=14):
+    """
+    Export model SentenceTransformer (phần transformer) sang ONNX và lượng tử hóa động int8.
+    Pooling (mean theo attention mask) được làm lại trong OnnxEmbeddingModel nên không cần export.
+
+    Args:
+        model_name (str): Tên model (ví dụ 'paraphrase-multilingual-MiniLM-L12-v2').
+        output_dir (str, optional): Thư mục lưu, mặc định theo `onnx_model_dir`.
+        quantize (bool): Lượng tử hóa động trọng số sang int8 (model.int8.onnx).
+        opset (int): ONNX opset.
+
+    Returns:
+        str: Đường dẫn file .onnx sẽ được dùng khi chạy.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    output_dir = output_dir or onnx_model_dir(model_name)
+    os.makedirs(output_dir, exist_ok=True)
+
+    st_model = SentenceTransformer(model_name, device='cpu')
+    transformer = st_model[0].auto_model.eval()
+    tokenizer = st_model.tokenizer
+    tokenizer.save_pretrained(output_dir)
+
+    dummy = tokenizer(["Chiến dịch Điện Biên Phủ"], return_tensors='pt')
+    fp32_path = os.path.join(output_dir, 'model.onnx')
+    print(f"Đang export {model_name} sang ONNX: {fp32_path}")
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            (dummy['input_ids'], dummy['attention_mask']),
+            fp32_path,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['last_hidden_state'],
+            dynamic_axes={
+                'input_ids': {0: 'batch', 1: 'sequence'},
+                'attention_mask': {0: 'batch', 1: 'sequence'},
+                'last_hidden_state': {0: 'batch', 1: 'sequence'}
+            },
+            opset_version=opset
+        )
+
+    model_path = fp32_path
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        model_path = os.path.join(output_dir, 'model.int8.onnx')
+        print(f"Đang lượng tử hóa động int8: {model_path}")
+        quantize_dynamic(fp32_path, model_path, weight_type=QuantType.QInt8)
+
+    with open(os.path.join(output_dir, 'onnx_config.json'), 'w', encoding='utf-8') as f:
+        json.dump({'model_name': model_name, 'model_file': os.path.basename(model_path),
+                   'max_seq_length': st_model.max_seq_length}, f)
+    return model_path
+
+
+class OnnxEmbeddingModel:
+    """
+    Model embedding chạy bằng ONNX Runtime (CPU), cùng cách pooling với SentenceTransformer
+    (mean theo attention mask). Dùng thay trực tiếp cho SentenceTransformer ở mọi nơi gọi `model.encode(...)`.
+    """
+
+    def __init__(self, model_dir, num_threads=ONNX_NUM_THREADS, batch_size=ONNX_BATCH_SIZE,
+                 max_seq_length=None):
+        """
+        Args:
+            model_dir (str): Thư mục do `export_onnx_model` tạo ra.
+            num_threads (int): Số thread intra-op của ONNX Runtime (0 = tự chọn).
+            batch_size (int): Kích thước batch mặc định.
+            max_seq_length (int, optional): Số token tối đa mỗi câu (mặc định theo model gốc).
+        """
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(model_dir, 'onnx_config.json'), 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        self.model_name = config['model_name']
+        self.store_name = embedding_model_key(self.model_name, 'onnx')
+        self.max_seq_length = max_seq_length or config.get('max_seq_length') or ONNX_MAX_SEQ_LENGTH
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(os.path.join(model_dir, config['model_file']), options,
+                                            providers=['CPUExecutionProvider'])
+        print(f"Đã load model embedding ONNX: {os.path.join(model_dir, config['model_file'])}")
+
+    def _encode_batch(self, sentences):
+        encoded = self.tokenizer(sentences, padding=True, truncation=True, max_length=self.max_seq_length,
+                                 return_tensors='np')
+        attention_mask = encoded['attention_mask'].astype(np.int64)
+        last_hidden_state = self.session.run(None, {
+            'input_ids': encoded['input_ids'].astype(np.int64),
+            'attention_mask': attention_mask
+        })[0]
+        mask = attention_mask[..., None].astype(np.float32)
+        return (last_hidden_state * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+    def encode(self, sentences, show_progress_bar=False, batch_size=None, normalize_embeddings=False, **kwargs):
+        """Giống SentenceTransformer.encode (numpy float32): chuỗi đơn trả về vector 1 chiều."""
+        if isinstance(sentences, str):
+            return self.encode([sentences], show_progress_bar, batch_size, normalize_embeddings)[0]
+        sentences = list(sentences)
+        batch_size = batch_size or self.batch_size
+        embeddings = np.zeros((len(sentences), 0), dtype=np.float32)
+        if not sentences:
+            return embeddings
+
+        # Sắp theo độ dài để mỗi batch ít padding, trả kết quả theo thứ tự ban đầu
+        order = np.argsort([-len(sentence) for sentence in sentences], kind='stable')
+        for start in range(0, len(order), batch_size):
+            batch_indices = order[start:start + batch_size]
+            batch_embeddings = self._encode_batch([sentences[i] for i in batch_indices])
+            if embeddings.shape[1] == 0:
+                embeddings = np.zeros((len(sentences), batch_embeddings.shape[1]), dtype=np.float32)
+            embeddings[batch_indices] = batch_embeddings
+        if normalize_embeddings:
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings
+
+
+# Tên kho embedding của model đã load trong process (None nếu chưa load model nào)
+_active_store_name = None
+
+
+def active_embedding_model_key(model_name):
+    """
+    Tên kho embedding của model thực sự đang dùng: sau khi backend ONNX lỗi và quay về SentenceTransformer
+    thì là kho của PyTorch, không phải kho suy ra từ EMBEDDING_BACKEND.
+    """
+    return _active_store_name or embedding_model_key(model_name)
+
+
+def load_embedding_model(model_name, backend=EMBEDDING_BACKEND):
+    """
+    Load model embedding theo cấu hình: 'onnx' dùng model ONNX int8 (export lần đầu nếu chưa có),
+    lỗi thì quay về SentenceTransformer. Model trả về có `store_name` là tên kho embedding của nó.
+    """
+    global _active_store_name
+    model = None
+    if backend == 'onnx':
+        model_dir = onnx_model_dir(model_name)
+        try:
+            if not os.path.exists(os.path.join(model_dir, 'onnx_config.json')):
+                export_onnx_model(model_name, model_dir)
+            model = OnnxEmbeddingModel(model_dir)
+        except Exception as e:
+            print(f"Không dùng được backend ONNX ({e}), quay về SentenceTransformer")
+    if model is None:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name)
+        model.store_name = embedding_model_key(model_name, 'torch')
+    _active_store_name = model.store_name
+    return model
+
+
+def validate_onnx_embeddings(model_name, sentences, model_dir=None, batch_size=ONNX_BATCH_SIZE):
+    """
+    So sánh embedding của model ONNX với PyTorch trên cùng tập câu.
+
+    Returns:
+        dict: cosine trung bình/nhỏ nhất/phân vị 1%, tỉ lệ top-1 láng giềng gần nhất trùng khớp, thời gian nhúng.
+    """
+    import time
+    from sentence_transformers import SentenceTransformer
+
+    torch_model = SentenceTransformer(model_name, device='cpu')
+    onnx_model = OnnxEmbeddingModel(model_dir or onnx_model_dir(model_name), batch_size=batch_size)
+
+    start = time.time()
+    torch_embeddings = np.asarray(torch_model.encode(sentences, batch_size=batch_size), dtype=np.float32)
+    torch_seconds = time.time() - start
+    start = time.time()
+    onnx_embeddings = onnx_model.encode(sentences, batch_size=batch_size)
+    onnx_seconds = time.time() - start
+
+    def normalize(x):
+        return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+    torch_embeddings, onnx_embeddings = normalize(torch_embeddings), normalize(onnx_embeddings)
+    cosines = (torch_embeddings * onnx_embeddings).sum(axis=1)
+
+    # Láng giềng gần nhất (bỏ chính nó) có giữ nguyên sau khi lượng tử hóa không
+    neighbor_agreement = None
+    if len(sentences) > 1:
+        torch_sim = torch_embeddings @ torch_embeddings.T
+        onnx_sim = onnx_embeddings @ onnx_embeddings.T
+        np.fill_diagonal(torch_sim, -np.inf)
+        np.fill_diagonal(onnx_sim, -np.inf)
+        neighbor_agreement = float(np.mean(torch_sim.argmax(axis=1) == onnx_sim.argmax(axis=1)))
+
+    return {
+        'n_sentences': len(sentences),
+        'cosine_mean': float(cosines.mean()),
+        'cosine_min': float(cosines.min()),
+        'cosine_p01': float(np.percentile(cosines, 1)),
+        'top1_neighbor_agreement': neighbor_agreement,
+        'torch_seconds': round(torch_seconds, 3),
+        'onnx_seconds': round(onnx_seconds, 3)
+    }
+
+
+if __name__ == '__main__':
+    # Sử dụng: python OnnxEmbedding.py export
+    #          python OnnxEmbedding.py validate <file văn bản, mỗi dòng một đoạn>
+    from EmbeddingStore import EMBEDDING_MODEL_NAME
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'export'
+    if command == 'export':
+        print(export_onnx_model(EMBEDDING_MODEL_NAME))
+    elif command == 'validate':
+        with open(sys.argv[2], 'r', encoding='utf-8') as f:
+            corpus = [line.strip() for line in f if line.strip()]
+        print(json.dumps(validate_onnx_embeddings(EMBEDDING_MODEL_NAME, corpus), indent=4))
+    else:
+        print(f"Lệnh không hợp lệ: {command} (export | validate <file>)")
@@ -1,14 +1,54 @@
 from PIL import Image
 import fitz
 import numpy as np
-
-def summary_paragraph(client, paragraph):
-    system_prompt = '''
+import os
+import multiprocessing
+import bisect
+from concurrent.futures import ProcessPoolExecutor
+from LLMBackend import LLM_MODEL
+from LLMCache import cached_chat_completion
+
+# Số trang tối đa được giữ ảnh trong bộ nhớ cùng lúc khi xử lý PDF
+PAGE_WINDOW_SIZE = int(os.getenv('PDF_PAGE_WINDOW_SIZE', '2'))
+# 'layout': luôn dùng YOLO, 'native': đọc trực tiếp text layer và chỉ dùng YOLO khi cần
+PDF_EXTRACTION_MODE = os.getenv('PDF_EXTRACTION_MODE', 'layout')
+# Số trang mỗi lần gọi YOLO predict (để trống: tự chọn theo bộ nhớ khả dụng)
+LAYOUT_BATCH_SIZE = int(os.getenv('LAYOUT_BATCH_SIZE', '0')) or None
+LAYOUT_MAX_BATCH_SIZE = int(os.getenv('LAYOUT_MAX_BATCH_SIZE', '8'))
+# Ước lượng bộ nhớ cần cho một ảnh khi YOLO chạy ở imgsz=1024 trên CPU
+LAYOUT_MB_PER_IMAGE = float(os.getenv('LAYOUT_MB_PER_IMAGE', '400'))
+# Số thread intra-op của torch (để trống: giữ mặc định của torch)
+TORCH_NUM_THREADS = int(os.getenv('TORCH_NUM_THREADS', '0')) or None
+# Số process xử lý trang song song (1: xử lý tuần tự trong process hiện tại)
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', '1'))
+LAYOUT_MODEL_PATH = os.getenv('LAYOUT_MODEL_PATH', "model/model_detect_layout/doclayout_yolo_docstructbench_imgsz1024.pt")
+
+# Tỷ lệ chiều cao ký tự bị bỏ qua ở mép trên/dưới khi cắt văn bản theo bounding box
+CHAR_VERTICAL_INSET = 0.2
+# Dòng mới nằm cùng hàng hoặc thấp hơn dòng trước dưới ngưỡng này (tính theo cỡ chữ) thì MuPDF nối vào khối hiện tại
+LINE_JOIN_DISTANCE = 1.5
+
+# Trạng thái riêng của mỗi worker process (document và model được mở một lần cho mỗi worker)
+_pdf_worker_state = {}
+
+SUMMARY_SYSTEM_PROMPT = '''
             Bạn là chuyên giao trong việc tóm tắt ngắn gọn các văn bản lịch sử.
             Hãy tóm tắt ngắn gọn đoạn văn được cung cấp nhưng tuyệt đối không được làm mất đi các thông tin lịch sử quan trọng.
             '''
-    response = client.chat.completions.create(
-            model='gpt-4o-mini',
+
+KEYWORD_SYSTEM_PROMPT = '''
+              Bạn là chuyên gia trong việc trích xuất từ khóa cho thông tin lịch sử.
+              Hãy tìm ra một từ/cụm từ khóa có thể thể hiện tổng quát nội dung cốt lõi của đoạn văn.
+              YÊU CẦU:
+              Chỉ cung cấp từ khóa, không đưa thông tin gì thêm.
+              '''
+
+def summary_paragraph(client, paragraph):
+    system_prompt = SUMMARY_SYSTEM_PROMPT
+    return cached_chat_completion(
+            client,
+            'summary_paragraph',
+            model=LLM_MODEL,
             temperature=0,
 
         messages=[
@@ -22,17 +62,13 @@ def summary_paragraph(client, paragraph):
             }
             ]
         )
-    return response.choices[0].message.content
 
 def extract_key_word(client, summary):
-    system_prompt = '''
-              Bạn là chuyên gia trong việc trích xuất từ khóa cho thông tin lịch sử.
-              Hãy tìm ra một từ/cụm từ khóa có thể thể hiện tổng quát nội dung cốt lõi của đoạn văn.
-              YÊU CẦU:
-              Chỉ cung cấp từ khóa, không đưa thông tin gì thêm.
-              '''
-    response = client.chat.completions.create(
-            model='gpt-4o-mini',
+    system_prompt = KEYWORD_SYSTEM_PROMPT
+    return cached_chat_completion(
+            client,
+            'extract_key_word',
+            model=LLM_MODEL,
             temperature=0,
 
         messages=[
@@ -46,11 +82,66 @@ def extract_key_word(client, summary):
             }
             ]
         )
-    return response.choices[0].message.content
+
+def iter_pdf_page_images(documents, dpi=300):
+    """
+    Chuyển đổi lần lượt từng trang của file PDF sang PIL Image (generator).
+    Chỉ trang đang được yêu cầu mới được render, không giữ lại toàn bộ tài liệu.
+    Args:
+        documents (fitz.Document): Đối tượng PDF.
+        dpi (int): Độ phân giải khi render trang.
+    Yields:
+        dict: Dictionary chứa 'image' (PIL Image) và 'page_index' của trang.
+    """
+    for page_index in range(len(documents)):
+        yield {
+            "image": render_page_image(documents[page_index], page_index, dpi),
+            "page_index": page_index
+        }
+
+def render_page_image(page, page_index, dpi=300):
+    """Render một trang fitz.Page thành PIL Image."""
+    pix = page.get_pixmap(dpi=dpi)
+    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    del pix
+    print(f"  - Đã chuyển đổi trang {page_index}")
+    return img
+
+def iter_pdf_page_data(documents, extraction_mode=PDF_EXTRACTION_MODE, dpi=300, page_indices=None):
+    """
+    Sinh dữ liệu từng trang cho pipeline xử lý PDF.
+    Ở chế độ 'native', trang có text layer dùng được sẽ không bị render thành ảnh;
+    các trang còn lại (không có text layer hoặc bố cục không rõ ràng) sẽ được render để chạy YOLO.
+    Args:
+        documents (fitz.Document): Đối tượng PDF.
+        extraction_mode (str): 'layout' hoặc 'native'.
+        dpi (int): Độ phân giải khi render trang.
+        page_indices (list, optional): Chỉ xử lý các trang này (mặc định: toàn bộ tài liệu).
+    Yields:
+        dict: 'page_index' và 'native_blocks' (chế độ native) hoặc 'image' (PIL Image).
+    """
+    if page_indices is None:
+        page_indices = range(len(documents))
+    for page_index in page_indices:
+        page = documents[page_index]
+        page_data = {"page_index": page_index}
+        if extraction_mode == 'native':
+            # Chỉ mục văn bản được dùng lại cho YOLO nếu trang phải fallback
+            page_data["text_index"] = PageTextIndex(page)
+            native_blocks = extract_native_page_blocks(page_data["text_index"], page_index)
+            if native_blocks is not None:
+                page_data["native_blocks"] = native_blocks
+                yield page_data
+                continue
+            print(f"  - Trang {page_index} không dùng được text layer, chuyển sang YOLO")
+
+        page_data["image"] = render_page_image(page, page_index, dpi)
+        yield page_data
 
 def pdf_to_images(documents):
     """
     Chuyển đổi từng trang của file PDF sang định dạng PIL Image.
+    Lưu ý: giữ toàn bộ ảnh trong bộ nhớ, với file lớn nên dùng `iter_pdf_page_images`.
     Args:
         documents (fitz.Document): Đối tượng PDF.
     Returns:
@@ -59,18 +150,55 @@ def pdf_to_images(documents):
     """
 
     doc_images = []
-    for page_index, page in enumerate(documents):
-        pix = page.get_pixmap(dpi=300)
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        doc_images.append({
-            "image": img,
-            "page_index": page_index,
-            "page": page
-        })
-        print(f"  - Đã chuyển đổi trang {page_index}")
+    for page_data in iter_pdf_page_images(documents):
+        page_data["page"] = documents[page_data["page_index"]]
+        doc_images.append(page_data)
 
     return doc_images
 
+def iter_page_windows(page_iterator, window_size=PAGE_WINDOW_SIZE):
+    """
+    Gom các trang từ một iterator thành từng cửa sổ nhỏ có kích thước cố định.
+    Args:
+        page_iterator: Iterator sinh ra dict của từng trang.
+        window_size (int): Số trang tối đa trong một cửa sổ.
+    Yields:
+        list: Danh sách tối đa `window_size` trang liên tiếp.
+    """
+    window_size = max(1, int(window_size))
+    window = []
+    for page_data in page_iterator:
+        window.append(page_data)
+        if len(window) >= window_size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+def release_page_data(page_data):
+    """Giải phóng ảnh của một trang ngay sau khi đã trích xuất xong paragraphs."""
+    image = page_data.pop("image", None)
+    if image is not None:
+        image.close()
+    page_data.clear()
+
+def get_current_rss_mb():
+    """
+    Lấy dung lượng bộ nhớ thường trú (RSS) hiện tại của process, đơn vị MB.
+    Dùng psutil nếu có, nếu không thì đọc /proc/self/statm. Trả về 0.0 nếu không đo được.
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError, IndexError):
+        return 0.0
+
 def detect_layout(model_detect_layout, pil_image_obj):
     """
     Phát hiện bố cục trên một PIL Image bằng model YOLOv10.
@@ -89,6 +217,80 @@ def detect_layout(model_detect_layout, pil_image_obj):
               )
     return results[0]
 
+def configure_torch_threads(num_threads=TORCH_NUM_THREADS):
+    """Đặt số thread intra-op cho torch (dùng khi YOLO chạy trên CPU)."""
+    if not num_threads:
+        return
+    try:
+        import torch
+        torch.set_num_threads(int(num_threads))
+        print(f"  - Torch intra-op threads: {int(num_threads)}")
+    except ImportError:
+        print("  ⚠ Không tìm thấy torch, bỏ qua cấu hình số thread")
+
+def get_available_memory_mb():
+    """
+    Lấy dung lượng bộ nhớ còn khả dụng của hệ thống, đơn vị MB.
+    Dùng psutil nếu có, nếu không thì đọc MemAvailable trong /proc/meminfo. Trả về None nếu không đo được.
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().available / (1024 * 1024)
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def choose_layout_batch_size(max_batch_size=LAYOUT_MAX_BATCH_SIZE, mb_per_image=LAYOUT_MB_PER_IMAGE, memory_fraction=0.5):
+    """
+    Chọn số trang cho mỗi lần gọi YOLO dựa trên bộ nhớ khả dụng.
+    Args:
+        max_batch_size (int): Giới hạn trên của batch.
+        mb_per_image (float): Bộ nhớ ước lượng cho một ảnh (MB).
+        memory_fraction (float): Tỷ lệ bộ nhớ khả dụng được phép dùng cho inference.
+    Returns:
+        int: Kích thước batch, tối thiểu là 1.
+    """
+    available_mb = get_available_memory_mb()
+    if available_mb is None:
+        return 1
+    batch_size = int(available_mb * memory_fraction // mb_per_image)
+    return max(1, min(max_batch_size, batch_size))
+
+def detect_layout_batch(model_detect_layout, pil_images, batch_size=None):
+    """
+    Phát hiện bố cục cho nhiều trang, mỗi lần gọi predict xử lý tối đa `batch_size` ảnh.
+    Args:
+        model_detect_layout: Model Doclayout-yolo
+        pil_images (list): List các PIL Image theo thứ tự trang.
+        batch_size (int, optional): Số ảnh mỗi lần predict. Mặc định chọn theo bộ nhớ khả dụng.
+    Returns:
+        list: Kết quả YOLOv10 tương ứng với từng ảnh, cùng thứ tự với `pil_images`.
+    """
+    if not pil_images:
+        return []
+    batch_size = batch_size or choose_layout_batch_size()
+
+    layout_results = []
+    for start in range(0, len(pil_images), batch_size):
+        batch = pil_images[start:start + batch_size]
+        results = model_detect_layout.predict(
+                      batch,             # Danh sách ảnh của batch
+                      imgsz=1024,        # Prediction image size
+                      conf=0.3,          # Confidence threshold
+                      device="cpu"    # Device to use (e.g., 'cuda:0' or 'cpu')
+                  )
+        if len(results) != len(batch):
+            raise RuntimeError(f"YOLO trả về {len(results)} kết quả cho batch {len(batch)} ảnh")
+        layout_results.extend(results)
+    return layout_results
+
 def sort_bboxes_top_to_bottom_left_to_right(boxes, row_tolerance=15):
     """
     Sắp xếp các bounding box theo thứ tự từ trên xuống dưới, từ trái sang phải.
@@ -123,9 +325,153 @@ def recognize_text_from_image(reader, img_array_or_pil_image):
     results = reader.readtext(img_array_or_pil_image, detail=0)
     return results
 
+class PageTextIndex:
+    """
+    Chỉ mục văn bản của một trang PDF, được xây dựng từ một lần gọi `page.get_text('rawdict')`.
+    Các dòng được sắp theo y0 để tìm những dòng giao với một bounding box bằng tìm kiếm nhị phân,
+    sau đó lọc theo từng ký tự (giống cách `clip` của PyMuPDF hoạt động),
+    thay vì gọi lại `get_text` với `clip` cho từng box.
+    """
+
+    def __init__(self, page):
+        """
+        Args:
+            page (fitz.Page): Trang PDF cần lập chỉ mục.
+        """
+        self.page_rect = page.rect
+        self.blocks = []  # Các khối chữ theo thứ tự trong PDF
+        self.lines = []   # Các dòng, sắp xếp theo y0
+        for block in page.get_text('rawdict')['blocks']:
+            if block.get('type') != 0:
+                continue
+            block_lines = []
+            for line in block['lines']:
+                if not line['spans']:
+                    continue
+                line_info = {
+                    'block_no': len(self.blocks),
+                    'line_no': len(block_lines),
+                    'bbox': line['bbox'],
+                    'font': line['spans'][0]['font'],
+                    'flags': line['spans'][0].get('flags', 0),
+                    # Mỗi span: (font, size, [(x0, y0, x1, y1, ký tự), ...])
+                    'spans': [(span['font'], span['size'], [(*char['bbox'], char['c']) for char in span['chars']])
+                              for span in line['spans']]
+                }
+                block_lines.append(line_info)
+            if block_lines:
+                self.blocks.append({'bbox': block['bbox'], 'lines': block_lines})
+                self.lines.extend(block_lines)
+
+        self.lines.sort(key=lambda line: line['bbox'][1])
+        self._line_tops = [line['bbox'][1] for line in self.lines]
+        self._max_line_height = max((line['bbox'][3] - line['bbox'][1] for line in self.lines), default=0.0)
+
+    def query_lines(self, rect):
+        """
+        Lấy các dòng giao với `rect` (tọa độ PDF).
+        Returns:
+            list: Các dòng, sắp xếp theo (block_no, line_no).
+        """
+        x1, y1, x2, y2 = rect
+        lo = bisect.bisect_left(self._line_tops, y1 - self._max_line_height)
+        hi = bisect.bisect_right(self._line_tops, y2)
+        found = []
+        for line in self.lines[lo:hi]:
+            lx1, ly1, lx2, ly2 = line['bbox']
+            if lx1 < x2 and x1 < lx2 and ly1 < y2 and y1 < ly2:
+                found.append(line)
+        found.sort(key=lambda line: (line['block_no'], line['line_no']))
+        return found
+
+    @staticmethod
+    def _clip_spans(line, rect=None):
+        """
+        Cắt các span của dòng theo `rect`: chỉ giữ ký tự giao với vùng.
+        Returns:
+            list: Các tuple (font, size, text) của span còn ký tự sau khi cắt.
+        """
+        clipped = []
+        for font, size, chars in line['spans']:
+            if rect is None:
+                text = ''.join(char[4] for char in chars)
+            else:
+                x1, y1, x2, y2 = rect
+                # Thu hẹp bbox ký tự theo chiều dọc để bỏ qua ký tự của dòng bên cạnh chỉ chạm mép vùng
+                text = ''.join(c for cx1, cy1, cx2, cy2, c in chars
+                               if cx1 < x2 and x1 < cx2
+                               and cy1 + CHAR_VERTICAL_INSET * (cy2 - cy1) < y2
+                               and y1 < cy2 - CHAR_VERTICAL_INSET * (cy2 - cy1))
+            if text:
+                clipped.append((font, size, text))
+        return clipped
+
+    @staticmethod
+    def _line_text(line, rect=None):
+        """Ghép text của các span trong dòng, chỉ lấy ký tự giao với `rect` nếu được truyền vào."""
+        return ''.join(text for _, _, text in PageTextIndex._clip_spans(line, rect))
+
+    def text_in_rect(self, rect):
+        """
+        Trả về (label, text) cho một vùng, tương đương `get_text('dict'/'blocks', clip=rect)`:
+        label là 'title' nếu có dòng bắt đầu bằng font đậm/nghiêng, text là khối chữ đầu tiên trong vùng.
+        """
+        label = ''
+        block_lines = []
+        previous = None
+        first_block_done = False
+        for line in self.query_lines(rect):
+            spans = self._clip_spans(line, rect)
+            if not spans:
+                continue
+            if _is_title_font(spans[0][0]):
+                label = 'title'
+            if first_block_done:
+                continue
+            # Khi cắt theo vùng, MuPDF dựng lại khối từ các dòng còn lại theo thứ tự trong PDF: dòng của khối khác
+            # vẫn được nối vào nếu cùng hàng hoặc ngay bên dưới dòng trước (vd. hai tiêu đề cùng hàng ở hai cột)
+            if previous is not None and line['block_no'] != previous['block_no']:
+                baseline_shift = line['bbox'][3] - previous['bbox'][3]
+                if not -0.5 * previous_size < baseline_shift < LINE_JOIN_DISTANCE * previous_size:
+                    first_block_done = True
+                    continue
+            block_lines.append(''.join(text for _, _, text in spans))
+            previous, previous_size = line, spans[0][1]
+
+        if not block_lines:
+            return label, ''
+        return label, '\n'.join(block_lines) + '\n'
+
+    def blocks_in_reading_order(self):
+        """Các khối chữ sắp xếp theo thứ tự đọc (trên xuống dưới, trái sang phải)."""
+        return sorted(self.blocks, key=lambda block: (int(block['bbox'][1]), int(block['bbox'][0])))
+
+def recognize_text_from_page_index(text_index, bbox, dpi=300):
+    """
+    Trích xuất văn bản trong một bounding box (tọa độ ảnh) bằng chỉ mục văn bản của trang.
+
+    Args:
+        text_index (PageTextIndex): Chỉ mục văn bản của trang.
+        bbox (list hoặc tuple): Bounding box dưới dạng [x1, y1, x2, y2], đây là tọa độ hình ảnh
+        dpi (int): DPI của ảnh đã dùng để phát hiện bố cục.
+
+    Returns:
+        tuple: (label, text). label là 'title' nếu vùng chứa font đậm/nghiêng, text rỗng nếu không tìm thấy.
+    """
+    # chuyển sang tọa độ hình ảnh sang tọa độ PDF
+    # 300 DPI = 300/72 = 4.167 pixels per point
+    scale = dpi / 72
+    rect = [coord / scale for coord in bbox]
+
+    label_2, text = text_index.text_in_rect(rect)
+    text = text.replace('.\n', '.#')
+    text = text.replace('\n', ' ')
+    return label_2, text
+
 def recognize_text_from_pymupdf_page(docs, page_index, bbox):
     """
     Trích xuất văn bản từ một trang PyMuPDF trong một vùng (bounding box) nhất định.
+    Khi xử lý nhiều box trên cùng một trang, nên tạo `PageTextIndex` một lần và dùng `recognize_text_from_page_index`.
 
     Args:
         docs (fitz.Document): Đối tượng PDF.
@@ -135,43 +481,157 @@ def recognize_text_from_pymupdf_page(docs, page_index, bbox):
     Returns:
         str: Văn bản được trích xuất từ vùng đã cho. Trả về chuỗi rỗng nếu không tìm thấy text.
     """
-    label_2 = ''
     try:
-
-        # chuyển sang tọa độ hình ảnh sang tọa độ PDF
-        # 300 DPI = 300/72 = 4.167 pixels per point
-
-        scale = 300/72
-        # Tạo một fitz.Rect từ bounding box
-        x1, y1, x2, y2 = [coord / scale for coord in bbox]
-
-        # Tạo clip rect và trích xuất text
-        clip_rect = fitz.Rect(x1, y1, x2, y2)
-        pymupdf_page = docs[page_index]
-        block = pymupdf_page.get_text('dict',clip= clip_rect)
-        for spans in block['blocks']:
-          for line in spans['lines']:
-              font = line['spans'][0]['font']
-              if 'BoldMT' in font or 'BoldItalicMT' in font or 'ItalicMT' in font:
-                  label_2 = 'title'
-        block = pymupdf_page.get_text('blocks', clip = clip_rect)
-        text = block[0][4]
-        text = text.replace('.\n','.#')
-        text = text.replace('\n',' ')
-
-        return label_2, text
+        return recognize_text_from_page_index(PageTextIndex(docs[page_index]), bbox)
 
     except Exception as e:
         print(f"  ❌ Lỗi khi trích xuất text từ PyMuPDF: {str(e)}")
         return '', "" # Trả về chuỗi rỗng nếu có lỗi
 
 
+def _is_title_font(font, flags=0):
+    """Kiểm tra font của span có phải đậm/nghiêng (dấu hiệu của tiêu đề) hay không."""
+    if 'BoldMT' in font or 'BoldItalicMT' in font or 'ItalicMT' in font:
+        return True
+    # Bit 1: nghiêng, bit 4: đậm (theo quy ước flags của PyMuPDF)
+    return bool(flags & 2) or bool(flags & 16)
+
+def _weighted_median(values, weights):
+    """Trung vị có trọng số, dùng để ước lượng cỡ chữ của phần thân văn bản."""
+    order = np.argsort(values)
+    values = np.asarray(values, dtype=float)[order]
+    cumulative = np.cumsum(np.asarray(weights, dtype=float)[order])
+    return float(values[np.searchsorted(cumulative, cumulative[-1] / 2)])
+
+def extract_native_page_blocks(text_index, page_index, min_chars=50, margin_ratio=0.07,
+                               footnote_ratio=0.25, max_overlap_ratio=0.2, max_garbage_ratio=0.05):
+    """
+    Trích xuất paragraphs, tiêu đề và vùng 'abandon' (header/footer) trực tiếp từ
+    dữ liệu block/span/font của text layer mà không cần chạy YOLO.
+
+    Args:
+        text_index (PageTextIndex): Chỉ mục văn bản của trang.
+        page_index (int): Index của trang.
+        min_chars (int): Số ký tự tối thiểu để coi là trang có text layer.
+        margin_ratio (float): Tỷ lệ chiều cao trang ở đầu/cuối được coi là vùng header/footer.
+        footnote_ratio (float): Vùng cuối trang mà khối chữ nhỏ hơn thân bài được coi là chú thích.
+        max_overlap_ratio (float): Tỷ lệ khối chồng lấn tối đa trước khi coi bố cục là không rõ ràng.
+        max_garbage_ratio (float): Tỷ lệ ký tự lỗi tối đa trong text layer.
+
+    Returns:
+        list hoặc None: List các dict {'type', 'full_text', 'page_index', 'is_title'} theo thứ tự đọc.
+                        Trả về None nếu trang không có text layer hoặc bố cục không rõ ràng,
+                        khi đó cần dùng YOLO.
+    """
+    page_height = text_index.page_rect.height
+
+    blocks = []
+    sizes, size_weights = [], []
+    total_chars = 0
+    garbage_chars = 0
+    for block in text_index.blocks_in_reading_order():
+        lines_text = []
+        is_title = False
+        block_sizes = []
+        for line in block['lines']:
+            if _is_title_font(line['font'], line['flags']):
+                is_title = True
+            lines_text.append(PageTextIndex._line_text(line))
+            for _, span_size, span_text in PageTextIndex._clip_spans(line):
+                n_chars = len(span_text.strip())
+                if n_chars:
+                    block_sizes.append(span_size)
+                    sizes.append(span_size)
+                    size_weights.append(n_chars)
+        text = '\n'.join(lines_text) + '\n'
+        if not text.strip():
+            continue
+        total_chars += len(text.strip())
+        garbage_chars += text.count('\ufffd')
+        blocks.append({
+            'bbox': block['bbox'],
+            'text': text,
+            'n_lines': len(lines_text),
+            'is_title': is_title,
+            'size': max(block_sizes) if block_sizes else 0.0
+        })
+
+    # Không có text layer dùng được -> fallback YOLO
+    if total_chars < min_chars or garbage_chars > max_garbage_ratio * total_chars:
+        return None
+
+    # Bố cục không rõ ràng: nhiều khối chữ chồng lên nhau
+    overlapping = 0
+    for i, a in enumerate(blocks):
+        for b in blocks[i + 1:]:
+            if a['bbox'][0] < b['bbox'][2] and b['bbox'][0] < a['bbox'][2] \
+                    and a['bbox'][1] < b['bbox'][3] and b['bbox'][1] < a['bbox'][3]:
+                overlapping += 1
+                break
+    if len(blocks) > 1 and overlapping > max_overlap_ratio * len(blocks):
+        return None
+
+    body_size = _weighted_median(sizes, size_weights)
+
+    native_blocks = []
+    for block in blocks:
+        x1, y1, x2, y2 = block['bbox']
+        in_margin = y2 <= page_height * margin_ratio or y1 >= page_height * (1 - margin_ratio)
+        is_footnote = y1 >= page_height * (1 - footnote_ratio) and block['size'] < body_size * 0.95
+        if (in_margin and block['n_lines'] == 1) or is_footnote:
+            label = 'abandon'
+        elif block['is_title'] or block['size'] >= body_size * 1.15:
+            label = 'title'
+        else:
+            label = 'plain text'
+
+        native_blocks.append({
+            'type': label,
+            'full_text': block['text'].replace('.\n', '.#').replace('\n', ' '),
+            'page_index': page_index,
+            'is_title': label == 'title'
+        })
+    return native_blocks
+
+def process_native_page(pdf_page_data, continue_index):
+    """
+    Tạo paragraphs cho một trang đã được trích xuất bằng text layer (chế độ native).
+    Args:
+        pdf_page_data (dict): Dictionary chứa 'native_blocks' và 'page_index'.
+        continue_index (int): Index tiếp tục từ lần xử lý trước
+    Returns:
+        tuple: (continue_index, processed_paragraphs)
+    """
+    page_index = pdf_page_data["page_index"]
+    print(f"\n--- Xử lý trang (text layer): {page_index} ---")
+
+    processed_paragraphs = []
+    for block in pdf_page_data["native_blocks"]:
+        if block['type'] == 'abandon':
+            print(f"      Bỏ qua do là chú thích")
+            continue
+        continue_index += 1
+        processed_paragraphs.append({
+            'type': block['type'],
+            'full_text': block['full_text'],
+            'page_index': page_index,
+            'parent_index': -1,
+            'index': continue_index,
+            'is_title': block['is_title']
+        })
+
+    print(f"\n  >>> Hoàn thành xử lý trang {page_index}: {len(processed_paragraphs)} paragraphs")
+    return continue_index, processed_paragraphs
+
+
 def process_pdf_page(docs, model_detect_layout, pdf_page_data, continue_index):
     """
     Xử lý một trang PDF: phát hiện bố cục và nhận dạng văn bản.
     Args:
         model_detect_layout: model Doclayout_yolo
         pdf_page_data (dict): Dictionary chứa 'image' (PIL Image) và 'page_index'.
+                              Nếu có key 'layout_results' (từ `detect_layout_batch`) thì dùng lại, không gọi YOLO nữa.
+                              Nếu có key 'text_index' (PageTextIndex) thì dùng lại, không đọc lại text layer.
         continue_index (int): Index tiếp tục từ lần xử lý trước
     Returns:
         tuple: (continue_index, processed_paragraphs, page_results)
@@ -182,7 +642,9 @@ def process_pdf_page(docs, model_detect_layout, pdf_page_data, continue_index):
     print(f"\n--- Xử lý trang: {page_index} ---")
 
     # 1. Phát hiện bố cục
-    layout_results = detect_layout(model_detect_layout, pil_image)
+    layout_results = pdf_page_data.get("layout_results")
+    if layout_results is None:
+        layout_results = detect_layout(model_detect_layout, pil_image)
     processed_paragraphs = []
 
     print("\n  >>> Kết quả phát hiện bố cục:")
@@ -195,6 +657,10 @@ def process_pdf_page(docs, model_detect_layout, pdf_page_data, continue_index):
     sorted_boxes = sort_bboxes_top_to_bottom_left_to_right(layout_results.boxes)
 
     print(f"    Tìm thấy {len(sorted_boxes)} đối tượng bố cục")
+    # Lập chỉ mục văn bản của trang một lần cho tất cả các box
+    text_index = pdf_page_data.get("text_index")
+    if text_index is None:
+        text_index = PageTextIndex(docs[page_index])
     lable_2 = ''
     # 3. Xử lý từng box theo thứ tự đã sắp xếp
     for i, box in enumerate(sorted_boxes):
@@ -216,13 +682,8 @@ def process_pdf_page(docs, model_detect_layout, pdf_page_data, continue_index):
         continue_index += 1
 
         try:
-            # Cắt ảnh theo bbox
-            image_cut = pil_image.crop((x1, y1, x2, y2))
-            img_np = np.array(image_cut)
-
             # 4. Nhận dạng văn bản
-            # recognized_text_results = recognize_text_from_image(reader, img_np)
-            lable_from_pymupdf, recognized_text_results = recognize_text_from_pymupdf_page(docs, page_index, bbox)
+            lable_from_pymupdf, recognized_text_results = recognize_text_from_page_index(text_index, bbox)
 
             # 5. Tạo thông tin paragraph
             if recognized_text_results:
@@ -253,42 +714,202 @@ def process_pdf_page(docs, model_detect_layout, pdf_page_data, continue_index):
     return continue_index, processed_paragraphs
 
 
-def process_full_pdf(model_detect_layout, reader, pdf_path):
+def iter_pdf_paragraphs(documents, model_detect_layout, window_size=PAGE_WINDOW_SIZE, memory_stats=None,
+                        extraction_mode=PDF_EXTRACTION_MODE, layout_batch_size=LAYOUT_BATCH_SIZE, page_indices=None):
+    """
+    Pipeline dạng generator: render -> phát hiện bố cục -> trích xuất văn bản.
+    Chỉ giữ tối đa `window_size` ảnh trang trong bộ nhớ, ảnh được giải phóng
+    ngay sau khi paragraphs của trang đó được sinh ra.
+    Args:
+        documents (fitz.Document): Đối tượng PDF.
+        model_detect_layout: model Doclayout_yolo
+        window_size (int): Số trang tối đa được giữ ảnh cùng lúc.
+        memory_stats (dict, optional): Nếu truyền vào, key 'peak_rss_mb' sẽ được cập nhật.
+        extraction_mode (str): 'layout' (luôn dùng YOLO) hoặc 'native' (ưu tiên text layer).
+        layout_batch_size (int, optional): Số trang mỗi lần gọi YOLO. Mặc định chọn theo bộ nhớ khả dụng.
+        page_indices (list, optional): Chỉ xử lý các trang này (mặc định: toàn bộ tài liệu).
+    Yields:
+        tuple: (page_index, page_paragraphs)
+    """
+    total_pages = len(documents)
+    continue_index = 0
+    layout_batch_size = layout_batch_size or choose_layout_batch_size()
+    # Batch YOLO không vượt quá cửa sổ trang để giữ nguyên giới hạn bộ nhớ của `window_size`
+    layout_batch_size = max(1, min(layout_batch_size, window_size))
+    print(f"📦 Batch phát hiện bố cục: {layout_batch_size} trang, cửa sổ: {window_size} trang")
+
+    page_iterator = iter_pdf_page_data(documents, extraction_mode, page_indices=page_indices)
+    for window in iter_page_windows(page_iterator, window_size):
+        # Phát hiện bố cục theo batch cho các trang cần YOLO, ánh xạ kết quả về từng trang
+        image_pages = [page_data for page_data in window if "image" in page_data]
+        try:
+            batch_results = detect_layout_batch(model_detect_layout,
+                                                [page_data["image"] for page_data in image_pages],
+                                                layout_batch_size)
+            for page_data, layout_results in zip(image_pages, batch_results):
+                page_data["layout_results"] = layout_results
+        except Exception as e:
+            print(f"❌ Lỗi khi phát hiện bố cục theo batch, chuyển sang từng trang: {str(e)}")
+
+        for page_data in window:
+            page_index = page_data["page_index"]
+            print(f"\n📖 Đang xử lý trang {page_index + 1}/{total_pages}...")
+            page_paragraphs = []
+            try:
+                # Xử lý trang và nhận kết quả
+                if "native_blocks" in page_data:
+                    continue_index, page_paragraphs = process_native_page(page_data, continue_index)
+                else:
+                    continue_index, page_paragraphs = process_pdf_page(documents, model_detect_layout, page_data, continue_index)
+                print(f"✅ Hoàn thành trang {page_index + 1}: {len(page_paragraphs)} paragraphs")
+
+            except Exception as e:
+                print(f"❌ Lỗi khi xử lý trang {page_index + 1}: {str(e)}")
+
+            if memory_stats is not None:
+                memory_stats['peak_rss_mb'] = max(memory_stats.get('peak_rss_mb', 0.0), get_current_rss_mb())
+            release_page_data(page_data)
+
+            yield page_index, page_paragraphs
+
+def renumber_paragraphs(paragraphs):
+    """
+    Đánh lại 'index' của các paragraph theo thứ tự xuất hiện, bắt đầu từ 1
+    (giống cách `continue_index` được tăng dần khi xử lý tuần tự).
+    """
+    for position, paragraph in enumerate(paragraphs, 1):
+        paragraph['index'] = position
+    return paragraphs
+
+def split_page_shards(total_pages, workers, shards_per_worker=4):
+    """
+    Chia các trang thành các shard gồm những trang liên tiếp.
+    Mỗi worker nhận nhiều shard nhỏ để cân bằng tải khi số paragraph mỗi trang khác nhau.
+    Returns:
+        list: List các list page_index, theo thứ tự trang.
+    """
+    n_shards = max(1, min(total_pages, workers * shards_per_worker))
+    return [shard.tolist() for shard in np.array_split(np.arange(total_pages), n_shards) if len(shard)]
+
+def _init_pdf_worker(pdf_path, layout_model_path, torch_threads):
+    """Khởi tạo worker: mở document và load model phát hiện bố cục riêng cho process này."""
+    configure_torch_threads(torch_threads)
+    _pdf_worker_state['documents'] = fitz.open(pdf_path)
+    from doclayout_yolo import YOLOv10
+    _pdf_worker_state['model'] = YOLOv10(layout_model_path)
+
+def _process_page_shard(page_indices, window_size, extraction_mode, layout_batch_size):
+    """
+    Xử lý một shard trang trong worker process.
+    Returns:
+        tuple: (page_index đầu tiên, paragraphs của shard, pid, peak RSS của worker)
+    """
+    memory_stats = {'peak_rss_mb': get_current_rss_mb()}
+    shard_paragraphs = []
+    for _, page_paragraphs in iter_pdf_paragraphs(_pdf_worker_state['documents'], _pdf_worker_state['model'],
+                                                  window_size, memory_stats, extraction_mode,
+                                                  layout_batch_size, page_indices):
+        shard_paragraphs.extend(page_paragraphs)
+    return page_indices[0], shard_paragraphs, os.getpid(), memory_stats['peak_rss_mb']
+
+def process_full_pdf_parallel(pdf_path, workers=PDF_WORKERS, layout_model_path=LAYOUT_MODEL_PATH,
+                              window_size=PAGE_WINDOW_SIZE, extraction_mode=PDF_EXTRACTION_MODE,
+                              layout_batch_size=LAYOUT_BATCH_SIZE, torch_threads=TORCH_NUM_THREADS):
+    """
+    Xử lý PDF song song: chia các trang thành shard và phân phối cho một process pool.
+    Mỗi worker tự mở `fitz.Document` và model phát hiện bố cục của riêng nó.
+    Kết quả được ghép lại theo thứ tự trang và đánh lại index, nên giống hệt cách xử lý tuần tự.
+    Args:
+        pdf_path (str): Đường dẫn đến file PDF.
+        workers (int): Số worker process.
+        layout_model_path (str): Đường dẫn file trọng số Doclayout-yolo để mỗi worker tự load.
+        torch_threads (int, optional): Số thread torch cho mỗi worker (mặc định: số core / số worker).
+    Returns:
+        dict: Dictionary chứa tất cả kết quả xử lý và thống kê (cùng định dạng với `process_full_pdf`)
+    """
+    print(f"\n🚀 Bắt đầu xử lý PDF song song ({workers} worker): {pdf_path}")
+    with fitz.open(pdf_path) as documents:
+        total_pages = len(documents)
+    print(f"📄 Tổng số trang: {total_pages}")
+
+    if torch_threads is None:
+        torch_threads = max(1, (os.cpu_count() or 1) // workers)
+    # Batch nhỏ hơn để tổng bộ nhớ của các worker vẫn nằm trong giới hạn
+    if layout_batch_size is None:
+        layout_batch_size = max(1, choose_layout_batch_size() // workers)
+
+    shards = split_page_shards(total_pages, workers)
+    shard_results = []
+    worker_peaks = {}
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_pdf_worker,
+                             initargs=(pdf_path, layout_model_path, torch_threads)) as executor:
+        futures = [executor.submit(_process_page_shard, shard, window_size, extraction_mode, layout_batch_size)
+                   for shard in shards]
+        for future in futures:
+            first_page, shard_paragraphs, pid, peak_rss_mb = future.result()
+            shard_results.append((first_page, shard_paragraphs))
+            worker_peaks[pid] = max(worker_peaks.get(pid, 0.0), peak_rss_mb)
+
+    # Ghép kết quả theo thứ tự trang rồi đánh lại index
+    all_paragraphs = []
+    for _, shard_paragraphs in sorted(shard_results, key=lambda result: result[0]):
+        all_paragraphs.extend(shard_paragraphs)
+    renumber_paragraphs(all_paragraphs)
+
+    peak_rss_mb = get_current_rss_mb() + sum(worker_peaks.values())
+    print(f"📊 Peak RSS khi xử lý {pdf_path}: {peak_rss_mb:.1f} MB (tổng {len(worker_peaks)} worker)")
+
+    return {
+        "pdf_path": pdf_path,
+        "total_pages": total_pages,
+        "total_paragraphs": len(all_paragraphs),
+        "all_paragraphs": all_paragraphs,
+        "peak_rss_mb": peak_rss_mb,
+    }
+
+def process_full_pdf(model_detect_layout, reader, pdf_path, window_size=PAGE_WINDOW_SIZE,
+                     extraction_mode=PDF_EXTRACTION_MODE, layout_batch_size=LAYOUT_BATCH_SIZE,
+                     torch_threads=TORCH_NUM_THREADS, workers=PDF_WORKERS, layout_model_path=LAYOUT_MODEL_PATH):
     """
     Xử lý toàn bộ file PDF: chuyển đổi, phát hiện bố cục và nhận dạng văn bản từng trang.
+    Các trang được xử lý theo dạng luồng (streaming), bộ nhớ bị chặn bởi `window_size`.
     Args:
         pdf_path (str): Đường dẫn đến file PDF.
+        window_size (int): Số trang tối đa được giữ ảnh trong bộ nhớ cùng lúc.
+        extraction_mode (str): 'layout' (luôn dùng YOLO) hoặc 'native' (đọc text layer,
+                               chỉ dùng YOLO cho trang không có text layer/bố cục không rõ ràng).
+        layout_batch_size (int, optional): Số trang mỗi lần gọi YOLO, mặc định chọn theo bộ nhớ khả dụng.
+        torch_threads (int, optional): Số thread intra-op của torch.
+        workers (int): Nếu > 1, xử lý song song bằng `process_full_pdf_parallel`.
+        layout_model_path (str): Đường dẫn trọng số YOLO cho các worker khi chạy song song.
     Returns:
         dict: Dictionary chứa tất cả kết quả xử lý và thống kê
     """
+    if workers and workers > 1:
+        return process_full_pdf_parallel(pdf_path, workers, layout_model_path, window_size,
+                                         extraction_mode, layout_batch_size, torch_threads)
+
     print(f"\n🚀 Bắt đầu xử lý PDF: {pdf_path}")
+    configure_torch_threads(torch_threads)
     documents = fitz.open(pdf_path)
-    # Chuyển đổi PDF thành ảnh
-    all_page_images = pdf_to_images(documents)
-    total_pages = len(all_page_images)
+    total_pages = len(documents)
     print(f"📄 Tổng số trang: {total_pages}")
 
     # Khởi tạo kết quả
-
     all_paragraphs = []
-    continue_index = 0
-
-    # Xử lý từng trang
-    for i, page_data in enumerate(all_page_images, 1):
-        print(f"\n📖 Đang xử lý trang {i}/{total_pages}...")
-
-        try:
-            # Xử lý trang và nhận kết quả
-            continue_index, page_paragraphs = process_pdf_page(documents, model_detect_layout, page_data, continue_index)
+    memory_stats = {'peak_rss_mb': get_current_rss_mb()}
 
+    try:
+        for _, page_paragraphs in iter_pdf_paragraphs(documents, model_detect_layout, window_size,
+                                                      memory_stats, extraction_mode, layout_batch_size):
             # Thêm paragraphs vào danh sách tổng
             all_paragraphs.extend(page_paragraphs)
+    finally:
+        documents.close()
 
-            print(f"✅ Hoàn thành trang {i}: {len(page_paragraphs)} paragraphs")
-
-        except Exception as e:
-            print(f"❌ Lỗi khi xử lý trang {i}: {str(e)}")
-
+    print(f"📊 Peak RSS khi xử lý {pdf_path}: {memory_stats['peak_rss_mb']:.1f} MB")
 
     # Tạo thống kê tổng quan
     total_paragraphs = len(all_paragraphs)
@@ -297,6 +918,7 @@ def process_full_pdf(model_detect_layout, reader, pdf_path):
         "total_pages": total_pages,
         "total_paragraphs": total_paragraphs,
         "all_paragraphs": all_paragraphs,
+        "peak_rss_mb": memory_stats['peak_rss_mb'],
     }
 
 def merge_short_paragraphs(pdf_result_all_paragraphs, n_word=200):
@@ -5,6 +5,80 @@ from sklearn.decomposition import PCA
 from sklearn.metrics.pairwise import cosine_similarity
 import matplotlib.pyplot as plt
 import numpy as np
+import hashlib
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from scipy.cluster.hierarchy import cut_tree, linkage
+from threadpoolctl import threadpool_limits
+
+# Số process chạy song song các lần fit K-Means của phương pháp Elbow (1 = tuần tự)
+ELBOW_N_JOBS = int(os.getenv('ELBOW_N_JOBS', '1'))
+# Số đoạn văn (lấy mẫu) được tìm đoạn ít tương đồng nhất khi ước lượng độ tương đồng nhỏ nhất
+COHESION_MIN_QUERIES = int(os.getenv('COHESION_MIN_QUERIES', '2000'))
+
+_elbow_executor = None
+_elbow_executor_workers = 0
+_elbow_executor_lock = threading.Lock()
+
+
+def _fit_minibatch_inertia(embeddings, num_clusters, random_state, n_init, max_iter):
+    """
+    Một lần fit của phương pháp Elbow (dùng chung cho chạy tuần tự và song song). Luôn chạy BLAS/OpenMP
+    một thread: cùng cấu hình thread thì thứ tự cộng dấu phẩy động giống nhau, nên hai cách chạy
+    cho kết quả trùng khớp; mỗi worker song song cũng không tranh CPU với các worker khác.
+    """
+    mb_kmeans = MiniBatchKMeans(
+        n_clusters=num_clusters,
+        random_state=random_state,
+        n_init=n_init,
+        max_iter=max_iter,
+        batch_size=256 # Kích thước lô xử lý, có thể điều chỉnh
+    )
+    with threadpool_limits(limits=1):
+        mb_kmeans.fit(embeddings)
+    return mb_kmeans.inertia_
+
+
+def _elbow_worker(shm_name, shape, dtype, num_clusters, random_state, n_init, max_iter):
+    """Chạy trong worker process: đọc ma trận embedding từ shared memory (không copy) và fit một giá trị k."""
+    # Worker (spawn) dùng chung resource tracker với process chính, process chính giải phóng vùng nhớ
+    shm = shared_memory.SharedMemory(name=shm_name)
+    embeddings = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    try:
+        return _fit_minibatch_inertia(embeddings, num_clusters, random_state, n_init, max_iter)
+    finally:
+        # Bỏ tham chiếu tới buffer trước khi đóng vùng nhớ
+        del embeddings
+        shm.close()
+
+
+def _shutdown_elbow_executor():
+    global _elbow_executor
+    with _elbow_executor_lock:
+        if _elbow_executor is not None:
+            _elbow_executor.shutdown(wait=False, cancel_futures=True)
+            _elbow_executor = None
+
+
+def _get_elbow_executor(n_jobs):
+    """Pool process dùng lại giữa các vòng phân cụm (tạo lại nếu số worker thay đổi)."""
+    global _elbow_executor, _elbow_executor_workers
+    with _elbow_executor_lock:
+        if _elbow_executor is not None and _elbow_executor_workers != n_jobs:
+            _elbow_executor.shutdown(wait=True)
+            _elbow_executor = None
+        if _elbow_executor is None:
+            print(f"Khởi tạo {n_jobs} worker cho phương pháp Elbow")
+            _elbow_executor = ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn'))
+            _elbow_executor_workers = n_jobs
+        return _elbow_executor
+
+
+atexit.register(_shutdown_elbow_executor)
 
 class ParagraphClusterer:
     """
@@ -13,15 +87,18 @@ class ParagraphClusterer:
     và trực quan hóa kết quả phân cụm bằng PCA.
     """
 
-    def __init__(self, model_embedding):
+    def __init__(self, model_embedding, embedding_cache=None):
         """
         Khởi tạo ParagraphClusterer với một mô hình S-BERT.
 
         Args:
             model_name (str): Tên của mô hình S-BERT để sử dụng.
                               (Ví dụ: 'paraphrase-multilingual-MiniLM-L12-v2')
+            embedding_cache (dict, optional): Kho vector trong bộ nhớ theo hash nội dung đoạn văn,
+                              dùng khi văn bản đại diện thay đổi giữa các vòng (chỉ nhúng đoạn chưa có).
         """
         self.model = model_embedding
+        self.embedding_cache = embedding_cache
         self.paragraphs = []
         self.keywords = []
         self.paragraph_embeddings = None
@@ -30,12 +107,33 @@ class ParagraphClusterer:
         self.kmeans_model = None
         self.num_clusters = 0
 
-    def embed_paragraphs(self, paragraphs: list, keywords: list):
+    @staticmethod
+    def _text_hash(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _encode_with_cache(self, paragraphs):
+        """Nhúng các đoạn văn, chỉ gọi model cho những đoạn chưa có trong `embedding_cache`."""
+        hashes = [self._text_hash(paragraph) for paragraph in paragraphs]
+        missing = {}
+        for text_hash, paragraph in zip(hashes, paragraphs):
+            if text_hash not in self.embedding_cache and text_hash not in missing:
+                missing[text_hash] = paragraph
+        if missing:
+            print(f"Đang nhúng {len(missing)}/{len(paragraphs)} đoạn văn chưa có trong cache...")
+            new_embeddings = self.model.encode(list(missing.values()), show_progress_bar=True)
+            for text_hash, embedding in zip(missing, new_embeddings):
+                self.embedding_cache[text_hash] = embedding
+        return np.array([self.embedding_cache[text_hash] for text_hash in hashes])
+
+    def embed_paragraphs(self, paragraphs: list, keywords: list, source_indices: list = None):
         """
         Nhúng (embed) danh sách các đoạn văn thành vector số sử dụng S-BERT.
 
         Args:
             paragraphs (list): Một list các chuỗi (đoạn văn).
+            source_indices (list, optional): Vị trí của từng đoạn văn trong danh sách của lần nhúng trước
+                              (ví dụ `represent_index` của các cụm vòng trước). Khi có, vector được lấy lại
+                              từ ma trận đã tính thay vì nhúng lại.
         """
         if not paragraphs:
             print("Danh sách đoạn văn rỗng. Không thể nhúng.")
@@ -45,10 +143,26 @@ class ParagraphClusterer:
             self.normalized_embeddings = None
             return
 
+        if source_indices is not None and self.normalized_embeddings is not None:
+            if len(source_indices) != len(paragraphs):
+                raise ValueError(f"source_indices có {len(source_indices)} phần tử, "
+                                 f"nhưng có {len(paragraphs)} đoạn văn.")
+            # Các đoạn văn của vòng này là một tập con của vòng trước: cắt lại ma trận đã có
+            source_indices = np.asarray(source_indices, dtype=np.intp)
+            self.paragraphs = paragraphs
+            self.keywords = keywords
+            self.paragraph_embeddings = self.paragraph_embeddings[source_indices]
+            self.normalized_embeddings = self.normalized_embeddings[source_indices]
+            print(f"Dùng lại vector của {len(paragraphs)} đoạn văn từ vòng trước.")
+            return
+
         self.paragraphs = paragraphs
         self.keywords = keywords
         print("Đang nhúng các đoạn văn thành vector...")
-        self.paragraph_embeddings = self.model.encode(paragraphs, show_progress_bar=True)
+        if self.embedding_cache is not None:
+            self.paragraph_embeddings = self._encode_with_cache(paragraphs)
+        else:
+            self.paragraph_embeddings = self.model.encode(paragraphs, show_progress_bar=True)
         # Chuẩn hóa vector ngay sau khi nhúng để sử dụng cho K-Means với cosine affinity
         self.normalized_embeddings = normalize(self.paragraph_embeddings, axis=1)
         print("Hoàn tất nhúng và chuẩn hóa vector.")
@@ -151,10 +265,57 @@ class ParagraphClusterer:
                 "ID_of_cluster": cluster_id,
                 "index_from_list_paragraph": paragraph_indices_in_cluster,
                 "represent": self.paragraphs[representative_paragraph_index],
+                "represent_index": int(representative_paragraph_index),
                 "keyword": self.keywords[representative_paragraph_index]
             })
         return results
 
+    def mean_pairwise_similarity(self) -> float:
+        """Cosine trung bình chính xác giữa mọi cặp đoạn văn: (||Σx||² - Σ||x||²) / (n(n-1)), O(n·d)."""
+        embeddings = self.normalized_embeddings
+        n_paragraphs = len(embeddings)
+        summed = embeddings.sum(axis=0, dtype=np.float64)
+        squared_norms = np.einsum('ij,ij->', embeddings, embeddings, dtype=np.float64)
+        return float((summed @ summed - squared_norms) / (n_paragraphs * (n_paragraphs - 1)))
+
+    def _farthest_similarities(self, queries: np.ndarray, chunk_size: int = 1024) -> np.ndarray:
+        """
+        Với mỗi đoạn trong `queries`, cosine với đoạn ít tương đồng nhất (top-1 theo tích vô hướng với -x),
+        tính theo từng khối `chunk_size` dòng nên bộ nhớ chỉ O(chunk_size·n).
+        """
+        embeddings = self.normalized_embeddings
+        farthest = np.empty(len(queries), dtype=np.float64)
+        for start in range(0, len(queries), chunk_size):
+            rows = queries[start:start + chunk_size]
+            similarities = embeddings[rows] @ embeddings.T
+            similarities[np.arange(len(rows)), rows] = np.inf  # bỏ cặp một đoạn với chính nó
+            farthest[start:start + len(rows)] = similarities.min(axis=1)
+        return farthest
+
+    def cohesion_statistics(self, with_min: bool = True, max_queries: int = COHESION_MIN_QUERIES,
+                            chunk_size: int = 1024, random_state: int = 42):
+        """
+        Độ tương đồng cosine trung bình và nhỏ nhất giữa các cặp đoạn văn mà không dựng ma trận n x n.
+
+        - Trung bình: chính xác theo `mean_pairwise_similarity`, O(n·d).
+        - Nhỏ nhất (chỉ khi `with_min`): tìm đoạn ít tương đồng nhất của tối đa `max_queries` đoạn lấy mẫu,
+          O(max_queries·n·d). Khi n > max_queries kết quả là cận trên của min thật.
+
+        Returns:
+            tuple: (trung bình, nhỏ nhất hoặc None) hoặc (None, None) nếu chưa đủ 2 đoạn văn.
+        """
+        if self.normalized_embeddings is None or len(self.normalized_embeddings) < 2:
+            return None, None
+        avg_similarity = self.mean_pairwise_similarity()
+        if not with_min:
+            return avg_similarity, None
+
+        n_paragraphs = len(self.normalized_embeddings)
+        queries = np.arange(n_paragraphs)
+        if max_queries is not None and n_paragraphs > max_queries:
+            queries = np.sort(np.random.default_rng(random_state).choice(n_paragraphs, max_queries, replace=False))
+        return avg_similarity, float(self._farthest_similarities(queries, chunk_size).min())
+
     def calculate_average_cosine_similarity(self):
         """
         Tính toán độ tương đồng cosine trung bình của mỗi cụm.
@@ -232,7 +393,8 @@ class ParagraphClusterer:
         plt.grid(True)
         plt.show()
 
-    def find_optimal_clusters_elbow(self, k_range: range, random_state: int = 42, n_init='auto', max_iter: int = 300):
+    def find_optimal_clusters_elbow(self, k_range: range, random_state: int = 42, n_init='auto', max_iter: int = 300,
+                                    n_jobs: int = ELBOW_N_JOBS):
         """
         Tìm số cụm tối ưu bằng phương pháp Elbow (WCSS - Inertia)
         sử dụng MiniBatchKMeans.
@@ -242,6 +404,8 @@ class ParagraphClusterer:
             random_state (int): Hạt giống cho khả năng tái tạo của K-Means.
             n_init (int or 'auto'): Số lần chạy K-Means với các hạt giống centroid khác nhau.
             max_iter (int): Số lần lặp tối đa của thuật toán K-Means.
+            n_jobs (int): Số process fit song song các giá trị k (ma trận embedding dùng chung qua
+                          shared memory). Kết quả giống hệt khi chạy tuần tự.
 
         Returns:
             list: Một list các giá trị WCSS (inertia) tương ứng với mỗi k.
@@ -258,24 +422,17 @@ class ParagraphClusterer:
                 print("Phạm vi k không hợp lệ sau khi điều chỉnh.")
                 return []
 
-
-        inertias = []
+        # Bỏ qua k=0 vì không hợp lệ, không thể có số cụm nhiều hơn số điểm
+        k_values = [k for k in k_range if 0 < k <= len(self.normalized_embeddings)]
         print(f"Đang chạy MiniBatchKMeans để tìm k tối ưu qua phương pháp Elbow (kiểm tra k từ {k_range.start} đến {k_range.stop - 1})...")
-        for k in k_range:
-            if k == 0: continue # Bỏ qua k=0 vì không hợp lệ
-            if k > len(self.normalized_embeddings): # Không thể có số cụm nhiều hơn số điểm
-                break
-
-            mb_kmeans = MiniBatchKMeans(
-                n_clusters=k,
-                random_state=random_state,
-                n_init=n_init,
-                max_iter=max_iter,
-                batch_size=256 # Kích thước lô xử lý, có thể điều chỉnh
-            )
-            mb_kmeans.fit(self.normalized_embeddings)
-            inertias.append(mb_kmeans.inertia_)
-            print(f"  Đã tính WCSS cho k={k}: {mb_kmeans.inertia_:.2f}")
+
+        if n_jobs > 1 and len(k_values) > 1:
+            inertias = self._find_inertias_parallel(k_values, random_state, n_init, max_iter, n_jobs)
+        else:
+            inertias = [_fit_minibatch_inertia(self.normalized_embeddings, k, random_state, n_init, max_iter)
+                        for k in k_values]
+        for k, inertia in zip(k_values, inertias):
+            print(f"  Đã tính WCSS cho k={k}: {inertia:.2f}")
 
         # # Vẽ biểu đồ Elbow
         # plt.figure(figsize=(10, 6))
@@ -289,3 +446,191 @@ class ParagraphClusterer:
 
         return inertias
 
+    def _find_inertias_parallel(self, k_values, random_state, n_init, max_iter, n_jobs):
+        """Fit các giá trị k trên nhiều process; ma trận embedding được đặt một lần vào shared memory."""
+        embeddings = np.ascontiguousarray(self.normalized_embeddings)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, embeddings.nbytes))
+        try:
+            np.ndarray(embeddings.shape, dtype=embeddings.dtype, buffer=shm.buf)[:] = embeddings
+            executor = _get_elbow_executor(n_jobs)
+            # Gửi k lớn (fit lâu hơn) trước để các worker xong gần cùng lúc
+            futures = {k: executor.submit(_elbow_worker, shm.name, embeddings.shape, embeddings.dtype.str,
+                                          k, random_state, n_init, max_iter)
+                       for k in sorted(k_values, reverse=True)}
+            return [futures[k].result() for k in k_values]
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def _extend_centers(self, centers: np.ndarray, num_clusters: int, random_state: int = 42) -> np.ndarray:
+        """
+        Tạo `num_clusters` tâm khởi tạo ấm từ tâm của một lần fit khác:
+        - nhiều tâm hơn cần: lần lượt gộp cặp tâm gần nhau nhất (trung bình theo số điểm của mỗi tâm);
+        - ít tâm hơn cần: giữ các tâm sẵn có và chọn thêm điểm theo xác suất tỉ lệ với bình phương
+          khoảng cách tới tâm gần nhất (như k-means++).
+        """
+        embeddings = self.normalized_embeddings
+        centers = np.asarray(centers, dtype=embeddings.dtype)
+        if len(centers) > num_clusters:
+            assignments = np.argmax(embeddings @ centers.T - 0.5 * np.einsum('ij,ij->i', centers, centers), axis=1)
+            centers = [center for center in centers]
+            weights = list(np.bincount(assignments, minlength=len(centers)).astype(float))
+            while len(centers) > num_clusters:
+                stacked = np.vstack(centers)
+                squared_norms = np.einsum('ij,ij->i', stacked, stacked)
+                pair_distances = squared_norms[:, None] + squared_norms[None, :] - 2 * stacked @ stacked.T
+                np.fill_diagonal(pair_distances, np.inf)
+                first, second = sorted(np.unravel_index(np.argmin(pair_distances), pair_distances.shape))
+                total_weight = weights[first] + weights[second]
+                if total_weight > 0:
+                    centers[first] = (weights[first] * centers[first] + weights[second] * centers[second]) / total_weight
+                else:
+                    centers[first] = (centers[first] + centers[second]) / 2
+                weights[first] += weights[second]
+                del centers[second], weights[second]
+            return np.vstack(centers)
+        if len(centers) == num_clusters:
+            return centers.copy()
+        rng = np.random.default_rng(random_state)
+        min_distances = np.full(len(embeddings), np.inf)
+        if len(centers):
+            # ||x - c||² = ||x||² + ||c||² - 2x·c (không tạo mảng n x k x d)
+            squared_distances = (np.einsum('ij,ij->i', embeddings, embeddings)[:, None]
+                                 + np.einsum('ij,ij->i', centers, centers)[None, :]
+                                 - 2 * embeddings @ centers.T)
+            min_distances = np.maximum(squared_distances.min(axis=1), 0)
+        new_centers = [centers]
+        for _ in range(num_clusters - len(centers)):
+            total = min_distances.sum()
+            if np.isfinite(total) and total > 0:
+                chosen = int(rng.choice(len(embeddings), p=min_distances / total))
+            else:
+                chosen = int(rng.integers(len(embeddings)))
+            new_centers.append(embeddings[chosen:chosen + 1])
+            min_distances = np.minimum(min_distances, ((embeddings - embeddings[chosen]) ** 2).sum(axis=1))
+        return np.vstack(new_centers)
+
+    def fit_kmeans_inertia(self, num_clusters: int, init_centers: np.ndarray = None, random_state: int = 42,
+                           n_init='auto', max_iter: int = 300):
+        """
+        Chạy MiniBatchKMeans cho một giá trị k và trả về (inertia, tâm cụm).
+        Có `init_centers` (tâm của một lần fit trước) thì khởi tạo ấm từ đó, chỉ cần một lần khởi tạo.
+        """
+        init = 'k-means++'
+        if init_centers is not None:
+            init = self._extend_centers(init_centers, num_clusters, random_state)
+            n_init = 1
+        mb_kmeans = MiniBatchKMeans(
+            n_clusters=num_clusters,
+            init=init,
+            random_state=random_state,
+            n_init=n_init,
+            max_iter=max_iter,
+            batch_size=256
+        )
+        mb_kmeans.fit(self.normalized_embeddings)
+        return mb_kmeans.inertia_, mb_kmeans.cluster_centers_
+
+    def find_optimal_clusters_hierarchy(self, k_range: range, method: str = 'ward'):
+        """
+        Tính đường cong WCSS theo k từ MỘT cây phân cấp (agglomerative) thay vì chạy K-Means cho từng k.
+
+        - 'ward': mỗi lần gộp hai cụm làm WCSS tăng đúng d²/2 (d là khoảng cách Ward của scipy),
+          nên WCSS(k) là tổng các mức tăng của n-k lần gộp đầu tiên.
+        - 'average': liên kết trung bình theo cosine, cắt cây ở mọi k bằng `cut_tree` rồi tính WCSS
+          của từng cách chia quanh tâm cụm.
+
+        Args:
+            k_range (range): Các giá trị k cần tính.
+            method (str): 'ward' hoặc 'average'.
+
+        Returns:
+            list: Các giá trị WCSS tương ứng với mỗi k (cùng định dạng `find_optimal_clusters_elbow`).
+        """
+        if self.normalized_embeddings is None:
+            print("Chưa có vector đoạn văn nào được nhúng. Vui lòng gọi `embed_paragraphs` trước.")
+            return []
+
+        embeddings = np.asarray(self.normalized_embeddings, dtype=np.float64)
+        n_samples = len(embeddings)
+        k_values = [k for k in k_range if 0 < k <= n_samples]
+        if not k_values:
+            print("Phạm vi k không hợp lệ sau khi điều chỉnh.")
+            return []
+        if n_samples == 1:
+            return [0.0]
+
+        print(f"Đang dựng cây phân cấp ({method}) để tính WCSS cho k từ {k_values[0]} đến {k_values[-1]}...")
+        if method == 'ward':
+            merges = linkage(embeddings, method='ward')
+            # wcss_after_merges[m] = WCSS sau m lần gộp (còn n - m cụm)
+            wcss_after_merges = np.concatenate(([0.0], np.cumsum(merges[:, 2] ** 2 / 2)))
+            inertias = [float(wcss_after_merges[n_samples - k]) for k in k_values]
+        elif method == 'average':
+            merges = linkage(embeddings, method='average', metric='cosine')
+            labels_per_k = cut_tree(merges, n_clusters=k_values)
+            total_norm = float(np.einsum('ij,ij->', embeddings, embeddings))
+            inertias = []
+            for column, k in enumerate(k_values):
+                labels = labels_per_k[:, column]
+                cluster_sums = np.zeros((k, embeddings.shape[1]))
+                np.add.at(cluster_sums, labels, embeddings)
+                counts = np.bincount(labels, minlength=k)
+                # WCSS = Σ||x||² - Σ_c ||Σx_c||² / n_c
+                inertias.append(max(0.0, total_norm - float(np.sum(np.einsum('ij,ij->i', cluster_sums, cluster_sums) / counts))))
+        else:
+            raise ValueError("method phải là 'ward' hoặc 'average'")
+
+        for k, inertia in zip(k_values, inertias):
+            print(f"  WCSS (cây phân cấp) cho k={k}: {inertia:.2f}")
+        return inertias
+
+    def hierarchy_levels(self, branching_factor: int = 4, method: str = 'ward'):
+        """
+        Dựng MỘT cây phân cấp trên các đoạn văn và cắt thành các tầng lồng nhau, mỗi tầng có số cụm
+        bằng khoảng 1/branching_factor số nút của tầng dưới (tầng cuối chỉ còn 1 cụm).
+
+        Args:
+            branching_factor (int): Số nút con trung bình của mỗi nút (>= 2).
+            method (str): 'ward' hoặc 'average' (cosine).
+
+        Returns:
+            tuple: (danh sách số cụm của từng tầng, ma trận nhãn n x số tầng theo từng đoạn văn).
+        """
+        if self.normalized_embeddings is None or len(self.normalized_embeddings) < 2:
+            return [], None
+        if branching_factor < 2:
+            raise ValueError("branching_factor phải >= 2")
+
+        embeddings = np.asarray(self.normalized_embeddings, dtype=np.float64)
+        if method == 'ward':
+            merges = linkage(embeddings, method='ward')
+        elif method == 'average':
+            merges = linkage(embeddings, method='average', metric='cosine')
+        else:
+            raise ValueError("method phải là 'ward' hoặc 'average'")
+
+        level_sizes = []
+        n_nodes = len(embeddings)
+        while n_nodes > 1:
+            n_nodes = -(-n_nodes // branching_factor)
+            level_sizes.append(n_nodes)
+        print(f"Cắt cây phân cấp ({method}) thành {len(level_sizes)} tầng: {level_sizes}")
+        return level_sizes, cut_tree(merges, n_clusters=level_sizes)
+
+    def level_representatives(self, labels: np.ndarray, num_clusters: int) -> np.ndarray:
+        """
+        Chọn đoạn đại diện cho mọi cụm của một tầng trong một lượt: đoạn văn có cosine lớn nhất với
+        tâm (trung bình đã chuẩn hóa) của cụm chứa nó.
+
+        Returns:
+            np.ndarray: Chỉ số đoạn văn đại diện của từng cụm 0..num_clusters-1.
+        """
+        embeddings = self.normalized_embeddings
+        cluster_sums = np.zeros((num_clusters, embeddings.shape[1]), dtype=np.float64)
+        np.add.at(cluster_sums, labels, embeddings)
+        centers = cluster_sums / np.maximum(np.linalg.norm(cluster_sums, axis=1, keepdims=True), 1e-12)
+        scores = np.einsum('ij,ij->i', embeddings, centers[labels])
+        # Sắp theo (cụm, điểm giảm dần): phần tử đầu của mỗi cụm là đại diện
+        order = np.lexsort((-scores, labels))
+        return order[np.searchsorted(labels[order], np.arange(num_clusters))]
@@ -0,0 +1,447 @@
+import asyncio
+import json
+import os
+import re
+from LLMBackend import LLM_MODEL, as_backend
+from LLMCache import cached_chat_completion, cached_chat_completion_async
+from PDF_Processor import SUMMARY_SYSTEM_PROMPT, KEYWORD_SYSTEM_PROMPT, summary_paragraph, extract_key_word
+
+# Số request LLM tối đa chạy đồng thời khi làm giàu (tóm tắt + từ khóa) các đoạn văn
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '8'))
+# 'async': gọi LLM song song bằng asyncio, 'sequential': gọi lần lượt như cũ,
+# 'structured': song song và chỉ một request JSON trả về cả tóm tắt lẫn từ khóa cho mỗi đoạn,
+# 'packed': gộp nhiều đoạn vào một request (theo ngân sách token), đoạn bị thiếu được gọi lại riêng
+LLM_ENRICHMENT_MODE = os.getenv('LLM_ENRICHMENT_MODE', 'async')
+# Số lần gọi lại khi LLM trả về JSON không hợp lệ
+STRUCTURED_ENRICHMENT_RETRIES = int(os.getenv('STRUCTURED_ENRICHMENT_RETRIES', '2'))
+# Ngân sách token (phần đoạn văn đầu vào) và số đoạn tối đa cho mỗi request ở chế độ 'packed'
+PACKED_ENRICHMENT_TOKEN_BUDGET = int(os.getenv('PACKED_ENRICHMENT_TOKEN_BUDGET', '3000'))
+PACKED_ENRICHMENT_MAX_ITEMS = int(os.getenv('PACKED_ENRICHMENT_MAX_ITEMS', '16'))
+# Ước lượng số ký tự/token khi không có tiktoken (tiếng Việt có dấu thường ~3 ký tự/token)
+CHARS_PER_TOKEN = 3
+
+STRUCTURED_ENRICHMENT_SYSTEM_PROMPT = '''
+            Bạn là chuyên gia trong việc tóm tắt và trích xuất từ khóa cho các văn bản lịch sử.
+            Với đoạn văn được cung cấp, hãy:
+            - Tóm tắt ngắn gọn đoạn văn nhưng tuyệt đối không được làm mất đi các thông tin lịch sử quan trọng.
+            - Tìm ra một từ/cụm từ khóa có thể thể hiện tổng quát nội dung cốt lõi của đoạn văn.
+            YÊU CẦU:
+            Chỉ trả về JSON đúng định dạng sau, không đưa thông tin gì thêm:
+            {"summary": "<bản tóm tắt>", "keyword": "<từ khóa>"}
+            '''
+
+PACKED_ENRICHMENT_SYSTEM_PROMPT = '''
+            Bạn là chuyên gia trong việc tóm tắt và trích xuất từ khóa cho các văn bản lịch sử.
+            Bạn sẽ nhận nhiều đoạn văn, mỗi đoạn bắt đầu bằng số thứ tự dạng [1], [2], ...
+            Với TỪNG đoạn văn, hãy:
+            - Tóm tắt ngắn gọn đoạn văn nhưng tuyệt đối không được làm mất đi các thông tin lịch sử quan trọng.
+            - Tìm ra một từ/cụm từ khóa có thể thể hiện tổng quát nội dung cốt lõi của đoạn văn.
+            Mỗi đoạn được xử lý độc lập, không trộn thông tin giữa các đoạn.
+            YÊU CẦU:
+            Chỉ trả về JSON đúng định dạng sau, mỗi đoạn văn một phần tử, giữ đúng số thứ tự, không đưa thông tin gì thêm:
+            {"items": [{"id": 1, "summary": "<bản tóm tắt>", "keyword": "<từ khóa>"}, ...]}
+            '''
+
+STRUCTURED_ENRICHMENT_RETRY_MESSAGE = '''
+            Phản hồi trước không phải JSON hợp lệ với hai trường "summary" và "keyword".
+            Hãy trả lời lại, chỉ gồm JSON đúng định dạng yêu cầu.
+            '''
+
+
+def make_async_client(client):
+    """
+    Tạo backend dùng trong event loop từ `client` (LLMBackend hoặc OpenAI client).
+    Với OpenAI, mỗi lần chạy event loop tạo một AsyncOpenAI client riêng để không dùng lại kết nối của loop đã đóng.
+    """
+    return as_backend(client).async_session()
+
+
+async def _chat_completion_async(async_client, semaphore, function_name, system_prompt, content):
+    """Gọi chat completion bất đồng bộ (qua cache LLM), số request đồng thời bị giới hạn bởi `semaphore`."""
+    async with semaphore:
+        return await cached_chat_completion_async(
+            async_client,
+            function_name,
+            model=LLM_MODEL,
+            temperature=0,
+            messages=[
+                {
+                    "role": "system",
+                    "content": system_prompt
+                },
+                {
+                    "role": "user",
+                    "content": content
+                }
+            ]
+        )
+
+
+async def summary_paragraph_async(async_client, semaphore, paragraph):
+    """Phiên bản bất đồng bộ của `summary_paragraph`."""
+    return await _chat_completion_async(async_client, semaphore, 'summary_paragraph', SUMMARY_SYSTEM_PROMPT, paragraph)
+
+
+async def extract_key_word_async(async_client, semaphore, summary):
+    """Phiên bản bất đồng bộ của `extract_key_word`."""
+    return await _chat_completion_async(async_client, semaphore, 'extract_key_word', KEYWORD_SYSTEM_PROMPT, summary)
+
+
+def parse_structured_enrichment(content):
+    """
+    Phân tích và kiểm tra phản hồi JSON {"summary": ..., "keyword": ...}.
+
+    Args:
+        content (str): Nội dung phản hồi của LLM (có thể nằm trong khối ```json).
+
+    Returns:
+        dict: {'summary': str, 'keyword': str}
+
+    Raises:
+        ValueError: Nếu phản hồi không phải JSON hợp lệ hoặc thiếu trường.
+    """
+    if not content:
+        raise ValueError("Phản hồi rỗng")
+    content = re.sub(r'^\s*```(?:json)?\s*|\s*```\s*$', '', content)
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"JSON không hợp lệ: {e}")
+    if not isinstance(data, dict):
+        raise ValueError("Phản hồi không phải JSON object")
+
+    result = {}
+    for field in ('summary', 'keyword'):
+        value = data.get(field)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError(f"Thiếu hoặc sai kiểu trường '{field}'")
+        result[field] = value.strip()
+    return result
+
+
+def _structured_enrichment_messages(paragraph, attempt):
+    """Tạo messages cho request tóm tắt + từ khóa, thêm lời nhắc định dạng khi gọi lại."""
+    messages = [
+        {
+            "role": "system",
+            "content": STRUCTURED_ENRICHMENT_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": paragraph
+        }
+    ]
+    if attempt > 0:
+        messages.append({
+            "role": "user",
+            "content": STRUCTURED_ENRICHMENT_RETRY_MESSAGE
+        })
+    return messages
+
+
+def summarize_and_extract_keyword(client, paragraph, max_retries=STRUCTURED_ENRICHMENT_RETRIES):
+    """
+    Tóm tắt và trích xuất từ khóa cho một đoạn văn trong một request JSON duy nhất.
+    Gọi lại (kèm lời nhắc định dạng) khi phản hồi không hợp lệ; nếu vẫn lỗi,
+    quay về hai lời gọi riêng `summary_paragraph` và `extract_key_word`.
+
+    Returns:
+        dict: {'summary', 'keyword', 'summary_keyword'} (summary_keyword trùng với keyword).
+    """
+    for attempt in range(max_retries + 1):
+        content = cached_chat_completion(
+            client,
+            'summarize_and_extract_keyword',
+            model=LLM_MODEL,
+            temperature=0,
+            validator=parse_structured_enrichment,
+            response_format={"type": "json_object"},
+            messages=_structured_enrichment_messages(paragraph, attempt)
+        )
+        try:
+            result = parse_structured_enrichment(content)
+            return {**result, 'summary_keyword': result['keyword']}
+        except ValueError as e:
+            print(f"  ⚠ Phản hồi tóm tắt/từ khóa không hợp lệ (lần {attempt + 1}): {e}")
+
+    summary = summary_paragraph(client, paragraph)
+    keyword = extract_key_word(client, paragraph)
+    return {'summary': summary, 'keyword': keyword, 'summary_keyword': keyword}
+
+
+async def summarize_and_extract_keyword_async(async_client, semaphore, paragraph,
+                                              max_retries=STRUCTURED_ENRICHMENT_RETRIES):
+    """Phiên bản bất đồng bộ của `summarize_and_extract_keyword`."""
+    for attempt in range(max_retries + 1):
+        async with semaphore:
+            content = await cached_chat_completion_async(
+                async_client,
+                'summarize_and_extract_keyword',
+                model=LLM_MODEL,
+                temperature=0,
+                validator=parse_structured_enrichment,
+                response_format={"type": "json_object"},
+                messages=_structured_enrichment_messages(paragraph, attempt)
+            )
+        try:
+            result = parse_structured_enrichment(content)
+            return {**result, 'summary_keyword': result['keyword']}
+        except ValueError as e:
+            print(f"  ⚠ Phản hồi tóm tắt/từ khóa không hợp lệ (lần {attempt + 1}): {e}")
+
+    summary, keyword = await asyncio.gather(
+        summary_paragraph_async(async_client, semaphore, paragraph),
+        extract_key_word_async(async_client, semaphore, paragraph)
+    )
+    return {'summary': summary, 'keyword': keyword, 'summary_keyword': keyword}
+
+
+_token_encoder = None
+
+
+def count_tokens(text):
+    """
+    Đếm số token của văn bản bằng tiktoken (nếu đã cài), ngược lại ước lượng theo số ký tự.
+    """
+    global _token_encoder
+    if _token_encoder is None:
+        try:
+            import tiktoken
+            _token_encoder = tiktoken.get_encoding('o200k_base')
+        except Exception:
+            _token_encoder = False
+    if _token_encoder:
+        return len(_token_encoder.encode(text))
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def pack_paragraphs(paragraphs, token_budget=PACKED_ENRICHMENT_TOKEN_BUDGET, max_items=PACKED_ENRICHMENT_MAX_ITEMS):
+    """
+    Chia các đoạn văn (giữ nguyên thứ tự) thành các nhóm, mỗi nhóm có tổng số token không vượt
+    `token_budget` và tối đa `max_items` đoạn. Đoạn dài hơn ngân sách được đặt riêng một nhóm.
+
+    Returns:
+        list: Danh sách nhóm, mỗi nhóm là list chỉ số đoạn văn.
+    """
+    batches = []
+    current, current_tokens = [], 0
+    for i, paragraph in enumerate(paragraphs):
+        # Cộng thêm vài token cho nhãn [i] và dòng trống phân cách
+        n_tokens = count_tokens(paragraph) + 4
+        if current and (current_tokens + n_tokens > token_budget or len(current) >= max_items):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += n_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def format_packed_paragraphs(paragraphs):
+    """Đánh số các đoạn văn ([1], [2], ...) và nối lại thành nội dung một request."""
+    return '\n\n'.join(f"[{i}] {paragraph}" for i, paragraph in enumerate(paragraphs, start=1))
+
+
+def parse_packed_enrichment(content, n_items):
+    """
+    Tách phản hồi của một request gộp thành kết quả cho từng đoạn.
+    Chấp nhận {"items": [...]}, một mảng JSON trực tiếp, hoặc object có khóa là số thứ tự;
+    phần tử thiếu/sai định dạng/trùng số thứ tự bị bỏ qua để gọi lại riêng.
+
+    Args:
+        content (str): Nội dung phản hồi của LLM.
+        n_items (int): Số đoạn văn đã gửi.
+
+    Returns:
+        dict: {số thứ tự (1..n_items): {'summary', 'keyword'}}
+
+    Raises:
+        ValueError: Nếu phản hồi không phải JSON hợp lệ hoặc không tách được đoạn nào.
+    """
+    if not content:
+        raise ValueError("Phản hồi rỗng")
+    content = re.sub(r'^\s*```(?:json)?\s*|\s*```\s*$', '', content)
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"JSON không hợp lệ: {e}")
+
+    if isinstance(data, dict):
+        if isinstance(data.get('items'), list):
+            items = data['items']
+        elif all(str(key).strip().isdigit() for key in data):
+            items = [{**value, 'id': key} for key, value in data.items() if isinstance(value, dict)]
+        else:
+            items = next((value for value in data.values() if isinstance(value, list)), [])
+    elif isinstance(data, list):
+        items = data
+    else:
+        items = []
+
+    results = {}
+    for position, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            continue
+        item_id = item.get('id', position if len(items) == n_items else None)
+        try:
+            item_id = int(str(item_id).strip('[] '))
+        except (TypeError, ValueError):
+            continue
+        if not 1 <= item_id <= n_items or item_id in results:
+            continue
+        try:
+            results[item_id] = parse_structured_enrichment(json.dumps(item, ensure_ascii=False))
+        except ValueError:
+            continue
+
+    if not results:
+        raise ValueError("Không tách được kết quả cho đoạn văn nào")
+    return results
+
+
+def is_complete_packed_enrichment(content, n_items):
+    """
+    Validator cho cache của request gộp: chỉ phản hồi có đủ kết quả cho cả `n_items` đoạn mới được lưu/đọc lại,
+    phản hồi thiếu đoạn vẫn được dùng cho lần chạy này nhưng lần sau sẽ gửi lại request gộp.
+    """
+    return len(parse_packed_enrichment(content, n_items)) == n_items
+
+
+async def _enrich_packed_batch_async(async_client, semaphore, paragraphs):
+    """
+    Làm giàu một nhóm đoạn văn bằng một request gộp; đoạn nào thiếu trong phản hồi
+    được gọi lại riêng bằng `summarize_and_extract_keyword_async`.
+    """
+    if len(paragraphs) == 1:
+        return [await summarize_and_extract_keyword_async(async_client, semaphore, paragraphs[0])]
+
+    async with semaphore:
+        content = await cached_chat_completion_async(
+            async_client,
+            'summarize_and_extract_keyword_packed',
+            model=LLM_MODEL,
+            temperature=0,
+            validator=lambda content: is_complete_packed_enrichment(content, len(paragraphs)),
+            response_format={"type": "json_object"},
+            messages=[
+                {
+                    "role": "system",
+                    "content": PACKED_ENRICHMENT_SYSTEM_PROMPT
+                },
+                {
+                    "role": "user",
+                    "content": format_packed_paragraphs(paragraphs)
+                }
+            ]
+        )
+    try:
+        parsed = parse_packed_enrichment(content, len(paragraphs))
+    except ValueError as e:
+        print(f"  ⚠ Phản hồi gộp {len(paragraphs)} đoạn không hợp lệ: {e}")
+        parsed = {}
+
+    missing = [i for i in range(1, len(paragraphs) + 1) if i not in parsed]
+    if missing:
+        print(f"  ↻ Gọi lại riêng {len(missing)}/{len(paragraphs)} đoạn bị thiếu trong phản hồi gộp")
+        retried = await asyncio.gather(*(
+            summarize_and_extract_keyword_async(async_client, semaphore, paragraphs[i - 1]) for i in missing
+        ))
+        for i, result in zip(missing, retried):
+            parsed[i] = result
+
+    return [{**parsed[i], 'summary_keyword': parsed[i]['keyword']} for i in range(1, len(paragraphs) + 1)]
+
+
+async def enrich_paragraphs_packed_async(client, paragraphs, max_concurrency=LLM_MAX_CONCURRENCY,
+                                         token_budget=PACKED_ENRICHMENT_TOKEN_BUDGET,
+                                         max_items=PACKED_ENRICHMENT_MAX_ITEMS):
+    """
+    Làm giàu các đoạn văn theo nhóm: mỗi request chứa nhiều đoạn (tối đa `token_budget` token
+    và `max_items` đoạn), các nhóm chạy song song, tối đa `max_concurrency` request cùng lúc.
+
+    Returns:
+        list: Mỗi phần tử là dict {'summary', 'keyword', 'summary_keyword'}, đúng thứ tự đầu vào.
+    """
+    batches = pack_paragraphs(paragraphs, token_budget, max_items)
+    print(f"  📦 Gộp {len(paragraphs)} đoạn thành {len(batches)} request (ngân sách {token_budget} token)")
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    async with make_async_client(client) as async_client:
+        batch_results = await asyncio.gather(*(
+            _enrich_packed_batch_async(async_client, semaphore, [paragraphs[i] for i in batch])
+            for batch in batches
+        ))
+    return [result for results in batch_results for result in results]
+
+
+async def _enrich_paragraph_async(async_client, semaphore, paragraph):
+    """
+    Làm giàu một đoạn văn: tóm tắt và từ khóa của đoạn gốc chạy song song,
+    từ khóa của bản tóm tắt chạy ngay sau khi có tóm tắt.
+    """
+    async def summarize_then_keyword():
+        summary = await summary_paragraph_async(async_client, semaphore, paragraph)
+        return summary, await extract_key_word_async(async_client, semaphore, summary)
+
+    (summary, summary_keyword), keyword = await asyncio.gather(
+        summarize_then_keyword(),
+        extract_key_word_async(async_client, semaphore, paragraph)
+    )
+    return {
+        'summary': summary,
+        'keyword': keyword,
+        'summary_keyword': summary_keyword
+    }
+
+
+async def enrich_paragraphs_async(client, paragraphs, max_concurrency=LLM_MAX_CONCURRENCY, structured=False):
+    """
+    Làm giàu tất cả các đoạn văn song song, tối đa `max_concurrency` request cùng lúc.
+
+    Args:
+        client: LLMBackend hoặc OpenAI client (đồng bộ).
+        paragraphs (list): Danh sách đoạn văn gốc.
+        max_concurrency (int): Số request LLM đồng thời tối đa.
+        structured (bool): True để dùng một request JSON (tóm tắt + từ khóa) cho mỗi đoạn.
+
+    Returns:
+        list: Mỗi phần tử là dict {'summary', 'keyword', 'summary_keyword'}, đúng thứ tự đầu vào.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    enrich_one = summarize_and_extract_keyword_async if structured else _enrich_paragraph_async
+    async with make_async_client(client) as async_client:
+        # asyncio.gather trả kết quả theo đúng thứ tự các coroutine truyền vào
+        return await asyncio.gather(*(
+            enrich_one(async_client, semaphore, paragraph) for paragraph in paragraphs
+        ))
+
+
+def enrich_paragraphs(client, paragraphs, mode=LLM_ENRICHMENT_MODE, max_concurrency=LLM_MAX_CONCURRENCY):
+    """
+    Tạo tóm tắt, từ khóa của đoạn gốc và từ khóa của bản tóm tắt cho từng đoạn văn.
+
+    Args:
+        client: LLMBackend hoặc OpenAI client.
+        paragraphs (list): Danh sách đoạn văn gốc.
+        mode (str): 'async' (song song), 'structured' (song song, một request JSON cho mỗi đoạn),
+                    'packed' (gộp nhiều đoạn vào một request theo ngân sách token) hoặc 'sequential' (lần lượt).
+        max_concurrency (int): Số request LLM đồng thời tối đa ở các chế độ song song.
+
+    Returns:
+        list: Mỗi phần tử là dict {'summary', 'keyword', 'summary_keyword'}, đúng thứ tự đầu vào.
+    """
+    print(f"🧠 Làm giàu {len(paragraphs)} đoạn văn (chế độ: {mode})")
+    if mode == 'packed':
+        return asyncio.run(enrich_paragraphs_packed_async(client, paragraphs, max_concurrency))
+    if mode in ('async', 'structured'):
+        return asyncio.run(enrich_paragraphs_async(client, paragraphs, max_concurrency, structured=mode == 'structured'))
+
+    enriched = []
+    for paragraph in paragraphs:
+        summary = summary_paragraph(client, paragraph)
+        enriched.append({
+            'summary': summary,
+            'keyword': extract_key_word(client, paragraph),
+            'summary_keyword': extract_key_word(client, summary)
+        })
+    return enriched
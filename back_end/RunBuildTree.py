@@ -2,46 +2,140 @@ from ParagraphClusterer import *
 from ClusteringTreeBuilder import *
 from PDF_Processor import *
 from FindOptimalK import *
-def run_clustering_with_tree_building(client, model_embedding, list_node , clustering_strategy='adaptive'):
+from ParagraphEnrichment import enrich_paragraphs, LLM_ENRICHMENT_MODE, LLM_MAX_CONCURRENCY
+from FaissParagraphClusterer import CLUSTERING_ENGINE, create_paragraph_clusterer
+import os
+import numpy as np
+
+# --- Cấu hình dựng cây ---
+# 'rounds': phân cụm lại từng vòng trên các đoạn đại diện; 'linkage': cắt một cây phân cấp duy nhất thành các tầng
+TREE_MODE = os.getenv('TREE_MODE', 'rounds')
+# Số nút con trung bình của mỗi nút khi TREE_MODE='linkage'
+TREE_BRANCHING_FACTOR = int(os.getenv('TREE_BRANCHING_FACTOR', '4'))
+TREE_LINKAGE = os.getenv('TREE_LINKAGE', 'ward')
+
+
+def build_tree_from_linkage(clusterer, tree_builder, list_paragraphs, list_keywords, leaf_indices,
+                            branching_factor=TREE_BRANCHING_FACTOR, linkage_method=TREE_LINKAGE):
+    """
+    Dựng toàn bộ cây từ một lần tính cây phân cấp trên embedding của các nút lá: mỗi tầng cắt từ cây
+    phân cấp trở thành một vòng của `tree_builder.add_cluster_round` (cùng định dạng node với chế độ
+    phân cụm theo vòng). Đoạn đại diện của mỗi nút là đoạn lá gần tâm nút nhất.
+
+    Returns:
+        list: index (trong cây) của các nút ở tầng trên cùng.
+    """
+    clusterer.embed_paragraphs(list_paragraphs, list_keywords)
+    level_sizes, level_labels = clusterer.hierarchy_levels(branching_factor, linkage_method)
+
+    # Nút của tầng trước, theo thứ tự trong `current_indices`: tầng 0 là các đoạn lá
+    previous_labels = np.arange(len(list_paragraphs))
+    previous_count = len(list_paragraphs)
+    current_indices = leaf_indices
+
+    for round_count, num_clusters in enumerate(level_sizes, start=1):
+        labels = level_labels[:, round_count - 1]
+        representatives = clusterer.level_representatives(labels, num_clusters)
+
+        # Các tầng cắt từ cùng một cây nên lồng nhau: nút tầng trước thuộc đúng một cụm của tầng này
+        parent_of_previous = np.empty(previous_count, dtype=np.int64)
+        parent_of_previous[previous_labels] = labels
+        order = np.argsort(parent_of_previous, kind='stable')
+        boundaries = np.searchsorted(parent_of_previous[order], np.arange(num_clusters + 1))
+
+        cluster_info = []
+        for cluster_id in range(num_clusters):
+            representative_index = int(representatives[cluster_id])
+            cluster_info.append({
+                "ID_of_cluster": cluster_id,
+                "index_from_list_paragraph": order[boundaries[cluster_id]:boundaries[cluster_id + 1]].tolist(),
+                "represent": list_paragraphs[representative_index],
+                "represent_index": representative_index,  # chỉ số đoạn lá
+                "keyword": list_keywords[representative_index]
+            })
+
+        current_indices = tree_builder.add_cluster_round(cluster_info, round_count, current_indices)
+        print(f"\n📉 Tầng {round_count}: giảm từ {previous_count} xuống {num_clusters} nút")
+        previous_labels, previous_count = labels, num_clusters
+
+    return current_indices
+
+
+def run_clustering_with_tree_building(client, model_embedding, list_node , clustering_strategy='adaptive',
+                                      enrichment_mode=LLM_ENRICHMENT_MODE, max_concurrency=LLM_MAX_CONCURRENCY,
+                                      k_search=K_SEARCH_METHOD, clustering_engine=CLUSTERING_ENGINE,
+                                      tree_mode=TREE_MODE, branching_factor=TREE_BRANCHING_FACTOR):
     """
     Chạy phân cụm và xây dựng cây đồng thời
+
+    Args:
+        enrichment_mode: 'async' (gọi LLM tóm tắt/từ khóa song song), 'structured' (một request JSON
+                         trả về cả tóm tắt và từ khóa cho mỗi đoạn), 'packed' (gộp nhiều đoạn vào một
+                         request theo ngân sách token) hoặc 'sequential'
+        max_concurrency: số request LLM đồng thời tối đa ở các chế độ song song
+        k_search: cách tính đường cong elbow, 'hierarchy' (một cây phân cấp cho mọi k), 'log' (lưới log
+                  + tinh chỉnh quanh knee) hoặc 'kmeans'
+        clustering_engine: 'sklearn' (MiniBatchKMeans) hoặc 'faiss' (spherical faiss.Kmeans, cho tài liệu
+                           hàng chục nghìn đoạn văn)
+        tree_mode: 'rounds' (phân cụm lại từng vòng) hoặc 'linkage' (cắt một cây phân cấp thành các tầng,
+                   không dùng với engine faiss, khi đó quay về 'rounds')
+        branching_factor: số nút con trung bình của mỗi nút khi tree_mode='linkage'
     """
     # Khởi tạo các đối tượng
-    clusterer = ParagraphClusterer(model_embedding)
+    clusterer = create_paragraph_clusterer(model_embedding, clustering_engine)
+    if clustering_engine == 'faiss' and k_search == 'hierarchy':
+        # Cây phân cấp cần ma trận khoảng cách n x n, không dùng được với tài liệu rất lớn
+        print("Engine faiss: tìm k bằng lưới log thay vì cây phân cấp")
+        k_search = 'log'
+    if clustering_engine == 'faiss' and tree_mode == 'linkage':
+        # Cây phân cấp cũng cần ma trận khoảng cách n x n: dựng cây theo từng vòng phân cụm
+        print("Engine faiss: dựng cây theo vòng (tree_mode='rounds') thay vì cắt cây phân cấp")
+        tree_mode = 'rounds'
     tree_builder = ClusteringTreeBuilder()
 
     # Dữ liệu ban đầu
     initial_paragraphs = [paragraph['full_text'] for paragraph in list_node]
 
-    initial_summarized_paragraphs = []
-    for full_paragraph in initial_paragraphs:
-        summarized_paragraph = summary_paragraph(client, full_paragraph )
-        initial_summarized_paragraphs.append(summarized_paragraph)
+    # Tóm tắt + từ khóa cho từng đoạn văn (song song ở chế độ 'async')
+    enriched_paragraphs = enrich_paragraphs(client, initial_paragraphs, enrichment_mode, max_concurrency)
+    initial_summarized_paragraphs = [enriched['summary'] for enriched in enriched_paragraphs]
 
     list_paragraphs = initial_summarized_paragraphs.copy()
-    list_keywords = [extract_key_word(client, paragraph) for paragraph in initial_paragraphs]
+    list_keywords = [enriched['keyword'] for enriched in enriched_paragraphs]
 
     print(f"🚀 BẮT ĐẦU PHÂN CỤM VÀ XÂY DỰNG CÂY")
     print(f"Số đoạn văn ban đầu: {len(initial_paragraphs)}")
 
     # Thêm các đoạn văn ban đầu vào cây, các nút lá
-    current_indices = tree_builder.add_initial_paragraphs(client, paragraphs= initial_summarized_paragraphs)
+    current_indices = tree_builder.add_initial_paragraphs(client, paragraphs= initial_summarized_paragraphs,
+                                                          keywords=[enriched['summary_keyword'] for enriched in enriched_paragraphs])
+
+    if tree_mode == 'linkage':
+        build_tree_from_linkage(clusterer, tree_builder, list_paragraphs, list_keywords, current_indices,
+                                branching_factor)
+        return {
+            'tree': tree_builder.get_tree_structure(),
+            'tree_builder': tree_builder
+        }
 
     round_count = 1
+    # Vị trí (trong danh sách của vòng trước) của các đoạn đại diện, để dùng lại vector đã nhúng
+    source_indices = None
 
     while len(list_paragraphs) > 1:
         print(f"\n{'='*60}")
         print(f"--- VÒNG {round_count} | Số đoạn hiện tại: {len(list_paragraphs)} ---")
         print(f"{'='*60}")
 
-        # Nhúng các đoạn văn thành vector
-        clusterer.embed_paragraphs(list_paragraphs, list_keywords)
+        # Nhúng các đoạn văn thành vector (chỉ vòng đầu gọi model, các vòng sau dùng lại vector)
+        clusterer.embed_paragraphs(list_paragraphs, list_keywords, source_indices)
 
         # Lấy số cụm tối ưu
         optimal_k = get_optimal_k_with_final_merge_logic(
             list_paragraphs,
             clusterer,
-            clustering_strategy
+            clustering_strategy,
+            k_search
         )
 
         print(f"\n🎯 Số cụm được chọn: {optimal_k}")
@@ -61,6 +155,7 @@ def run_clustering_with_tree_building(client, model_embedding, list_node , clust
             previous_count = len(list_paragraphs)
             list_paragraphs = [cluster['represent'] for cluster in cluster_info]
             list_keywords = [cluster['keyword'] for cluster in cluster_info]
+            source_indices = [cluster['represent_index'] for cluster in cluster_info]
 
             current_indices = new_indices
             current_count = len(list_paragraphs)
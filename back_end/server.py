@@ -1,20 +1,31 @@
-from flask import Flask, request, jsonify, session
+from flask import Flask, request, jsonify, session, Response, stream_with_context
 from flask_cors import CORS
 import redis
 from owlready2 import *
 from dotenv import load_dotenv
-from openai import OpenAI
 from werkzeug.utils import secure_filename
 import os
 import json
+import shutil
 import uuid
 import time
-from sentence_transformers import SentenceTransformer
 from collections import defaultdict
 
 # Import các module xử lý chính (giả định đã được đơn giản hóa bên trong)
 from MainProcessor import process_PDF_file, create_ontology
 from LLMquery import *
+from DocumentCache import DocumentCache, document_cache_key, save_upload_with_hash
+from EmbeddingStore import EMBEDDING_MODEL_NAME, StoredEmbeddingModel, get_embedding_store
+from EncoderPool import EncoderPool
+from OnnxEmbedding import EMBEDDING_BACKEND, load_embedding_model
+from LLMBackend import LLM_BACKEND, LLM_MODEL, create_llm_backend
+from PDF_Processor import PDF_EXTRACTION_MODE
+from FindOptimalK import K_SEARCH_LINKAGE, K_SEARCH_METHOD
+from RunBuildTree import TREE_BRANCHING_FACTOR, TREE_LINKAGE, TREE_MODE
+from FaissParagraphClusterer import CLUSTERING_ENGINE
+from ParagraphEnrichment import LLM_ENRICHMENT_MODE
+from LLMCache import get_llm_cache
+from LLMScheduler import get_llm_scheduler
 
 # Giả định YOLOv10 và easyocr không yêu cầu cấu hình đặc biệt cho chế độ tuần tự
 from doclayout_yolo import YOLOv10
@@ -47,19 +58,23 @@ GENERATED_ONTOLOGIES_FOLDER = 'generated_ontologies'
 if not os.path.exists(GENERATED_ONTOLOGIES_FOLDER):
     os.makedirs(GENERATED_ONTOLOGIES_FOLDER)
 
-# --- Load biến môi trường và Khởi tạo OpenAI Client ---
+# Cache kết quả xử lý PDF theo nội dung file (SHA-256)
+document_cache = DocumentCache()
+
+# --- Load biến môi trường và Khởi tạo LLM backend (OpenAI, hoặc giả lập khi LLM_BACKEND=fake) ---
 load_dotenv(dotenv_path="secrect.env")
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-client = OpenAI(api_key=OPENAI_API_KEY)
+client = create_llm_backend(OPENAI_API_KEY, LLM_BACKEND)
 
 # --- Khởi tạo các model ---
-model_detect_layout = YOLOv10("model/model_detect_layout/doclayout_yolo_docstructbench_imgsz1024.pt")
+model_detect_layout = YOLOv10(os.getenv('LAYOUT_MODEL_PATH', "model/model_detect_layout/doclayout_yolo_docstructbench_imgsz1024.pt"))
 reader = easyocr.Reader(['vi', 'en'], gpu=False)
 
 # --- Load Ontology mặc định (nếu có) ---
 ONTO_AVAILABLE_PATH = "static/MINDMAP.owl"
 name_ontology_available = ONTO_AVAILABLE_PATH.split('/')[-1].split('.')[0]
 ontology_available = None
+ontology_available_key = None
 relation = None
 explication = None
 
@@ -67,17 +82,45 @@ try:
     if os.path.exists(ONTO_AVAILABLE_PATH):
         ontology_available = get_ontology(f"file://{os.path.abspath(ONTO_AVAILABLE_PATH)}").load()
         print(f"Ontology mặc định '{ONTO_AVAILABLE_PATH}' đã được tải.")
-        relation = find_relation(ontology_available)
-        entities_with_annotation_sumarry = get_entities_with_annotation(ontology_available, 'summary')
-        explication = create_explication(entities_with_annotation_sumarry)
+        ontology_available_key = ontology_file_key(ONTO_AVAILABLE_PATH)
+        relation, explication = get_ontology_context(ontology_available, ontology_available_key)
     else:
         print(f"Warning: File ontology mặc định '{ONTO_AVAILABLE_PATH}' không tồn tại. Bỏ qua việc tải.")
 except Exception as e:
     print(f"Không thể tải ontology mặc định '{ONTO_AVAILABLE_PATH}': {e}")
 
 # --- Model Embedding ---
-model_embedding_name = 'paraphrase-multilingual-MiniLM-L12-v2'
-model_embedding = SentenceTransformer(model_embedding_name)
+model_embedding_name = EMBEDDING_MODEL_NAME
+# EMBEDDING_BACKEND=onnx: dùng model ONNX lượng tử hóa int8 (nhanh hơn trên CPU), mặc định SentenceTransformer
+model_embedding = load_embedding_model(model_embedding_name, EMBEDDING_BACKEND)
+# Nhúng theo batch sắp theo độ dài, song song nhiều process khi ENCODER_POOL_WORKERS > 0
+model_embedding = EncoderPool(model_embedding, model_embedding_name)
+# Kho embedding trên đĩa dùng chung cho phân cụm, tạo ontology và chat: văn bản đã nhúng không phải nhúng lại
+# Tên kho theo model thực sự được load (ONNX lỗi thì là kho của PyTorch), CreateOnology dùng cùng tên kho này
+embedding_store = get_embedding_store(model_embedding.store_name)
+# Xử lý tài liệu ghi vector mới vào kho; chat chỉ tra cứu để câu hỏi người dùng không bị lưu xuống đĩa
+ingest_model_embedding = model_embedding
+if embedding_store is not None:
+    ingest_model_embedding = StoredEmbeddingModel(model_embedding, embedding_store)
+    model_embedding = StoredEmbeddingModel(model_embedding, embedding_store, write=False)
+    print(f"Kho embedding: {embedding_store.stats()}")
+# Cấu hình ảnh hưởng tới cây và ontology tạo ra: là một phần key của cache tài liệu
+DOCUMENT_CACHE_SETTINGS = {
+    'pdf_extraction_mode': PDF_EXTRACTION_MODE,
+    'k_search_method': K_SEARCH_METHOD,
+    'k_search_linkage': K_SEARCH_LINKAGE,
+    'tree_mode': TREE_MODE,
+    'tree_branching_factor': TREE_BRANCHING_FACTOR,
+    'tree_linkage': TREE_LINKAGE,
+    'clustering_engine': CLUSTERING_ENGINE,
+    'embedding_model': model_embedding.store_name,  # gồm cả backend thực sự được load
+    'llm_backend': LLM_BACKEND,
+    'llm_model': LLM_MODEL,
+    'llm_enrichment_mode': LLM_ENRICHMENT_MODE
+}
+# Tính trước chỉ mục embedding thực thể của ontology mặc định (dùng cho PP2 và lọc ứng viên PP1)
+if explication:
+    get_class_embedding_index(model_embedding, explication, ontology_available, ontology_available_key)
 
 # --- Lịch sử Chat trong memory ---
 chat_histories = {}
@@ -232,28 +275,54 @@ def upload_pdf():
         filename = secure_filename(pdf_file.filename)
         unique_filename = f"{uuid.uuid4().hex}_{filename}"
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        pdf_file.save(file_path)
-        print(f"File PDF đã lưu tạm thời: {file_path}")
+        pdf_hash = save_upload_with_hash(pdf_file, file_path)
+        print(f"File PDF đã lưu tạm thời: {file_path} (sha256: {pdf_hash})")
+
+        ontology_filename = f"{user_session_id}_ontology.owl"
+        ontology_save_path = os.path.join(GENERATED_ONTOLOGIES_FOLDER, ontology_filename)
+
+        # 0. Nếu tài liệu đã được xử lý trước đó, dùng lại kết quả trong cache
+        cache_key = document_cache_key(pdf_hash, DOCUMENT_CACHE_SETTINGS)
+        cached_result = document_cache.get(cache_key)
+        if cached_result:
+            shutil.copyfile(cached_result['ontology_path'], ontology_save_path)
+            set_ontology_state(user_session_id, {
+                'status': 'completed',
+                'timestamp': time.time(),
+                'ontology_path': ontology_save_path,
+                'created_from': 'document_cache',
+                'pdf_hash': pdf_hash
+            })
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+            return jsonify({
+                "message": "Tệp đã được xử lý trước đó, dùng lại Ontology trong cache.",
+                "initial_data": cached_result['tree'],
+                "session_id": user_session_id,
+                "ontology_status": "completed",
+                "ontology_path": ontology_save_path
+            }), 200
 
         try:
             # 1. Thực hiện process_PDF_file đồng bộ
             print(f"Bắt đầu process_PDF_file đồng bộ cho {file_path}")
-            clustering_tree = process_PDF_file(client, model_embedding, model_detect_layout, reader, file_path)
+            clustering_tree = process_PDF_file(client, ingest_model_embedding, model_detect_layout, reader, file_path)
             print("process_PDF_file hoàn tất.")
 
             # 2. Xây dựng ontology ngay lập tức (tuần tự)
             print("Bắt đầu xây dựng ontology đồng bộ.")
-            ontology_filename = f"{user_session_id}_ontology.owl"
-            ontology_save_path = os.path.join(GENERATED_ONTOLOGIES_FOLDER, ontology_filename)
-            create_ontology(clustering_tree, ontology_save_path)
+            create_ontology(clustering_tree, ontology_save_path, model_embedding=ingest_model_embedding)
             print(f"Ontology đã được xây dựng và lưu tại: {ontology_save_path}")
+            document_cache.put(cache_key, clustering_tree, ontology_save_path)
 
             # Cập nhật trạng thái trong Redis
             set_ontology_state(user_session_id, {
                 'status': 'completed',
                 'timestamp': time.time(),
                 'ontology_path': ontology_save_path,
-                'created_from': 'pdf_upload'
+                'created_from': 'pdf_upload',
+                'pdf_hash': pdf_hash
             })
 
             # Dọn dẹp file PDF tạm thời
@@ -300,18 +369,20 @@ def chat_with_available_onto_route():
 
     data = request.json
     question = data.get("message", "")
+    chat_mode = get_chat_mode(data)
 
     if not question:
         return jsonify({"error": "Không có tin nhắn được cung cấp"}), 400
 
     start_time = time.time()
+    retrieval_time = None
     bot_response = ""
 
     try:
-        entities = find_entities_from_question_PP1(client, relation, explication, question,
-                                                   chat_histories[current_user_id])
+        entities = find_question_entities(chat_mode, relation, explication, question, chat_histories[current_user_id],
+                                          ontology_available, ontology_available_key)
         print('tìm được: ', entities)
-        list_query = create_query(ontology_available, name_ontology_available, json.loads(entities))
+        list_query = create_query(ontology_available, name_ontology_available, entities)
         print("list_query (Default Ontology): ", list_query)
 
         result_from_ontology = find_question_info(name_ontology_available, list_query)
@@ -325,6 +396,7 @@ def chat_with_available_onto_route():
 
         k_similar_info = find_similar_info_from_raw_informations(model_embedding, question,
                                                                  raw_informations_from_ontology)
+        retrieval_time = time.time() - start_time
 
         bot_response = generate_response(client, k_similar_info, question, chat_histories[current_user_id])
 
@@ -335,7 +407,7 @@ def chat_with_available_onto_route():
         bot_response = "Xin lỗi, tôi không thể trả lời câu hỏi của bạn với ontology mặc định vào lúc này."
 
     end_time = time.time()
-    print("Thời gian thực thi (Default Ontology Chat):", end_time - start_time, "giây")
+    print(f"Thời gian thực thi (Default Ontology Chat, {chat_mode}):", end_time - start_time, "giây")
 
     # Lưu vào lịch sử chat
     chat_histories[current_user_id].append({"sender": "user", "text": question})
@@ -343,7 +415,9 @@ def chat_with_available_onto_route():
 
     return jsonify({
         "response": bot_response,
-        "session_id": current_user_id
+        "session_id": current_user_id,
+        "mode": chat_mode,
+        "timings": chat_timings(start_time, retrieval_time, end_time)
     })
 
 
@@ -371,6 +445,7 @@ def chat_with_new_ontology():
     try:
         current_ontology = get_ontology(f"file://{os.path.abspath(ontology_path)}").load()
         name_new_ontology = ontology_path.split('/')[-1].split('.')[0]
+        new_ontology_key = ontology_file_key(ontology_path)
         print(f"Ontology mới '{ontology_path}' đã được tải lại cho session {current_user_id}.")
     except Exception as e:
         import traceback
@@ -379,22 +454,22 @@ def chat_with_new_ontology():
 
     data = request.json
     question = data.get("message", "")
+    chat_mode = get_chat_mode(data)
 
     if not question:
         return jsonify({"error": "Không có tin nhắn được cung cấp"}), 400
 
     start_time = time.time()
+    retrieval_time = None
     bot_response = ""
 
     try:
-        relation = find_relation(current_ontology)
-        entities_with_annotation_sumarry = get_entities_with_annotation(current_ontology, 'summary')
-        explication = create_explication(entities_with_annotation_sumarry)
+        relation, explication = get_ontology_context(current_ontology, new_ontology_key)
 
-        entities = find_entities_from_question_PP1(client, relation, explication, question,
-                                                   chat_histories[current_user_id])
+        entities = find_question_entities(chat_mode, relation, explication, question, chat_histories[current_user_id],
+                                          current_ontology, new_ontology_key)
 
-        list_query = create_query(current_ontology, name_new_ontology, json.loads(entities))
+        list_query = create_query(current_ontology, name_new_ontology, entities)
 
         result_from_ontology = find_question_info(name_new_ontology, list_query)
         raw_informations_from_ontology = []
@@ -407,6 +482,7 @@ def chat_with_new_ontology():
 
         k_similar_info = find_similar_info_from_raw_informations(model_embedding, question,
                                                                  raw_informations_from_ontology)
+        retrieval_time = time.time() - start_time
 
         bot_response = generate_response(client, k_similar_info, question, chat_histories[current_user_id])
 
@@ -417,7 +493,7 @@ def chat_with_new_ontology():
         bot_response = "Xin lỗi, tôi không thể trả lời câu hỏi của bạn với ontology mới vào lúc này."
 
     end_time = time.time()
-    print("Thời gian thực thi (New Ontology Chat):", end_time - start_time, "giây")
+    print(f"Thời gian thực thi (New Ontology Chat, {chat_mode}):", end_time - start_time, "giây")
 
     # Lưu vào lịch sử chat
     chat_histories[current_user_id].append({"sender": "user", "text": question})
@@ -425,10 +501,198 @@ def chat_with_new_ontology():
 
     return jsonify({
         "response": bot_response,
-        "session_id": current_user_id
+        "session_id": current_user_id,
+        "mode": chat_mode,
+        "timings": chat_timings(start_time, retrieval_time, end_time)
     })
 
 
+# Chế độ tìm thực thể khi chat: 'pp1' (LLM chọn thực thể) hoặc 'pp2' (chỉ dùng embedding, bỏ một lời gọi LLM)
+CHAT_MODE = os.getenv('CHAT_MODE', 'pp1')
+CHAT_MODES = ('pp1', 'pp2')
+
+
+def get_chat_mode(data):
+    """Chế độ chat từ trường 'mode' của request, mặc định theo CHAT_MODE."""
+    mode = (data.get("mode") or CHAT_MODE).lower()
+    return mode if mode in CHAT_MODES else CHAT_MODE
+
+
+def find_question_entities(mode, relation, explication, question, history, onto=None, ontology_key=None):
+    """
+    Tìm thực thể liên quan đến câu hỏi theo chế độ chat, trả về dict dùng cho create_query.
+    `onto` cho phép dùng lại vector thực thể đã lưu trong ontology khi tạo chỉ mục thực thể,
+    `ontology_key` (`ontology_file_key`) là key cache chỉ mục của ontology.
+    """
+    if mode == 'pp2':
+        return find_entities_from_question_PP2(model_embedding, explication, question, onto=onto,
+                                               ontology_key=ontology_key)
+    entities = find_entities_from_question_pruned(client, model_embedding, relation, explication, question, history,
+                                                  onto=onto, ontology_key=ontology_key)
+    return json.loads(entities)
+
+
+def chat_timings(start_time, retrieval_time, end_time):
+    """Thời gian truy xuất (tìm thực thể + truy vấn ontology + chọn thông tin) và thời gian tạo câu trả lời."""
+    total = end_time - start_time
+    return {
+        "retrieval_seconds": round(retrieval_time, 3) if retrieval_time is not None else None,
+        "generation_seconds": round(total - retrieval_time, 3) if retrieval_time is not None else None,
+        "total_seconds": round(total, 3)
+    }
+
+
+def format_sse(event, data):
+    """Định dạng một sự kiện Server-Sent Events (data là JSON)."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream_chat_answer(current_user_id, question, onto, name_onto, relation, explication, error_message,
+                       chat_mode=CHAT_MODE, ontology_key=None):
+    """
+    Generator SSE cho một câu hỏi: gửi sự kiện 'progress' cho từng bước truy xuất,
+    'token' cho từng đoạn câu trả lời, cuối cùng là 'done' (hoặc 'error').
+    Câu hỏi và câu trả lời đầy đủ được lưu vào lịch sử chat khi stream kết thúc (kể cả khi client ngắt kết nối).
+
+    Args:
+        current_user_id: ID session.
+        question: Câu hỏi của người dùng.
+        onto: Ontology dùng để trả lời.
+        name_onto: Tên ontology (dùng trong SPARQL query).
+        relation, explication: Cấu trúc và chú thích ontology; None thì tính từ `onto`.
+        error_message: Câu trả lời khi có lỗi.
+        chat_mode: 'pp1' hoặc 'pp2'.
+        ontology_key: Định danh ontology (`ontology_file_key`) để cache cấu trúc, chú thích và chỉ mục thực thể.
+    """
+    start_time = time.time()
+    answer_parts = []
+    try:
+        if relation is None or explication is None:
+            yield format_sse('progress', {"step": "analyze_ontology", "message": "Đang phân tích ontology..."})
+            relation, explication = get_ontology_context(onto, ontology_key)
+
+        yield format_sse('progress', {"step": "find_entities", "message": "Đang tìm thực thể liên quan...",
+                                      "mode": chat_mode})
+        json_entities = find_question_entities(chat_mode, relation, explication, question,
+                                               chat_histories[current_user_id], onto, ontology_key)
+
+        yield format_sse('progress', {"step": "query_ontology", "message": "Đang truy vấn ontology...",
+                                      "entities": json_entities})
+        list_query = create_query(onto, name_onto, json_entities)
+        result_from_ontology = find_question_info(name_onto, list_query)
+        raw_informations_from_ontology = []
+        try:
+            for result in result_from_ontology[0]:
+                raw_informations_from_ontology.append(result)
+        except Exception as e:
+            print(f"Lỗi khi xử lý kết quả ontology: {e}")
+            raw_informations_from_ontology.append("Không có thông tin cho câu hỏi từ ontology.")
+
+        yield format_sse('progress', {"step": "rank_information", "message": "Đang chọn thông tin phù hợp...",
+                                      "n_informations": len(raw_informations_from_ontology)})
+        k_similar_info = find_similar_info_from_raw_informations(model_embedding, question,
+                                                                 raw_informations_from_ontology)
+
+        retrieval_time = time.time() - start_time
+        yield format_sse('progress', {"step": "generate", "message": "Đang tạo câu trả lời...",
+                                      "retrieval_seconds": round(retrieval_time, 3)})
+        for chunk in generate_response_stream(client, k_similar_info, question, chat_histories[current_user_id]):
+            answer_parts.append(chunk)
+            yield format_sse('token', {"text": chunk})
+
+        yield format_sse('done', {"response": ''.join(answer_parts), "session_id": current_user_id,
+                                  "mode": chat_mode,
+                                  "timings": chat_timings(start_time, retrieval_time, time.time())})
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"Lỗi trong quá trình chat (stream): {e}")
+        answer_parts = [error_message]
+        yield format_sse('error', {"response": error_message, "session_id": current_user_id})
+    finally:
+        print("Thời gian thực thi (Chat stream):", time.time() - start_time, "giây")
+        # Lưu vào lịch sử chat
+        chat_histories[current_user_id].append({"sender": "user", "text": question})
+        chat_histories[current_user_id].append({"sender": "bot", "text": ''.join(answer_parts)})
+
+
+def sse_response(generator):
+    """Tạo Flask Response dạng text/event-stream, tắt buffer của proxy để token được gửi ngay."""
+    return Response(stream_with_context(generator), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route("/api/chat_with_available_onto/stream", methods=["POST"])
+def chat_with_available_onto_stream_route():
+    """Giống /api/chat_with_available_onto nhưng trả câu trả lời dần dần qua Server-Sent Events."""
+    if ontology_available is None:
+        return jsonify({"error": "Ontology mặc định chưa được tải hoặc không tồn tại."}), 500
+    if relation is None or explication is None:
+        return jsonify({"error": "Dữ liệu khởi tạo cho ontology mặc định chưa sẵn sàng."}), 500
+
+    # TẠO SESSION MỚI nếu chưa có khi chat với ontology có sẵn
+    current_user_id = get_current_session_id()
+    if not current_user_id:
+        current_user_id = create_new_session()
+        print(f"Tạo session mới cho chat với ontology có sẵn: {current_user_id}")
+
+    initialize_user_data(current_user_id)
+
+    data = request.json
+    question = data.get("message", "")
+
+    if not question:
+        return jsonify({"error": "Không có tin nhắn được cung cấp"}), 400
+
+    return sse_response(stream_chat_answer(
+        current_user_id, question, ontology_available, name_ontology_available, relation, explication,
+        "Xin lỗi, tôi không thể trả lời câu hỏi của bạn với ontology mặc định vào lúc này.",
+        get_chat_mode(data), ontology_available_key
+    ))
+
+
+@app.route("/api/chat_newOnto/stream", methods=["POST"])
+def chat_with_new_ontology_stream():
+    """Giống /api/chat_newOnto nhưng trả câu trả lời dần dần qua Server-Sent Events."""
+    current_user_id = get_current_session_id()
+
+    if not current_user_id:
+        return jsonify({
+            "error": "Không có session hợp lệ. Vui lòng upload PDF trước khi chat với ontology mới."
+        }), 400
+
+    # Kiểm tra session có ontology mới hợp lệ không
+    is_valid, message = validate_session_for_new_ontology(current_user_id)
+    if not is_valid:
+        return jsonify({"error": message}), 400
+
+    initialize_user_data(current_user_id)
+
+    current_ontology_info = get_ontology_state(current_user_id)
+    ontology_path = current_ontology_info.get('ontology_path')
+
+    try:
+        current_ontology = get_ontology(f"file://{os.path.abspath(ontology_path)}").load()
+        name_new_ontology = ontology_path.split('/')[-1].split('.')[0]
+        new_ontology_key = ontology_file_key(ontology_path)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": f"Không thể tải Ontology mới cho chat: {e}"}), 500
+
+    data = request.json
+    question = data.get("message", "")
+
+    if not question:
+        return jsonify({"error": "Không có tin nhắn được cung cấp"}), 400
+
+    return sse_response(stream_chat_answer(
+        current_user_id, question, current_ontology, name_new_ontology, None, None,
+        "Xin lỗi, tôi không thể trả lời câu hỏi của bạn với ontology mới vào lúc này.",
+        get_chat_mode(data), new_ontology_key
+    ))
+
+
 @app.route("/api/get-chat-history", methods=["GET"])
 def get_chat_history():
     """Endpoint để lấy lịch sử chat của session hiện tại"""
@@ -506,6 +770,18 @@ def get_session_info():
     })
 
 
+@app.route("/api/llm-metrics", methods=["GET"])
+def get_llm_metrics():
+    """Endpoint để xem thống kê gọi LLM: thời gian chờ hàng đợi theo luồng ưu tiên, số lần thử lại và cache"""
+    llm_cache = get_llm_cache()
+    # Bộ điều phối (Redis token bucket dùng chung với các Celery worker) được tạo ở request LLM đầu tiên
+    llm_scheduler = get_llm_scheduler()
+    return jsonify({
+        "scheduler": llm_scheduler.stats() if llm_scheduler else None,
+        "cache": llm_cache.stats() if llm_cache else None
+    })
+
+
 # --- Middleware và Error Handlers ---
 
 @app.before_request
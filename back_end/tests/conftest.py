@@ -0,0 +1,19 @@
+import os
+import sys
+
+# Các module của back_end được import theo tên phẳng (như khi chạy server.py trong thư mục back_end)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture
+def fake_llm(tmp_path, monkeypatch):
+    """FakeLLMBackend không độ trễ, không lỗi, với cache LLM riêng của test và không qua bộ điều phối."""
+    import LLMCache
+    from LLMBackend import FakeLLMBackend
+
+    cache = LLMCache.LLMResponseCache(path=str(tmp_path / 'llm_cache.sqlite3'))
+    monkeypatch.setattr(LLMCache, 'get_llm_cache', lambda: cache)
+    monkeypatch.setattr(LLMCache, 'get_llm_scheduler', lambda: None)
+    return FakeLLMBackend(latency_ms=0, latency_jitter_ms=0, error_rate=0)
@@ -0,0 +1,116 @@
+import json
+import sys
+import types
+
+import numpy as np
+import pytest
+
+for module_name in ('flask', 'flask_cors', 'redis', 'owlready2', 'dotenv', 'matplotlib'):
+    pytest.importorskip(module_name)
+
+QUESTION = 'Vua Gia Long lên ngôi năm nào?'
+INFORMATION = ['Năm 1802, Nguyễn Ánh lên ngôi hoàng đế, lấy niên hiệu là Gia Long. Kinh đô đặt tại Phú Xuân.']
+
+
+class FixedModel:
+    """Model nhúng giả trong test: vector cố định theo văn bản."""
+
+    store_name = 'fixed-test-model'
+
+    def encode(self, sentences, show_progress_bar=False, **kwargs):
+        return np.stack([np.random.default_rng(sum(map(ord, text))).normal(size=16).astype(np.float32)
+                         for text in sentences])
+
+
+@pytest.fixture
+def chat_server(fake_llm, tmp_path, monkeypatch):
+    """Module server với FakeLLMBackend, model giả và bước truy xuất ontology cố định."""
+    # server.py load model bố cục, OCR và model nhúng khi import: thay bằng bản giả, thư mục làm việc là tmp
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(sys.modules, 'doclayout_yolo', types.SimpleNamespace(YOLOv10=lambda path: None))
+    monkeypatch.setitem(sys.modules, 'easyocr', types.SimpleNamespace(Reader=lambda *args, **kwargs: None))
+    import LLMBackend
+    import OnnxEmbedding
+    monkeypatch.setattr(LLMBackend, 'LLM_BACKEND', 'fake')
+    monkeypatch.setattr(OnnxEmbedding, 'load_embedding_model', lambda name, backend=None: FixedModel())
+    import server
+
+    ontology_path = tmp_path / 'new_ontology.owl'
+    ontology_path.write_text('<rdf:RDF/>', encoding='utf-8')
+    monkeypatch.setattr(server, 'client', fake_llm)
+    monkeypatch.setattr(server, 'model_embedding', FixedModel())
+    monkeypatch.setattr(server, 'chat_histories', {})
+    monkeypatch.setattr(server, 'ontology_available', object())
+    monkeypatch.setattr(server, 'relation', 'Gia_Long')
+    monkeypatch.setattr(server, 'explication', {'Gia_Long': 'Vị vua đầu tiên của nhà Nguyễn'})
+    monkeypatch.setattr(server, 'get_ontology_context',
+                        lambda onto, ontology_key=None: ('Gia_Long', {'Gia_Long': 'Vị vua đầu tiên của nhà Nguyễn'}))
+    monkeypatch.setattr(server, 'get_ontology', lambda iri: types.SimpleNamespace(load=lambda: object()))
+    monkeypatch.setattr(server, 'get_ontology_state',
+                        lambda session_id: {'status': 'completed', 'ontology_path': str(ontology_path)})
+    monkeypatch.setattr(server, 'find_question_entities', lambda *args, **kwargs: {'Thực_thể': ['Gia_Long']})
+    monkeypatch.setattr(server, 'create_query', lambda onto, name_onto, entities: ['SELECT ...'])
+    monkeypatch.setattr(server, 'find_question_info', lambda name_onto, queries: [list(INFORMATION)])
+    return server
+
+
+def parse_sse(body):
+    """Tách body SSE thành list (event, data)."""
+    events = []
+    for message in body.split('\n\n'):
+        if not message:
+            continue
+        event_line, data_line = message.split('\n')
+        assert event_line.startswith('event: ') and data_line.startswith('data: ')
+        events.append((event_line[len('event: '):], json.loads(data_line[len('data: '):])))
+    return events
+
+
+def open_session(http_client):
+    with http_client.session_transaction() as flask_session:
+        flask_session['session_id'] = 'test-session'
+    return 'test-session'
+
+
+@pytest.mark.parametrize('route', ['/api/chat_with_available_onto/stream', '/api/chat_newOnto/stream'])
+def test_stream_routes_send_progress_tokens_and_done(chat_server, route):
+    http_client = chat_server.app.test_client()
+    session_id = open_session(http_client)
+
+    response = http_client.post(route, json={'message': QUESTION, 'mode': 'pp2'})
+
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    assert response.headers['Cache-Control'] == 'no-cache'
+    events = parse_sse(response.get_data(as_text=True))
+    names = [name for name, _ in events]
+    steps = [data['step'] for name, data in events if name == 'progress']
+    assert steps[-4:] == ['find_entities', 'query_ontology', 'rank_information', 'generate']
+    assert names[:len(steps)] == ['progress'] * len(steps)
+    assert names[len(steps):-1] and set(names[len(steps):-1]) == {'token'}
+    assert names[-1] == 'done'
+
+    answer = ''.join(data['text'] for name, data in events if name == 'token')
+    done = events[-1][1]
+    assert done['response'] == answer and done['session_id'] == session_id and done['mode'] == 'pp2'
+    assert chat_server.chat_histories[session_id] == [{'sender': 'user', 'text': QUESTION},
+                                                      {'sender': 'bot', 'text': answer}]
+
+
+def test_history_is_saved_when_the_client_disconnects(chat_server):
+    http_client = chat_server.app.test_client()
+    session_id = open_session(http_client)
+
+    response = http_client.post('/api/chat_with_available_onto/stream', json={'message': QUESTION},
+                                buffered=False)
+    received = []
+    for chunk in response.response:
+        received.extend(parse_sse(chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk))
+        if received[-1][0] == 'token':
+            break
+    # Client ngắt kết nối sau token đầu tiên
+    response.close()
+
+    partial_answer = received[-1][1]['text']
+    assert chat_server.chat_histories[session_id] == [{'sender': 'user', 'text': QUESTION},
+                                                      {'sender': 'bot', 'text': partial_answer}]
@@ -0,0 +1,37 @@
+import multiprocessing
+
+from DocumentCache import DocumentCache, document_cache_key
+
+
+def test_changed_settings_miss_the_cache(tmp_path):
+    ontology_path = tmp_path / 'ontology.owl'
+    ontology_path.write_text('<rdf:RDF/>', encoding='utf-8')
+    cache = DocumentCache(str(tmp_path / 'cache'))
+    settings = {'pdf_extraction_mode': 'layout', 'tree_mode': 'rounds', 'clustering_engine': 'sklearn'}
+
+    cache.put(document_cache_key('abc', settings), [{'index': 0}], str(ontology_path))
+
+    assert cache.get(document_cache_key('abc', dict(settings)))['tree'] == [{'index': 0}]
+    assert cache.get(document_cache_key('abc', {**settings, 'tree_mode': 'linkage'})) is None
+    assert cache.get(document_cache_key('def', settings)) is None
+
+
+def _put_documents(cache_dir, ontology_path, worker, count):
+    cache = DocumentCache(cache_dir)
+    for i in range(count):
+        cache.put(f"worker{worker}-doc{i}", [{'index': i}], ontology_path)
+
+
+def test_concurrent_processes_do_not_lose_entries(tmp_path):
+    ontology_path = tmp_path / 'ontology.owl'
+    ontology_path.write_text('<rdf:RDF/>', encoding='utf-8')
+    cache_dir = str(tmp_path / 'cache')
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=_put_documents, args=(cache_dir, str(ontology_path), worker, 10))
+               for worker in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+    assert DocumentCache(cache_dir).stats()['entries'] == 40
@@ -0,0 +1,44 @@
+import numpy as np
+
+from EmbeddingStore import EmbeddingStore, StoredEmbeddingModel
+
+
+class RandomModel:
+    """Model nhúng giả trong test: vector float32 ngẫu nhiên cố định theo văn bản."""
+
+    def __init__(self):
+        self.encoded = 0
+
+    def encode(self, texts, show_progress_bar=False):
+        self.encoded += len(texts)
+        return np.stack([np.random.default_rng(sum(map(ord, text))).normal(size=16).astype(np.float32)
+                         for text in texts])
+
+
+def test_encode_returns_same_vectors_on_miss_and_hit(tmp_path):
+    model = RandomModel()
+    texts = ['Cách mạng tháng Tám', 'Hiệp định Genève', 'Cách mạng tháng Tám']
+    store = EmbeddingStore(str(tmp_path / 'store'), dtype='float16')
+
+    first = store.encode(model, texts)
+    second = store.encode(model, texts)
+    reopened = EmbeddingStore(str(tmp_path / 'store'), read_only=True).encode(model, texts)
+
+    assert model.encoded == 2
+    assert first.dtype == np.float32
+    np.testing.assert_array_equal(first, second)
+    np.testing.assert_array_equal(first, reopened)
+
+
+def test_lookup_only_model_does_not_grow_the_store(tmp_path):
+    model = RandomModel()
+    store = EmbeddingStore(str(tmp_path / 'store'))
+    StoredEmbeddingModel(model, store).encode(['Cách mạng tháng Tám'])
+    chat_model = StoredEmbeddingModel(model, store, write=False)
+
+    vector = chat_model.encode('Hiệp định Genève được ký năm nào?')
+    chat_model.encode(['Cách mạng tháng Tám'])
+
+    assert vector.shape == (16,)
+    assert len(store) == 1
+    assert model.encoded == 2
@@ -0,0 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import EncoderPool as encoder_pool_module
+from EncoderPool import EncoderPool
+
+SENTENCES = [f"Đoạn văn số {i} " + "về lịch sử Việt Nam " * (i % 7) for i in range(300)]
+
+
+class HashModel:
+    """Model nhúng giả trong test: vector chỉ phụ thuộc vào văn bản, không phụ thuộc batch."""
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False):
+        return np.stack([np.random.default_rng(sum(map(ord, text))).normal(size=8).astype(np.float32)
+                         for text in sentences])
+
+
+def test_in_process_encoding_matches_model():
+    model = HashModel()
+    pool = EncoderPool(model, 'hash-model', workers=0)
+    np.testing.assert_array_equal(pool.encode(SENTENCES), model.encode(SENTENCES))
+    np.testing.assert_array_equal(pool.encode(SENTENCES[0]), model.encode(SENTENCES[:1])[0])
+
+
+def test_pooled_encoding_keeps_input_order(monkeypatch):
+    model = HashModel()
+    # Worker dùng thread thay cho process để chạy đúng đường chia nhóm/ghép kết quả mà không cần load model thật
+    monkeypatch.setitem(encoder_pool_module._encoder_worker_state, 'model', model)
+    pool = EncoderPool(model, 'hash-model', workers=2, batch_size=16, min_parallel_items=1)
+    pool._executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        np.testing.assert_array_equal(pool.encode(SENTENCES), model.encode(SENTENCES))
+    finally:
+        pool.close()
+
+
+def test_pooled_encoding_matches_sentence_transformer():
+    sentence_transformers = pytest.importorskip('sentence_transformers')
+    model_name = 'paraphrase-multilingual-MiniLM-L12-v2'
+    try:
+        model = sentence_transformers.SentenceTransformer(model_name, device='cpu')
+    except Exception as e:
+        pytest.skip(f"Không load được model {model_name}: {e}")
+
+    pool = EncoderPool(model, model_name, workers=2, min_parallel_items=1)
+    try:
+        # Padding khác nhau giữa các batch chỉ làm lệch sai số dấu phẩy động
+        np.testing.assert_allclose(pool.encode(SENTENCES), model.encode(SENTENCES), rtol=1e-4, atol=1e-5)
+    finally:
+        pool.close()
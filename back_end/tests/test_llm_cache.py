@@ -0,0 +1,34 @@
+import LLMCache
+from LLMBackend import FakeLLMBackend, LLMBackend, LLMCompletion
+from LLMCache import LLMResponseCache, cached_chat_completion
+
+
+class RecordingOpenAIBackend(LLMBackend):
+    """Backend đóng vai OpenAI trong test: trả lời cố định và đếm số lần gọi."""
+
+    name = 'openai'
+
+    def __init__(self):
+        self.calls = 0
+
+    def complete(self, messages, model=None, temperature=0, purpose=None, **request_options):
+        self.calls += 1
+        return LLMCompletion('phản hồi thật')
+
+
+def test_fake_backend_entries_never_hit_for_real_backend(tmp_path, monkeypatch):
+    cache = LLMResponseCache(path=str(tmp_path / 'llm_cache.sqlite3'))
+    monkeypatch.setattr(LLMCache, 'get_llm_cache', lambda: cache)
+    monkeypatch.setattr(LLMCache, 'get_llm_scheduler', lambda: None)
+    messages = [{'role': 'system', 'content': 'Tóm tắt đoạn văn.'},
+                {'role': 'user', 'content': 'Chiến dịch Điện Biên Phủ kết thúc năm 1954.'}]
+
+    fake_content = cached_chat_completion(FakeLLMBackend(latency_ms=0, error_rate=0), 'summary_paragraph', messages)
+    real_backend = RecordingOpenAIBackend()
+    real_content = cached_chat_completion(real_backend, 'summary_paragraph', messages)
+
+    assert real_backend.calls == 1
+    assert real_content == 'phản hồi thật' != fake_content
+    # Lần gọi thật tiếp theo dùng cache của chính backend thật
+    assert cached_chat_completion(real_backend, 'summary_paragraph', messages) == 'phản hồi thật'
+    assert real_backend.calls == 1
@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+from LLMScheduler import BULK_LANE, LLMScheduler, RedisTokenBucket
+
+
+class BlockingBucket:
+    """Bucket giả trong test: mỗi lệnh chặn thread như một round trip tới Redis."""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def try_acquire(self, cost, lane):
+        time.sleep(self.delay)
+        return 0
+
+    def waiting(self, lane, delta):
+        time.sleep(self.delay)
+
+
+def test_acquire_async_does_not_block_the_event_loop():
+    scheduler = LLMScheduler(BlockingBucket(0.1))
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker_task = asyncio.create_task(ticker())
+        await asyncio.gather(*(scheduler.acquire_async(10, BULK_LANE) for _ in range(4)))
+        ticker_task.cancel()
+        return ticks
+
+    # 4 coroutine x 3 lệnh x 0.1s: event loop bị chặn thì ticker gần như không chạy được
+    assert asyncio.run(run()) >= 10
+
+
+class RecordingRedis:
+    """Redis client giả: ghi lại tham số gọi script token bucket."""
+
+    def __init__(self):
+        self.calls = []
+
+    def register_script(self, script):
+        self.script = script
+
+        def run(keys, args):
+            self.calls.append(args)
+            return 0
+        return run
+
+
+def test_redis_bucket_uses_the_server_clock():
+    redis_client = RecordingRedis()
+    bucket = RedisTokenBucket(redis_client, rpm=60, tpm=1000, reserve_fraction=0.2)
+
+    assert bucket.try_acquire(10, BULK_LANE) == 0
+    assert "redis.call('TIME')" in redis_client.script
+    assert redis_client.calls == [[60, 1000, 10, 0.2, 1]]
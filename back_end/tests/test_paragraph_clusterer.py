@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('matplotlib')
+from ParagraphClusterer import ParagraphClusterer
+
+
+def clustered_embeddings(n_clusters=6, per_cluster=60, dim=32, seed=0):
+    """Embedding đã chuẩn hóa gồm các cụm rõ ràng quanh những tâm ngẫu nhiên."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    points = np.repeat(centers, per_cluster, axis=0) + 0.3 * rng.normal(size=(n_clusters * per_cluster, dim))
+    return (points / np.linalg.norm(points, axis=1, keepdims=True)).astype(np.float32)
+
+
+def test_parallel_elbow_matches_serial():
+    clusterer = ParagraphClusterer(None)
+    clusterer.normalized_embeddings = clustered_embeddings()
+
+    serial = clusterer.find_optimal_clusters_elbow(range(1, 10), n_jobs=1)
+    parallel = clusterer.find_optimal_clusters_elbow(range(1, 10), n_jobs=3)
+
+    assert len(serial) == 9
+    assert parallel == serial
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from ParagraphEnrichment import enrich_paragraphs, is_complete_packed_enrichment, parse_packed_enrichment
+
+PARAGRAPHS = [
+    f"Năm {1800 + i}, triều đình cử quan lại đi khai hoang vùng đất số {i}. Dân cư dần tụ họp thành làng."
+    for i in range(6)
+]
+
+
+def test_parse_packed_enrichment_accepts_the_supported_shapes():
+    item = {'summary': 'Tóm tắt', 'keyword': 'Từ khóa'}
+    expected = {1: item, 2: item}
+
+    assert parse_packed_enrichment(json.dumps({'items': [{'id': 1, **item}, {'id': 2, **item}]}), 2) == expected
+    assert parse_packed_enrichment(json.dumps([item, item]), 2) == expected
+    assert parse_packed_enrichment(json.dumps({'1': item, '2': item}), 2) == expected
+    assert parse_packed_enrichment('```json\n' + json.dumps([item, item]) + '\n```', 2) == expected
+
+
+def test_parse_packed_enrichment_skips_bad_items():
+    item = {'summary': 'Tóm tắt', 'keyword': 'Từ khóa'}
+    content = json.dumps({'items': [
+        {'id': 1, **item},
+        {'id': 1, 'summary': 'Trùng số thứ tự', 'keyword': 'Trùng'},
+        {'id': 7, **item},
+        {'id': 3, 'summary': 'Thiếu từ khóa'},
+    ]})
+
+    assert parse_packed_enrichment(content, 3) == {1: item}
+    assert is_complete_packed_enrichment(content, 3) is False
+    with pytest.raises(ValueError):
+        parse_packed_enrichment('không phải JSON', 2)
+    with pytest.raises(ValueError):
+        parse_packed_enrichment(json.dumps({'items': []}), 2)
+
+
+def test_packed_mode_matches_one_request_per_paragraph(fake_llm):
+    packed = enrich_paragraphs(fake_llm, PARAGRAPHS, mode='packed')
+    structured = enrich_paragraphs(fake_llm, PARAGRAPHS, mode='structured')
+
+    assert packed == structured
+    assert fake_llm.calls['summarize_and_extract_keyword_packed'] == 1
+
+    # Phản hồi gộp đầy đủ được đọc lại từ cache
+    enrich_paragraphs(fake_llm, PARAGRAPHS, mode='packed')
+    assert fake_llm.calls['summarize_and_extract_keyword_packed'] == 1
+
+
+def test_missing_items_are_retried_and_partial_responses_are_not_cached(fake_llm, monkeypatch):
+    respond = fake_llm._respond
+
+    def drop_second_item(messages, purpose):
+        content = respond(messages, purpose)
+        if purpose == 'summarize_and_extract_keyword_packed':
+            data = json.loads(content)
+            data['items'] = [item for item in data['items'] if item['id'] != 2]
+            content = json.dumps(data, ensure_ascii=False)
+        return content
+    monkeypatch.setattr(fake_llm, '_respond', drop_second_item)
+
+    packed = enrich_paragraphs(fake_llm, PARAGRAPHS, mode='packed')
+
+    assert fake_llm.calls['summarize_and_extract_keyword_packed'] == 1
+    assert fake_llm.calls['summarize_and_extract_keyword'] == 1
+    monkeypatch.setattr(fake_llm, '_respond', respond)
+    assert packed == enrich_paragraphs(fake_llm, PARAGRAPHS, mode='structured')
+
+    # Phản hồi thiếu đoạn không được lưu: lần chạy sau gửi lại request gộp
+    enrich_paragraphs(fake_llm, PARAGRAPHS, mode='packed')
+    assert fake_llm.calls['summarize_and_extract_keyword_packed'] == 2
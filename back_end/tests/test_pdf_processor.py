@@ -0,0 +1,116 @@
+import fitz
+import pytest
+
+from PDF_Processor import PageTextIndex, _is_title_font, process_full_pdf
+
+# Model YOLO giả: mỗi trang có hai vùng 'plain text' là nửa trên và nửa dưới của ảnh.
+# Được ghi thành module `doclayout_yolo` để các worker (spawn) cũng import được.
+STUB_LAYOUT_MODULE = '''
+import numpy as np
+
+
+class _Box:
+    def __init__(self, xyxy):
+        self.xyxy = np.array([xyxy], dtype=float)
+        self.cls = np.array([0])
+        self.conf = np.array([0.9])
+
+
+class _Result:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class YOLOv10:
+    names = {0: 'plain text'}
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def predict(self, images, **kwargs):
+        if not isinstance(images, list):
+            images = [images]
+        results = []
+        for image in images:
+            width, height = image.size
+            results.append(_Result([_Box([0, height / 2, width, height]), _Box([0, 0, width, height / 2])]))
+        return results
+'''
+
+
+def _write_pdf(path, pages=7):
+    documents = fitz.open()
+    for page_index in range(pages):
+        page = documents.new_page()
+        page.insert_textbox(fitz.Rect(72, 72, 520, 300),
+                            f"Trang {page_index}: đoạn thứ nhất nói về triều đại và các sự kiện lịch sử quan trọng. " * 3)
+        # Một số trang chỉ có đoạn ở nửa trên: box nửa dưới không có text, index phải được rollback
+        if page_index % 3 != 1:
+            page.insert_textbox(fitz.Rect(72, 480, 520, 700),
+                                f"Trang {page_index}: đoạn thứ hai kể lại diễn biến của cuộc kháng chiến. " * 3)
+    documents.save(str(path))
+    documents.close()
+
+
+@pytest.fixture
+def stub_layout_model(tmp_path, monkeypatch):
+    (tmp_path / 'doclayout_yolo.py').write_text(STUB_LAYOUT_MODULE, encoding='utf-8')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    from doclayout_yolo import YOLOv10
+    return YOLOv10()
+
+
+@pytest.mark.parametrize('extraction_mode', ['layout', 'native'])
+def test_parallel_matches_serial(tmp_path, stub_layout_model, extraction_mode):
+    pdf_path = str(tmp_path / 'document.pdf')
+    _write_pdf(pdf_path)
+
+    serial = process_full_pdf(stub_layout_model, None, pdf_path, window_size=2,
+                              extraction_mode=extraction_mode, layout_batch_size=2, workers=1)
+    parallel = process_full_pdf(stub_layout_model, None, pdf_path, window_size=2,
+                                extraction_mode=extraction_mode, layout_batch_size=2, workers=3,
+                                layout_model_path='stub.pt')
+
+    assert serial['total_paragraphs'] > serial['total_pages']
+    assert parallel['all_paragraphs'] == serial['all_paragraphs']
+    assert [paragraph['index'] for paragraph in parallel['all_paragraphs']] == \
+        list(range(1, serial['total_paragraphs'] + 1))
+
+
+def _old_clip_text(page, rect):
+    """Cách trích xuất cũ: hai lần `get_text` với `clip` cho mỗi box."""
+    clip = fitz.Rect(rect)
+    label = ''
+    for block in page.get_text('dict', clip=clip)['blocks']:
+        for line in block['lines']:
+            if _is_title_font(line['spans'][0]['font']):
+                label = 'title'
+    blocks = page.get_text('blocks', clip=clip)
+    return label, blocks[0][4] if blocks else ''
+
+
+def test_text_index_matches_clipped_get_text_on_two_columns():
+    documents = fitz.open()
+    page = documents.new_page()
+    sentence = "Nha Nguyen ghi lai nhieu bien co ve chinh tri va quan su trong the ky muoi chin. "
+    for x0, x1 in [(50, 290), (310, 550)]:
+        page.insert_textbox(fitz.Rect(x0, 50, x1, 80), "Chuong mot: Khoi nghia", fontname='Times-Bold')
+        page.insert_textbox(fitz.Rect(x0, 90, x1, 300), sentence * 4)
+        page.insert_textbox(fitz.Rect(x0, 320, x1, 520), sentence * 3)
+    page.insert_textbox(fitz.Rect(50, 760, 550, 790), "Trang 1 - Lich su Viet Nam")
+
+    # Các vùng giống box của model bố cục: từng khối, từng cột, từng hàng cắt ngang hai cột và cả trang.
+    # Cạnh của vùng nằm giữa các dòng: MuPDF cắt theo nét chữ của glyph, chỉ mục chỉ xấp xỉ khi cạnh cắt qua dòng.
+    blocks = page.get_text('dict')['blocks']
+    rects = [(x0 - 3, y0 - 3, x1 + 3, y1 + 3) for x0, y0, x1, y1 in (block['bbox'] for block in blocks)]
+    rects += [(40, y0, 300, y1) for y0, y1 in [(40, 310), (85, 530), (40, 800)]]
+    rects += [(300, y0, 560, y1) for y0, y1 in [(40, 310), (85, 530), (40, 800)]]
+    for block in blocks[:3]:
+        # Hàng gồm một hoặc hai dòng đầu của khối ở cả hai cột
+        lines = block['lines']
+        rects += [(40, lines[0]['bbox'][1] - 2, 560, line['bbox'][3] + 0.5) for line in lines[:2]]
+    rects += [(40, 750, 560, 800), (0, 0, 595, 842)]
+
+    text_index = PageTextIndex(page)
+    for rect in rects:
+        assert text_index.text_in_rect(rect) == _old_clip_text(page, rect), rect
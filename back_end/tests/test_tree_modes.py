@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('matplotlib')
+from RunBuildTree import run_clustering_with_tree_building
+
+NODE_KEYS = {'index', 'parent_index', 'summarized_paragraph', 'keyword', 'type', 'round', 'cluster_id', 'children'}
+PARAGRAPHS = [f"Đoạn {i}: sự kiện lịch sử số {i} diễn ra ở vùng {i % 4} với nhiều chi tiết về quân sự và ngoại giao."
+              for i in range(24)]
+
+
+class FixedModel:
+    """Model nhúng giả trong test: vector cố định theo văn bản."""
+
+    def encode(self, sentences, show_progress_bar=False, **kwargs):
+        return np.stack([np.random.default_rng(sum(map(ord, text))).normal(size=16).astype(np.float32)
+                         for text in sentences])
+
+
+def leaf_descendants(tree, node):
+    if node['type'] == 'leaf_node':
+        return {node['index']}
+    return set().union(*(leaf_descendants(tree, tree[child]) for child in node['children']))
+
+
+@pytest.mark.parametrize('tree_mode', ['rounds', 'linkage'])
+def test_tree_modes_produce_the_same_node_schema(fake_llm, tree_mode):
+    tree = run_clustering_with_tree_building(
+        fake_llm, FixedModel(), [{'full_text': text} for text in PARAGRAPHS], enrichment_mode='sequential',
+        k_search='hierarchy', clustering_engine='sklearn', tree_mode=tree_mode, branching_factor=4)['tree']
+
+    leaves = [node for node in tree if node['type'] == 'leaf_node']
+    internal = [node for node in tree if node['type'] != 'leaf_node']
+    assert len(leaves) == len(PARAGRAPHS)
+    assert [node['index'] for node in tree] == list(range(len(tree)))
+    assert [node['type'] for node in internal].count('root_node') == 1
+    assert tree[-1]['type'] == 'root_node' and tree[-1]['parent_index'] == -1
+
+    for node in tree:
+        assert NODE_KEYS <= node.keys()
+        for child in node['children']:
+            assert tree[child]['parent_index'] == node['index']
+        if node['type'] != 'root_node':
+            parent = tree[node['parent_index']]
+            assert node['index'] in parent['children'] and parent['round'] > node['round']
+    for node in internal:
+        # Nút trong đại diện bởi một đoạn lá của chính nó, original_indices là tập lá con cháu
+        descendants = leaf_descendants(tree, node)
+        assert node['original_indices'] == sorted(descendants)
+        assert node['summarized_paragraph'] in {tree[leaf]['summarized_paragraph'] for leaf in descendants}
+        assert isinstance(node['keyword'], str) and node['keyword']